@@ -1,11 +1,17 @@
 "Test that all archives in test-files get compiled"
+import glob
+import gzip
+import io
 import os
+import tarfile
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
 
 import pytest
 from conftest import ARCHIVES_DESC, ARCHIVES_DIR
 
-from yakunin.archive import Archive
-from yakunin.lib import aruspica_mime
+from yakunin.archive import Archive, task
+from yakunin.lib import TASK_LOG, aruspica_mime, place_file
 
 # TODO: archives with file size = 0 byte
 # TODO: archives with illegal file names
@@ -63,6 +69,25 @@ def test_filetype_guessing(archive, mime, setup_config):
     assert found_mime == mime
 
 
+def test_compressed_tar_peeking(tmp_path):
+    "Compressed tar files are told by their first header, without decompressing them"
+    tar_data = io.BytesIO()
+    with tarfile.open(fileobj=tar_data, mode="w") as tar:
+        big = tarfile.TarInfo("big.pdf")
+        big.size = 1_000_000
+        tar.addfile(big, io.BytesIO(os.urandom(big.size)))
+    compressed = gzip.compress(tar_data.getvalue())
+    # a broken tail is never read
+    half = len(compressed) // 2
+    archive = tmp_path / "broken.tar.gz"
+    archive.write_bytes(compressed[:half])
+    assert aruspica_mime(str(archive)) == "application/x-compressed-tar"
+
+    archive = tmp_path / "small.tex.gz"
+    archive.write_bytes(gzip.compress(b"\\documentclass{article}\n"))
+    assert aruspica_mime(str(archive)) == "application/gzip"
+
+
 TEX_MASTERS = [
     ("01-test.tex", "01-test.tex"),
     ("02-test.tex.gz", "02-test.tex"),
@@ -80,3 +105,116 @@ def test_tex_master_guessing(archive, master):
     with Archive(archive=archive) as arc:
         arc.find_master()
         assert arc.tex_master == master
+
+
+def test_mkpdf_single_pdf(tmp_path):
+    "A pdf alone in an archive (but for hidden files) is the main pdf, even in a subdir"
+    archive = tmp_path / "paper.tar"
+    with tarfile.open(archive, "w") as tar:
+        tar.add(os.path.join(ARCHIVES_DIR, "14-test.pdf"), arcname="paper/14-test.pdf")
+        hidden = tarfile.TarInfo("paper/.DS_Store")
+        tar.addfile(hidden, io.BytesIO(b""))
+    with Archive(archive=str(archive)) as arc:
+        arc.mkpdf()
+        assert arc.main_pdf == "14-test.pdf"
+        assert os.path.isfile(os.path.join(arc.temp_dir, arc.main_pdf))
+
+
+def test_stage_timings():
+    "The time spent in each stage is recorded, without counting nested stages twice"
+    archive = os.path.join(ARCHIVES_DIR, "04-test.tar.gz")
+    with Archive(archive=archive) as arc:
+        arc.tideup_src()
+        stages = [stage for stage, _ in arc.timings]
+        # a stage is recorded when it ends
+        assert stages == ["unpack", "find_master", "tideup_src"]
+        assert all(seconds >= 0 for _, seconds in arc.timings)
+
+
+def test_concurrent_archives():
+    "Archives can be processed in threads of the same process"
+    cwd = os.getcwd()
+    with ThreadPoolExecutor(max_workers=len(TEX_MASTERS)) as executor:
+        futures = []
+        for archive, master in TEX_MASTERS:
+            arc = Archive(archive=archive)
+            futures.append((executor.submit(arc.find_master), arc, master))
+        for future, arc, master in futures:
+            future.result()
+            assert arc.tex_master == master
+            arc.__exit__(None, None, None)
+    assert os.getcwd() == cwd
+
+
+def test_concurrent_task_logs(setup_config):
+    "Each Archive writes only to its own task log, even when run in threads"
+    archives = [Archive(archive=archive) for archive, _ in TEX_MASTERS]
+    with ThreadPoolExecutor(max_workers=len(archives)) as executor:
+        for future in [executor.submit(arc.find_master) for arc in archives]:
+            future.result()
+    for arc in archives:
+        arc.task_log.close()
+        with open(os.path.join(arc.temp_dir, TASK_LOG)) as task_log:
+            log = task_log.read()
+        others = [x.archive_name for x in archives if x is not arc]
+        assert arc.archive_name in log
+        assert not any(other in log for other in others)
+        arc.__exit__(None, None, None)
+
+
+def test_place_file(tmp_path):
+    "Copies are independent of the original; links are allowed only when asked for"
+    src = tmp_path / "src.tex"
+    src.write_text("original")
+    copy = tmp_path / "copy.tex"
+    place_file(src, copy)
+    copy.write_text("changed")
+    assert src.read_text() == "original"
+
+    link = tmp_path / "link.tex"
+    place_file(src, link, link=True)
+    assert link.read_text() == "original"
+    # on the same filesystem, the link is the file itself
+    assert os.path.samefile(src, link)
+
+
+def test_submission_in_place(tmp_path):
+    "The received file is placed in the submission dir and sniffed there"
+    archive = tmp_path / "04-test.tar.gz"
+    place_file(os.path.join(ARCHIVES_DIR, "04-test.tar.gz"), archive)
+    with Archive(archive=str(archive), base_dir=str(tmp_path)) as arc:
+        arc.find_master()
+        submitted = os.path.join(arc.temp_dir, "submission", "04-test.tar.gz")
+        assert os.path.samefile(submitted, archive)
+        assert arc.mime_type == "application/x-compressed-tar"
+    assert archive.exists()
+
+
+class Pipeline(Archive):
+    "An Archive with a task that calls another task"
+
+    @task
+    def inner(self, **kwargs):
+        "Just unpack"
+        if not self.work_dir:
+            self._unpack_archive()
+
+    @task
+    def outer(self, **kwargs):
+        "Call the inner task"
+        self.inner(**kwargs)
+
+
+def test_package_once(tmp_path, monkeypatch):
+    "Only the outermost task packages the result"
+    monkeypatch.setattr(tempfile, "tempdir", str(tmp_path))
+    archive = os.path.join(ARCHIVES_DIR, "04-test.tar.gz")
+    with Pipeline(archive=archive, base_dir=str(tmp_path)) as arc:
+        result = arc.outer()
+        stages = [stage for stage, _ in arc.timings]
+        assert stages.count("submission_archive") == 1
+        assert glob.glob(os.path.join(tmp_path, "*.tar.gz")) == [result]
+        # tasks run as steps of something else are not packaged
+        with arc.pipeline():
+            assert arc.outer() is None
+        assert glob.glob(os.path.join(tmp_path, "*.tar.gz")) == [result]
@@ -0,0 +1,46 @@
+"""Test the processing of many files at once."""
+
+import json
+import os
+import tarfile
+
+from conftest import ARCHIVES_DIR
+
+from yakunin.batch import MANIFEST, process_batch, result_names
+
+
+def test_result_names():
+    """Results are named after the files, unless the names clash."""
+    assert result_names(["a/x.pdf", "b/y.pdf", "c/x.pdf", "manifest.json"]) == [
+        "0-x.pdf",
+        "y.pdf",
+        "2-x.pdf",
+        "3-manifest.json",
+    ]
+
+
+def test_process_batch(setup_config):
+    """Each file gets its own result; failures are reported in the manifest."""
+    paths = [
+        os.path.join(ARCHIVES_DIR, "14-test.pdf"),
+        os.path.join(ARCHIVES_DIR, "04-test.tar.gz"),
+        os.path.join(ARCHIVES_DIR, "14-test-wm.pdf"),
+    ]
+    result = process_batch("find_master", paths, {}, max_workers=2)
+    try:
+        with tarfile.open(result) as tar:
+            names = tar.getnames()
+            manifest = json.load(tar.extractfile(f"./{MANIFEST}"))
+    finally:
+        os.unlink(result)
+
+    assert manifest["command"] == "find_master"
+    assert manifest["succeeded"] == 1
+    assert manifest["failed"] == 2
+    outcomes = {entry["file"]: entry for entry in manifest["files"]}
+    assert outcomes["14-test.pdf"]["outcome"] == "NoTeXMaster"
+    assert outcomes["14-test.pdf"]["result"] is None
+    assert outcomes["04-test.tar.gz"]["outcome"] == "success"
+    assert outcomes["04-test.tar.gz"]["result"] == "./04-test.tar.gz"
+    assert "./04-test.tar.gz/yakunin-task.log" in names
+    assert not any(name.startswith("./14-test.pdf") for name in names)
@@ -0,0 +1,106 @@
+"""Test the result cache."""
+
+import os
+import tarfile
+
+from conftest import ARCHIVES_DIR
+
+import yakunin.archive
+from yakunin.archive import Archive
+from yakunin.cache import ResultCache, cache_key
+
+
+def make_result(path, size):
+    with open(path, "wb") as result:
+        result.write(b"x" * size)
+    return str(path)
+
+
+def test_key():
+    """The key depends on the options that matter, whatever their spelling."""
+    key = cache_key("abc", "watermark", {"text": "DRAFT", "x": 550})
+    assert key == cache_key("abc", "watermark", {"x": 550, "text": "DRAFT"})
+    assert key == cache_key(
+        "abc", "watermark", {"text": "DRAFT", "x": 550, "log": 10, "tex-master": None}
+    )
+    assert key != cache_key("abc", "watermark", {"text": "DRAFT", "x": 551})
+    assert key != cache_key("abc", "mkpdf", {"text": "DRAFT", "x": 550})
+    assert key != cache_key("abd", "watermark", {"text": "DRAFT", "x": 550})
+
+
+def test_get_put(tmp_path):
+    """Stored results are returned as copies owned by the caller."""
+    cache = ResultCache(tmp_path / "cache")
+    assert cache.get("key") is None
+    cache.put("key", make_result(tmp_path / "result", 10))
+    copy = cache.get("key")
+    with open(copy, "rb") as result:
+        assert result.read() == b"x" * 10
+    os.unlink(copy)
+    assert cache.get("key") is not None
+    assert cache.stats() == {"hits": 2, "misses": 1, "entries": 1, "size": 10}
+
+
+def test_lru_eviction(tmp_path):
+    """The least recently used results are evicted first."""
+    cache = ResultCache(tmp_path / "cache", max_size=25)
+    for key in ("a", "b"):
+        cache.put(key, make_result(tmp_path / key, 10))
+    # make "a" older than "b", then use it
+    os.utime(os.path.join(cache.directory, "a.tar.gz"), (0, 0))
+    os.utime(os.path.join(cache.directory, "b.tar.gz"), (1, 1))
+    cache.get("a")
+    cache.put("c", make_result(tmp_path / "c", 10))
+    assert cache.get("b") is None
+    assert cache.get("a") is not None
+    assert cache.get("c") is not None
+    assert cache.size() == 20
+
+
+def test_archive_cache(tmp_path, setup_config):
+    """The result of a task is not computed twice."""
+    cache = ResultCache(tmp_path / "cache")
+    archive = os.path.join(ARCHIVES_DIR, "14-test.pdf")
+    with Archive(archive=archive, cache=cache) as arc:
+        first = arc.mkpdf()
+    with Archive(archive=archive, cache=cache) as arc:
+        second = arc.mkpdf()
+        # nothing has been unpacked
+        assert arc.work_dir is None
+    assert (cache.hits, cache.misses) == (1, 1)
+    with tarfile.open(first) as tar_1, tarfile.open(second) as tar_2:
+        assert tar_1.getnames() == tar_2.getnames()
+    os.unlink(first)
+    os.unlink(second)
+
+
+def test_archive_cache_unpacked(tmp_path, setup_config, monkeypatch):
+    """The digest of an unpacked archive is the one computed while unpacking."""
+    cache = ResultCache(tmp_path / "cache")
+    archive = os.path.join(ARCHIVES_DIR, "15-test.pdf.gz")
+    with Archive(archive=archive, cache=cache) as arc:
+        arc._unpack_archive()
+        with monkeypatch.context() as patch:
+            patch.setattr(yakunin.archive, "file_digest", None)
+            first = arc.mkpdf()
+    with Archive(archive=archive, cache=cache) as arc:
+        second = arc.mkpdf()
+    assert (cache.hits, cache.misses) == (1, 1)
+    os.unlink(first)
+    os.unlink(second)
+
+
+def test_package_formats(tmp_path):
+    """Results keep their format; compression settings do not change the key."""
+    cache = ResultCache(tmp_path / "cache")
+    cache.put("key", make_result(tmp_path / "result.zip", 10))
+    copy = cache.get("key")
+    assert copy.endswith(".zip")
+    os.unlink(copy)
+    assert cache.stats()["entries"] == 1
+
+    key = cache_key("abc", "mkpdf", {"package_format": "zip"})
+    assert key == cache_key(
+        "abc", "mkpdf", {"package_format": "zip", "package_level": 1}
+    )
+    assert key != cache_key("abc", "mkpdf", {"package_format": "gztar"})
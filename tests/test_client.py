@@ -0,0 +1,82 @@
+"""Test the client of the service."""
+
+import datetime
+import email.utils
+import os
+
+from conftest import ARCHIVES_DIR
+
+from yakunin.client import (
+    DEFAULT_RETRY_DELAY,
+    Submission,
+    collect_files,
+    output_names,
+    percentile,
+    read_mix,
+    retry_delay,
+    write_mix,
+)
+
+
+def test_collect_files(tmp_path):
+    """Directories are replaced by the files they contain."""
+    (tmp_path / "issue" / "b").mkdir(parents=True)
+    (tmp_path / "issue" / "b" / "2.pdf").write_text("")
+    (tmp_path / "issue" / "1.pdf").write_text("")
+    single = os.path.join(ARCHIVES_DIR, "14-test.pdf")
+    assert collect_files([single, str(tmp_path / "issue")]) == [
+        single,
+        str(tmp_path / "issue" / "1.pdf"),
+        str(tmp_path / "issue" / "b" / "2.pdf"),
+    ]
+
+
+def test_percentile():
+    """Percentiles are computed with the nearest-rank method."""
+    values = list(range(1, 101))
+    assert percentile(values, 0.50) == 50
+    assert percentile(values, 0.95) == 95
+    assert percentile(values, 0.99) == 99
+    assert percentile([3, 1, 2], 0.5) == 2
+    assert percentile([], 0.5) == 0
+
+
+def test_record_and_replay(tmp_path):
+    """Recorded submissions are replayed in the order they were sent."""
+    submissions = [
+        Submission("b.pdf", "watermark", "wjs.ini", at=0.5),
+        Submission("a.tar.gz", "mkpdf", at=0.1),
+    ]
+    write_mix(tmp_path / "mix.jsonl", submissions)
+    replayed = read_mix(tmp_path / "mix.jsonl")
+    assert [s.as_dict() for s in replayed] == [
+        {"file": "a.tar.gz", "command": "mkpdf", "ini": None, "at": 0.1},
+        {"file": "b.pdf", "command": "watermark", "ini": "wjs.ini", "at": 0.5},
+    ]
+
+
+def test_output_names():
+    """Results are named after file and command, without clashes."""
+    submissions = [
+        Submission("x/a.pdf", "watermark"),
+        Submission("y/a.pdf", "watermark"),
+        Submission("a.pdf", "mkpdf"),
+    ]
+    assert output_names(submissions) == [
+        "0-a.pdf.watermark",
+        "1-a.pdf.watermark",
+        "a.pdf.mkpdf",
+    ]
+
+
+def test_retry_delay():
+    """Retry-After is a number of seconds or an HTTP date."""
+    assert retry_delay("3") == 3
+    assert retry_delay("0.5") == 0.5
+    later = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(
+        seconds=30
+    )
+    assert 25 < retry_delay(email.utils.format_datetime(later, usegmt=True)) <= 30
+    assert retry_delay("Wed, 21 Oct 2015 07:28:00 GMT") == 0
+    for retry_after in (None, "soon", "inf", ""):
+        assert retry_delay(retry_after) == DEFAULT_RETRY_DELAY
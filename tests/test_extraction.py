@@ -0,0 +1,414 @@
+"""Test the extraction of the received archives."""
+
+import bz2
+import gzip
+import hashlib
+import io
+import os
+import shutil
+import tarfile
+import time
+import zipfile
+
+import pytest
+from conftest import ARCHIVES_DIR
+
+import yakunin.extraction
+from yakunin.archive import Archive
+from yakunin.cache import file_digest
+from yakunin.exceptions import ExtractionLimitExceeded, UnknownArchiveFormat
+from yakunin.extraction import (
+    DIRECTORY,
+    FILE,
+    LINK,
+    Limits,
+    StreamedExtraction,
+    extract,
+)
+from yakunin.lib import TASK_LOG
+from yakunin.packaging import package
+
+ARCHIVES = [
+    ("01-test.tex", "copy"),
+    ("02-test.tex.gz", "gz"),
+    ("04-test.tar.gz", "gztar"),
+    ("05-test.tar.bz2", "bztar"),
+    ("11-test.tex.bz2", "bz"),
+    ("19-test.tar", "tar"),
+    ("30440-neg-delay-3.zip", "zip"),
+    ("30527-1811_10998.tar.gz", "gztar"),
+]
+
+
+# members that would end up outside of the work dir (name, type, linkname)
+ESCAPES = {
+    "parent": ("../evil.tex", tarfile.REGTYPE, ""),
+    "nested-parent": ("paper/../../evil.tex", tarfile.REGTYPE, ""),
+    "absolute": ("/tmp/evil.tex", tarfile.REGTYPE, ""),
+    "symlink": ("paper/link", tarfile.SYMTYPE, "../.."),
+    "absolute-symlink": ("link", tarfile.SYMTYPE, "/etc"),
+    "hard-link": ("link", tarfile.LNKTYPE, "../evil.tex"),
+}
+# links that lead outside of the work dir only through each other
+LINK_CHAIN = [
+    ("b", tarfile.SYMTYPE, ".", b""),
+    ("b/c", tarfile.SYMTYPE, "..", b""),
+    ("b/c/evil.txt", tarfile.REGTYPE, "", b"x"),
+]
+
+
+def tar_file(path, members, fileobj_mode="w") -> str:
+    """Write a tar file with the given (name, type, linkname, content) members."""
+    with tarfile.open(path, fileobj_mode) as tar:
+        for name, member_type, linkname, content in members:
+            info = tarfile.TarInfo(name)
+            info.type = member_type
+            info.linkname = linkname
+            info.size = len(content)
+            tar.addfile(info, io.BytesIO(content))
+    return str(path)
+
+
+def tree(directory) -> dict:
+    """Return the content of the files in the given directory, by path."""
+    result = {}
+    for dirpath, _, filenames in os.walk(directory):
+        for name in filenames:
+            path = os.path.join(dirpath, name)
+            with open(path, "rb") as src:
+                result[os.path.relpath(path, directory)] = src.read()
+    return result
+
+
+# how the single files are read, and the suffixes they lose
+SINGLE_FILES = {"copy": (open, ""), "gz": (gzip.open, ".gz"), "bz": (bz2.open, ".bz2")}
+
+
+@pytest.mark.parametrize("archive,archive_format", ARCHIVES)
+def test_formats(tmp_path, archive, archive_format):
+    """The archives are extracted as shutil.unpack_archive would do."""
+    archive = os.path.join(ARCHIVES_DIR, archive)
+    expected = tmp_path / "expected"
+    expected.mkdir()
+    if archive_format in SINGLE_FILES:
+        opener, suffix = SINGLE_FILES[archive_format]
+        name = os.path.basename(archive)
+        name = name[: len(name) - len(suffix)]
+        with opener(archive, "rb") as src:
+            (expected / name).write_bytes(src.read())
+    else:
+        shutil.unpack_archive(archive, expected, archive_format)
+    work_dir = tmp_path / "work"
+    work_dir.mkdir()
+
+    manifest = extract(archive, str(work_dir), archive_format)
+    assert tree(work_dir) == tree(expected)
+    assert manifest.digest == file_digest(archive)
+    for path, size, kind in manifest.members:
+        if kind == FILE:
+            assert os.path.getsize(work_dir / path) == size
+    assert manifest.size == sum(len(content) for content in tree(work_dir).values())
+
+
+@pytest.mark.parametrize("archive_format", ["gztar", "bztar", "gz"])
+def test_digest_on_the_way(tmp_path, monkeypatch, archive_format):
+    """Streamed archives are hashed while they are extracted (and read once)."""
+    archive = dict((y, x) for x, y in ARCHIVES)[archive_format]
+    archive = os.path.join(ARCHIVES_DIR, archive)
+    expected = file_digest(archive)
+    monkeypatch.setattr(yakunin.extraction, "file_digest", None)
+    manifest = extract(archive, str(tmp_path), archive_format)
+    assert manifest.digest == expected
+
+
+def test_manifest(tmp_path):
+    """The manifest records every member, but lists only visible files."""
+    archive = tmp_path / "test.tar"
+    with tarfile.open(archive, "w") as tar:
+        for name, content in (("main.tex", b"\\documentclass"), (".hidden", b"x")):
+            info = tarfile.TarInfo(f"paper/{name}")
+            info.size = len(content)
+            tar.addfile(info, io.BytesIO(content))
+        info = tarfile.TarInfo("paper/figs")
+        info.type = tarfile.DIRTYPE
+        tar.addfile(info)
+        info = tarfile.TarInfo("paper/link.tex")
+        info.type = tarfile.SYMTYPE
+        info.linkname = "main.tex"
+        tar.addfile(info)
+    work_dir = tmp_path / "work"
+    work_dir.mkdir()
+
+    manifest = extract(str(archive), str(work_dir), "tar")
+    assert manifest.members == [
+        ("paper/main.tex", 14, FILE),
+        ("paper/.hidden", 1, FILE),
+        ("paper/figs", 0, DIRECTORY),
+        ("paper/link.tex", 0, LINK),
+    ]
+    assert manifest.files() == ["paper/main.tex", "paper/link.tex"]
+    assert (work_dir / "paper" / "link.tex").read_bytes() == b"\\documentclass"
+
+
+def test_multi_member_gzip(tmp_path):
+    """The tar.gz compressed in parallel (see yakunin.packaging) are extracted."""
+    source = tmp_path / "source"
+    source.mkdir()
+    (source / "main.tex").write_bytes(os.urandom(3 * 1024 * 1024))
+    archive = package(str(source), threads=3)
+    try:
+        manifest = extract(archive, str(tmp_path), "gztar")
+    finally:
+        os.unlink(archive)
+    assert manifest.files() == ["main.tex"]
+    assert (tmp_path / "main.tex").read_bytes() == (source / "main.tex").read_bytes()
+
+
+def test_broken_archive(tmp_path):
+    """Broken archives are reported as shutil.unpack_archive does."""
+    with open(os.path.join(ARCHIVES_DIR, "30527-1811_10998.tar.gz"), "rb") as src:
+        content = src.read()
+    archive = tmp_path / "broken.tar.gz"
+    half = len(content) // 2
+    archive.write_bytes(content[:half])
+    work_dir = tmp_path / "work"
+    work_dir.mkdir()
+    with pytest.raises(shutil.ReadError):
+        extract(str(archive), str(work_dir), "gztar")
+
+
+def test_limits_from_config():
+    """Limits are read from the configuration, with dashes or underscores."""
+    limits = Limits.from_config(
+        {"max-unpacked-size": "1000", "max_members": 10, "pdfa_url": "x"}
+    )
+    assert (limits.max_size, limits.max_members) == (1000, 10)
+    assert limits.max_ratio == yakunin.extraction.MAX_COMPRESSION_RATIO
+    assert limits.max_depth == yakunin.extraction.MAX_PATH_DEPTH
+
+
+@pytest.mark.parametrize("archive_format", ["gz", "gztar"])
+def test_too_big(tmp_path, archive_format):
+    """The extraction stops as soon as it goes beyond the maximum size."""
+    content = bytes(4 * 1024 * 1024)
+    if archive_format == "gz":
+        archive = tmp_path / "bomb.tex.gz"
+        archive.write_bytes(gzip.compress(content))
+    else:
+        archive = tmp_path / "bomb.tar.gz"
+        tar_file(archive, [("bomb.tex", tarfile.REGTYPE, "", content)], "w:gz")
+    work_dir = tmp_path / "work"
+    work_dir.mkdir()
+    with pytest.raises(ExtractionLimitExceeded, match="bytes"):
+        extract(str(archive), str(work_dir), archive_format, Limits(max_size=1000000))
+    # (no more than a chunk beyond the limit has been written)
+    assert sum(len(content) for content in tree(work_dir).values()) < 2000000
+
+
+def test_compression_ratio(tmp_path, monkeypatch):
+    """Archives that expand too much are refused, even below the maximum size."""
+    monkeypatch.setattr(yakunin.extraction, "RATIO_GRACE", 0)
+    archive = tmp_path / "bomb.tex.gz"
+    archive.write_bytes(gzip.compress(bytes(1024 * 1024)))
+    with pytest.raises(ExtractionLimitExceeded, match="ratio"):
+        extract(str(archive), str(tmp_path), "gz")
+    # TeX sources compress much less
+    archive = os.path.join(ARCHIVES_DIR, "02-test.tex.gz")
+    work_dir = tmp_path / "work"
+    work_dir.mkdir()
+    extract(archive, str(work_dir), "gz")
+
+
+def test_too_many_members(tmp_path):
+    """The extraction stops at the first member beyond the maximum."""
+    members = [(f"{index}.tex", tarfile.REGTYPE, "", b"x") for index in range(10)]
+    archive = tar_file(tmp_path / "many.tar", members)
+    work_dir = tmp_path / "work"
+    work_dir.mkdir()
+    with pytest.raises(ExtractionLimitExceeded, match="members"):
+        extract(archive, str(work_dir), "tar", Limits(max_members=3))
+    assert len(os.listdir(work_dir)) == 3
+
+
+def test_too_deep(tmp_path):
+    """Paths with too many components are refused."""
+    archive = tmp_path / "deep.zip"
+    with zipfile.ZipFile(archive, "w") as zip_file:
+        zip_file.writestr("a/b/main.tex", "x")
+        zip_file.writestr("a/b/c/d/main.tex", "x")
+    work_dir = tmp_path / "work"
+    work_dir.mkdir()
+    with pytest.raises(ExtractionLimitExceeded, match="deeper"):
+        extract(str(archive), str(work_dir), "zip", Limits(max_depth=3))
+    assert tree(work_dir) == {"a/b/main.tex": b"x"}
+
+
+@pytest.mark.parametrize("name", ESCAPES)
+def test_escapes(tmp_path, name):
+    """Members and links that point outside of the work dir are refused."""
+    member_name, member_type, linkname = ESCAPES[name]
+    members = [("main.tex", tarfile.REGTYPE, "", b"x")]
+    members.append((member_name, member_type, linkname, b""))
+    members.append(("link/evil.tex", tarfile.REGTYPE, "", b"x"))
+    archive = tar_file(tmp_path / "evil.tar", members)
+    work_dir = tmp_path / "work" / "dir"
+    work_dir.mkdir(parents=True)
+    with pytest.raises(ExtractionLimitExceeded, match="outside"):
+        extract(archive, str(work_dir), "tar")
+    assert os.listdir(work_dir) == ["main.tex"]
+    assert os.listdir(work_dir.parent) == ["dir"]
+
+
+@pytest.mark.parametrize("archive_format", ["tar", "gztar"])
+def test_link_chain(tmp_path, archive_format):
+    """Links that lead outside of the work dir through other links are refused."""
+    mode = {"tar": "w", "gztar": "w:gz"}[archive_format]
+    archive = tar_file(tmp_path / "evil.tar", LINK_CHAIN, mode)
+    work_dir = tmp_path / "work" / "dir"
+    work_dir.mkdir(parents=True)
+    with pytest.raises(ExtractionLimitExceeded, match="outside"):
+        extract(archive, str(work_dir), archive_format)
+    assert os.listdir(work_dir.parent) == ["dir"]
+
+
+def test_zip_escapes(tmp_path):
+    """Zip members that point outside of the work dir are refused too."""
+    archive = tmp_path / "evil.zip"
+    with zipfile.ZipFile(archive, "w") as zip_file:
+        zip_file.writestr("main..tex", "x")
+        zip_file.writestr("../evil.tex", "x")
+    work_dir = tmp_path / "work"
+    work_dir.mkdir()
+    with pytest.raises(ExtractionLimitExceeded):
+        extract(str(archive), str(work_dir), "zip")
+    assert sorted(os.listdir(tmp_path)) == ["evil.zip", "work"]
+    assert tree(work_dir) == {"main..tex": b"x"}
+
+
+def test_archive_limits(tmp_path):
+    """Archives that go beyond the limits fail as unknown formats, leaving nothing behind."""
+    archive = os.path.join(ARCHIVES_DIR, "30527-1811_10998.tar.gz")
+    with Archive(
+        archive=archive, base_dir=str(tmp_path), limits=Limits(max_members=2)
+    ) as arc:
+        with pytest.raises(UnknownArchiveFormat):
+            arc._unpack_archive()
+        assert os.listdir(arc.work_dir) == []
+        arc.task_log.close()
+        with open(os.path.join(arc.temp_dir, TASK_LOG)) as log:
+            assert "more than 2 members" in log.read()
+
+
+def wait_for(condition, timeout=10):
+    """Wait until the condition is true."""
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "Timed out"
+        time.sleep(0.01)
+
+
+def test_streamed_extraction(tmp_path):
+    """Tar files are extracted while they are written, as extract would do."""
+    members = [
+        ("paper/main.tex", tarfile.REGTYPE, "", b"\\documentclass{article}\n"),
+        ("paper/data.bin", tarfile.REGTYPE, "", os.urandom(2 * 1024 * 1024)),
+    ]
+    tar_file(tmp_path / "paper.tar.gz", members, "w:gz")
+    data = (tmp_path / "paper.tar.gz").read_bytes()
+    upload = tmp_path / "upload.tar.gz"
+    work_dir = tmp_path / "work"
+    work_dir.mkdir()
+    with open(upload, "wb") as dst:
+        extraction = StreamedExtraction(str(upload), str(work_dir))
+        half = len(data) // 2
+        dst.write(data[:half])
+        dst.flush()
+        # the first member is there before the file is complete
+        wait_for((work_dir / "paper" / "main.tex").exists)
+        assert not extraction.future.done()
+        dst.write(data[half:])
+    extraction.finish()
+    extracted = extraction.future.result(timeout=10)
+
+    expected = tmp_path / "expected"
+    expected.mkdir()
+    manifest = extract(str(upload), str(expected), "gztar")
+    assert extracted.format == "gztar"
+    assert extracted.manifest.members == manifest.members
+    assert extracted.manifest.digest == hashlib.sha256(data).hexdigest()
+    assert tree(work_dir) == tree(expected)
+
+
+def test_streamed_not_tar(tmp_path):
+    """Files that are not tar files are left alone."""
+    upload = tmp_path / "upload.pdf"
+    shutil.copy(os.path.join(ARCHIVES_DIR, "14-test.pdf"), upload)
+    work_dir = tmp_path / "work"
+    work_dir.mkdir()
+    # (the beginning of the file is enough to tell)
+    extraction = StreamedExtraction(str(upload), str(work_dir))
+    assert extraction.future.result(timeout=10) is None
+    assert not work_dir.exists()
+    extraction.finish()
+
+
+def test_streamed_abort(tmp_path):
+    """Aborted extractions stop at once and leave nothing behind."""
+    with open(os.path.join(ARCHIVES_DIR, "30527-1811_10998.tar.gz"), "rb") as src:
+        data = src.read()
+    upload = tmp_path / "upload.tar.gz"
+    upload.write_bytes(data[: len(data) // 2])
+    work_dir = tmp_path / "work"
+    work_dir.mkdir()
+    extraction = StreamedExtraction(str(upload), str(work_dir))
+    wait_for(lambda: os.listdir(work_dir))
+    extraction.abort()
+    assert extraction.future.result(timeout=0) is None
+    assert not work_dir.exists()
+
+
+def test_streamed_limits(tmp_path):
+    """The limits are enforced while receiving, and reported when adopting."""
+    members = [(f"{index}.tex", tarfile.REGTYPE, "", b"x") for index in range(5)]
+    upload = tar_file(tmp_path / "upload.tar", members)
+    work_dir = tmp_path / "work"
+    work_dir.mkdir()
+    extraction = StreamedExtraction(upload, str(work_dir), Limits(max_members=2))
+    extraction.finish()
+    extracted = extraction.future.result(timeout=10)
+    assert not work_dir.exists()
+    with pytest.raises(ExtractionLimitExceeded, match="members"):
+        extracted.adopt(str(tmp_path), upload)
+
+
+def test_streamed_link_chain(tmp_path):
+    """Links that lead outside through other links are refused while receiving too."""
+    upload = tar_file(tmp_path / "upload.tar.gz", LINK_CHAIN, "w:gz")
+    work_dir = tmp_path / "work" / "dir"
+    work_dir.mkdir(parents=True)
+    extraction = StreamedExtraction(upload, str(work_dir))
+    extraction.finish()
+    extracted = extraction.future.result(timeout=10)
+    assert os.listdir(work_dir.parent) == []
+    with pytest.raises(ExtractionLimitExceeded, match="outside"):
+        extracted.adopt(str(tmp_path), upload)
+
+
+@pytest.mark.parametrize("archive_format", ["tar", "gztar", "bztar"])
+def test_archive_adopts(tmp_path, monkeypatch, archive_format):
+    """An Archive adopts what has been extracted while it was received."""
+    archive = dict((y, x) for x, y in ARCHIVES)[archive_format]
+    archive = os.path.join(ARCHIVES_DIR, archive)
+    work_dir = tmp_path / "unpacked"
+    work_dir.mkdir()
+    extraction = StreamedExtraction(archive, str(work_dir))
+    extraction.finish()
+    extracted = extraction.future.result(timeout=10)
+    files = tree(work_dir)
+
+    monkeypatch.setattr(yakunin.archive, "extract", None)
+    with Archive(archive=archive, base_dir=str(tmp_path), extracted=extracted) as arc:
+        arc._unpack_archive()
+        assert tree(arc.work_dir) == files
+        assert arc.manifest.files()
+    assert not work_dir.exists()
@@ -3,10 +3,17 @@
 
 import io
 import logging
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 import pytest
+from conftest import ARCHIVES_DIR
 
 import yakunin.log_reading_lib as lr
+from yakunin.archive import Archive
+from yakunin.lib import TASK_LOG
 
 TASK_LOGGER = logging.getLogger("yakunin.task")
 
@@ -207,3 +214,36 @@ def test_log_reading_functions(func_name, tex_log_text, expected, setup_config):
         assert expected in log_lines
     else:
         assert expected not in log_lines
+
+
+def test_live_log_reading(tmp_path, setup_config):
+    "Problems are reported while the compilation is still running"
+    release = tmp_path / "release"
+    engine = tmp_path / "engine.py"
+    engine.write_text(
+        "import os, sys, time\n"
+        'print("! Undefined control sequence.", flush=True)\n'
+        'print("l.3 \\\\foo", flush=True)\n'
+        f"while not os.path.exists({str(release)!r}):\n"
+        "    time.sleep(0.05)\n"
+        "sys.exit(1)\n"
+    )
+    archive = Archive(archive=os.path.join(ARCHIVES_DIR, "01-test.tex"))
+    log_path = os.path.join(archive.temp_dir, TASK_LOG)
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        future = executor.submit(
+            archive.tex_compile,
+            tex_engine=f"{sys.executable} {engine}",
+            timeout_compilation=30,
+        )
+        for _ in range(200):
+            with open(log_path) as task_log:
+                if '"\\foo" is undefined' in task_log.read():
+                    break
+            time.sleep(0.05)
+        else:
+            pytest.fail("The problem has not been reported while compiling")
+        assert not future.done()
+        release.touch()
+        os.unlink(future.result())
+    archive.__exit__(None, None, None)
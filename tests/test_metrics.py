@@ -0,0 +1,42 @@
+"""Test the metrics registry."""
+
+import pytest
+
+from yakunin.metrics import Registry
+
+
+def test_render():
+    """Counters, gauges and histograms are rendered in Prometheus' text format."""
+    metrics = Registry()
+    requests = metrics.counter("requests_total", "Requests.", ("code",))
+    requests.inc(code=200)
+    requests.inc(2, code=200)
+    requests.inc(code=404)
+    metrics.gauge("load", "Load.", (), lambda: {(): 0.5})
+    histogram = metrics.histogram("duration_seconds", "Duration.", ("task",))
+    histogram.observe(0.07, task="mkpdf")
+    histogram.observe(400, task="mkpdf")
+
+    assert metrics.counter("requests_total", "Requests.", ("code",)) is requests
+    assert requests.get(code=200) == 3
+    assert histogram.get_count(task="mkpdf") == 2
+
+    text = metrics.render()
+    assert "# TYPE requests_total counter\n" in text
+    assert 'requests_total{code="200"} 3\n' in text
+    assert 'requests_total{code="404"} 1\n' in text
+    assert "# TYPE load gauge\nload 0.5\n" in text
+    # buckets are cumulative
+    assert 'duration_seconds_bucket{task="mkpdf",le="0.05"} 0\n' in text
+    assert 'duration_seconds_bucket{task="mkpdf",le="0.1"} 1\n' in text
+    assert 'duration_seconds_bucket{task="mkpdf",le="300"} 1\n' in text
+    assert 'duration_seconds_bucket{task="mkpdf",le="+Inf"} 2\n' in text
+    assert 'duration_seconds_sum{task="mkpdf"} 400.07\n' in text
+    assert 'duration_seconds_count{task="mkpdf"} 2\n' in text
+
+
+def test_wrong_labels():
+    """Samples must have exactly the declared labels."""
+    counter = Registry().counter("tasks_total", "Tasks.", ("task", "outcome"))
+    with pytest.raises(ValueError):
+        counter.inc(task="mkpdf")
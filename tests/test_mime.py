@@ -0,0 +1,152 @@
+"""Test the in-process detection of mime types against `file`."""
+
+import io
+import os
+import struct
+import tarfile
+import zipfile
+
+import pytest
+from conftest import ARCHIVES_DIR
+
+from yakunin.lib import file_mime
+from yakunin.mime import TAR_HEADER_SIZE, is_tar_header, sniff
+
+TEST_FILES = sorted(
+    os.path.join(ARCHIVES_DIR, name)
+    for name in os.listdir(ARCHIVES_DIR)
+    if not name.endswith(".xml")
+)
+
+DOCUMENTCLASS = b"\\documentclass{article}\n"
+TEXTS = {
+    "tex": DOCUMENTCLASS + b"\\begin{document}\\end{document}\n",
+    "comment-first": b"% main file\n\\input{intro}\n",
+    "latin1": DOCUMENTCLASS + "\u00e8\n".encode("latin-1"),
+    "bom": b"\xef\xbb\xbf" + DOCUMENTCLASS,
+    "late-command": b"%" + b"x" * 4100 + b"\\input\n",
+    "no-command": b"\\def\\x{1}\n",
+    "binary": DOCUMENTCLASS + b"\x00\x01\n",
+    "nul-at-end": DOCUMENTCLASS + b"\x00",
+    "postscript": b"%!PS\n" + DOCUMENTCLASS,
+    "shell": b"#!/bin/sh\n" + DOCUMENTCLASS,
+    "pdf-in-text": DOCUMENTCLASS + b"%PDF-1.4\n",
+    "empty": b"",
+}
+ZIPS = {
+    "plain": ["main.tex", "fig.pdf"],
+    "docx": ["[Content_Types].xml", "_rels/.rels", "word/document.xml"],
+    "docx-word-second": ["[Content_Types].xml", "word/document.xml", "a.xml"],
+    "docx-word-first": ["word/document.xml", "[Content_Types].xml"],
+    "xlsx": ["[Content_Types].xml", "_rels/.rels", "xl/workbook.xml"],
+    "odt": ["mimetype", "content.xml"],
+    "epub": ["mimetype", "content.opf"],
+}
+TAR_FORMATS = {
+    "ustar": tarfile.USTAR_FORMAT,
+    "gnu": tarfile.GNU_FORMAT,
+    "pax": tarfile.PAX_FORMAT,
+    "v7": tarfile.USTAR_FORMAT,
+}
+ZIP_MIMETYPES = {
+    "odt": "application/vnd.oasis.opendocument.text",
+    "epub": "application/epub+zip",
+}
+
+
+def ole_file(*names: str) -> bytes:
+    """Return a compound file (as .doc files are) with the given streams."""
+    header = bytes.fromhex("d0cf11e0a1b11ae1") + bytes(16)
+    header += struct.pack(
+        "<5H6x9I", 0x3E, 3, 0xFFFE, 9, 6, 0, 1, 1, 0, 4096, 0xFFFFFFFE, 0, 0xFFFFFFFE, 0
+    )
+    header += struct.pack("<I", 0) + b"\xff" * 432
+    fat = struct.pack("<II", 0xFFFFFFFD, 0xFFFFFFFE).ljust(512, b"\xff")
+    directory = b""
+    for index, name in enumerate(("Root Entry",) + names):
+        encoded = (name + "\0").encode("utf-16-le")
+        child = 1 if index == 0 else 0xFFFFFFFF
+        right = index + 1 if 0 < index < len(names) else 0xFFFFFFFF
+        directory += encoded.ljust(64, b"\0")
+        directory += struct.pack(
+            "<HBBIII", len(encoded), 5 if index == 0 else 2, 1, 0xFFFFFFFF, right, child
+        )
+        directory += bytes(36) + struct.pack("<IQ", 0xFFFFFFFE, 0)
+    return header + fat + directory.ljust(512, b"\0")
+
+
+@pytest.mark.parametrize("path", TEST_FILES)
+def test_test_files(path):
+    """The types of the test files are told, as `file` tells them."""
+    assert sniff(path) == file_mime(path)
+
+
+@pytest.mark.parametrize("name", TEXTS)
+def test_texts(tmp_path, name):
+    """Text files are TeX sources only when `file` says so."""
+    path = tmp_path / name
+    path.write_bytes(TEXTS[name])
+    found = sniff(str(path))
+    assert found in (file_mime(str(path)), None)
+    if name in ("tex", "comment-first", "latin1", "bom", "nul-at-end"):
+        assert found == "text/x-tex"
+    if name == "pdf-in-text":
+        assert found == "application/pdf"
+
+
+@pytest.mark.parametrize("name", ZIPS)
+def test_zips(tmp_path, name):
+    """OpenDocument and OOXML files are told from plain zip files, as `file` does."""
+    path = tmp_path / name
+    with zipfile.ZipFile(path, "w") as zip_file:
+        for member in ZIPS[name]:
+            content = ZIP_MIMETYPES[name] if member == "mimetype" else "x"
+            zip_file.writestr(member, content)
+    found = sniff(str(path))
+    assert found in (file_mime(str(path)), None)
+    if name == "plain":
+        assert found == "application/zip"
+    if name in ("docx", "docx-word-first"):
+        assert (
+            found
+            == "application/vnd.openxmlformats-officedocument.wordprocessingml.document"
+        )
+    if name == "odt":
+        assert found == "application/vnd.oasis.opendocument.text"
+
+
+def test_msword(tmp_path):
+    """Word documents are told among the other compound files."""
+    path = tmp_path / "test.doc"
+    path.write_bytes(ole_file("1Table", "WordDocument"))
+    assert sniff(str(path)) == file_mime(str(path)) == "application/msword"
+
+    path = tmp_path / "test.xls"
+    path.write_bytes(ole_file("Workbook"))
+    assert sniff(str(path)) is None
+
+
+@pytest.mark.parametrize("tar_format", TAR_FORMATS)
+def test_tar_header(tmp_path, tar_format):
+    """Tar files are told by their first header, even without the ustar magic."""
+    data = io.BytesIO()
+    with tarfile.open(fileobj=data, mode="w", format=TAR_FORMATS[tar_format]) as tar:
+        tar.addfile(tarfile.TarInfo("main.tex"), io.BytesIO(b""))
+    tar_data = bytearray(data.getvalue())
+    if tar_format == "v7":
+        # no magic and version, and the checksum without them
+        tar_data[257:265] = bytes(8)
+        checksum = sum(tar_data[:148]) + 8 * ord(" ") + sum(tar_data[156:512])
+        tar_data[148:156] = b"%06o\0 " % checksum
+    assert is_tar_header(bytes(tar_data[:TAR_HEADER_SIZE]))
+
+    path = tmp_path / "test.tar"
+    path.write_bytes(tar_data)
+    assert sniff(str(path)) == file_mime(str(path)) == "application/x-tar"
+
+
+def test_not_tar_header():
+    """Short or text blocks are not tar headers."""
+    assert not is_tar_header(b"\\documentclass{article}\n".ljust(TAR_HEADER_SIZE))
+    assert not is_tar_header(bytes(TAR_HEADER_SIZE))
+    assert not is_tar_header(b"main.tex")
@@ -0,0 +1,83 @@
+"""Test the incremental multipart/form-data parser."""
+
+import os
+
+import pytest
+from conftest import ARCHIVES_DIR
+from urllib3 import encode_multipart_formdata
+
+from yakunin.multipart import MultipartError, MultipartParser
+
+
+def make_body():
+    """Return the content of a test file and a multipart body that contains it."""
+    with open(os.path.join(ARCHIVES_DIR, "04-test.tar.gz"), "rb") as src:
+        content = src.read()
+    body, content_type = encode_multipart_formdata(
+        {
+            "command": "mkpdf",
+            "ini": ("wjs.ini", b"[wjs]\ntext = Ciao\n", "text/plain"),
+            "file": ("../../04-test.tar.gz", content, "application/gzip"),
+        }
+    )
+    boundary = content_type.split("boundary=")[1].encode()
+    return content, body, boundary
+
+
+@pytest.mark.parametrize("chunk_size", [1, 7, 100, 65536])
+def test_parse_in_chunks(tmp_path, chunk_size):
+    """The file part is written to disk, the other parts are kept in memory."""
+    content, body, boundary = make_body()
+    parser = MultipartParser(boundary, str(tmp_path))
+    for start in range(0, len(body), chunk_size):
+        parser.feed(body[start : start + chunk_size])  # NOQA E203
+    parser.finish()
+
+    assert parser.arguments == {"command": [b"mkpdf"]}
+    assert parser.files["ini"][0]["body"] == b"[wjs]\ntext = Ciao\n"
+
+    file_posted = parser.files["file"][0]
+    # the path given by the client is not trusted
+    assert file_posted["path"] == str(tmp_path / "04-test.tar.gz")
+    assert file_posted["size"] == len(content)
+    with open(file_posted["path"], "rb") as received:
+        assert received.read() == content
+
+
+def test_truncated_body(tmp_path):
+    """A body without the final delimiter is an error."""
+    content, body, boundary = make_body()
+    parser = MultipartParser(boundary, str(tmp_path))
+    parser.feed(body[: len(body) // 2])
+    with pytest.raises(MultipartError):
+        parser.finish()
+
+
+def test_same_file_names(tmp_path):
+    """Files with the same name are all kept, each with its name."""
+    body, content_type = encode_multipart_formdata(
+        [
+            ("file", ("a/main.tex", b"first", "text/plain")),
+            ("file", ("b/main.tex", b"second", "text/plain")),
+        ]
+    )
+    parser = MultipartParser(content_type.split("boundary=")[1].encode(), str(tmp_path))
+    parser.feed(body)
+    parser.finish()
+
+    paths = [file_posted["path"] for file_posted in parser.files["file"]]
+    assert paths[0] == str(tmp_path / "main.tex")
+    assert os.path.basename(paths[1]) == "main.tex"
+    assert [open(path, "rb").read() for path in paths] == [b"first", b"second"]
+
+
+def test_headers_not_utf8(tmp_path):
+    """Part headers that are not UTF-8 are an error."""
+    body = (
+        b"--xxx\r\n"
+        b'Content-Disposition: form-data; name="file"; filename="\xe0.tex"\r\n\r\n'
+        b"x\r\n--xxx--\r\n"
+    )
+    parser = MultipartParser(b"xxx", str(tmp_path))
+    with pytest.raises(MultipartError):
+        parser.feed(body)
@@ -0,0 +1,99 @@
+"""Test the packaging of the results."""
+
+import gzip
+import io
+import os
+import shutil
+import tarfile
+import zipfile
+
+import pytest
+
+from yakunin.packaging import (
+    FORMATS,
+    ParallelGzipWriter,
+    content_type,
+    package,
+    read_member,
+)
+
+
+@pytest.fixture
+def result_dir(tmp_path):
+    """A directory that looks like the temp dir of an Archive."""
+    directory = tmp_path / "result"
+    (directory / "work").mkdir(parents=True)
+    (directory / "submission").mkdir()
+    (directory / "yakunin-task.log").write_text("INFO Main pdf is main.pdf\n")
+    (directory / "work" / "main.tex").write_text("\\documentclass{article}\n" * 1000)
+    (directory / "main.pdf").write_bytes(os.urandom(100_000))
+    (directory / "work" / "link.tex").symlink_to("/etc/hostname")
+    return directory
+
+
+@pytest.mark.parametrize("package_format", FORMATS)
+@pytest.mark.parametrize("threads", [1, 3])
+def test_formats(result_dir, package_format, threads):
+    """Every format contains the whole directory."""
+    if package_format == "zstdtar" and shutil.which("zstd") is None:
+        pytest.skip("zstd is not installed")
+    result = package(str(result_dir), package_format, threads=threads)
+    try:
+        assert read_member(result, "yakunin-task.log") == b"INFO Main pdf is main.pdf\n"
+        assert read_member(result, "work/main.tex").startswith(b"\\documentclass")
+        assert read_member(result, "missing.txt") is None
+        assert content_type(result) in (
+            "application/gzip",
+            "application/zstd",
+            "application/zip",
+        )
+    finally:
+        os.unlink(result)
+
+
+def test_default_is_tar_gz(result_dir):
+    """By default, results are tar.gz files with paths starting with "./"."""
+    result = package(str(result_dir))
+    try:
+        assert result.endswith(".tar.gz")
+        with tarfile.open(result, "r:gz") as tar:
+            names = tar.getnames()
+            assert tar.getmember("./work/link.tex").issym()
+        assert "./main.pdf" in names
+        assert "./work/main.tex" in names
+    finally:
+        os.unlink(result)
+
+
+def test_parallel_gzip(tmp_path):
+    """Blocks compressed in parallel make a valid gzip file."""
+    data = os.urandom(1000) * 500
+    path = tmp_path / "data.gz"
+    with open(path, "wb") as fileobj:
+        with ParallelGzipWriter(fileobj, level=1, threads=4, block_size=10_000) as gz:
+            chunks = io.BytesIO(data)
+            for chunk in iter(lambda: chunks.read(7777), b""):
+                gz.write(chunk)
+    with gzip.open(path) as gz:
+        assert gz.read() == data
+
+
+def test_zip_stores_compressed_files(result_dir):
+    """Compressed files are stored as they are; links are not followed."""
+    result = package(str(result_dir), "zip")
+    try:
+        with zipfile.ZipFile(result) as zip_file:
+            assert zip_file.getinfo("main.pdf").compress_type == zipfile.ZIP_STORED
+            info = zip_file.getinfo("work/main.tex")
+            assert info.compress_type == zipfile.ZIP_DEFLATED
+            assert info.compress_size < info.file_size
+            assert zip_file.read("work/link.tex") == b"/etc/hostname"
+    finally:
+        os.unlink(result)
+
+
+@pytest.mark.parametrize("package_format,level", [("gztar", 10), ("bztar", None)])
+def test_invalid_options(result_dir, package_format, level):
+    """Unknown formats and levels are refused."""
+    with pytest.raises(ValueError):
+        package(str(result_dir), package_format, level=level)
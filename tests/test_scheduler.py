@@ -0,0 +1,157 @@
+"""Test the admission control of the service."""
+
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from yakunin.scheduler import (
+    COMPILE,
+    FAST,
+    REMOTE,
+    QueueFull,
+    Scheduler,
+    SingleFlight,
+    choose_lane,
+)
+
+
+def test_limits():
+    """Tasks beyond the concurrency wait; tasks beyond the queue are refused."""
+    release = threading.Event()
+    scheduler = Scheduler(concurrency={"mkpdf": 1}, max_queue=1)
+    executor = ThreadPoolExecutor(max_workers=4)
+
+    async def scenario():
+        limiter = scheduler.limiter("mkpdf")
+        first = asyncio.ensure_future(limiter.run(executor, release.wait))
+        second = asyncio.ensure_future(limiter.run(executor, release.wait))
+        await asyncio.sleep(0.1)
+        assert scheduler.status()["mkpdf"]["in_flight"] == 1
+        assert scheduler.status()["mkpdf"]["waiting"] == 1
+        assert scheduler.is_full("mkpdf")
+        with pytest.raises(QueueFull):
+            limiter.run(executor, release.wait)
+
+        # other types of task have their own limits
+        assert await scheduler.limiter("watermark").run(executor, sum, [1, 2]) == 3
+
+        release.set()
+        assert await first
+        assert await second
+        assert scheduler.status()["mkpdf"]["in_flight"] == 0
+        assert not scheduler.is_full("mkpdf")
+
+    asyncio.run(scenario())
+    executor.shutdown()
+
+
+@pytest.mark.parametrize(
+    "command,mime_type,lane",
+    [
+        ("watermark", "application/pdf", FAST),
+        ("mkpdf", "application/pdf", FAST),
+        ("find_master", "application/gzip", FAST),
+        ("watermark", "application/gzip", COMPILE),
+        ("mkpdf", "application/vnd.oasis.opendocument.text", COMPILE),
+        ("mkpdf", "application/msword", REMOTE),
+        ("topdfa", "application/pdf", REMOTE),
+    ],
+)
+def test_lanes(command, mime_type, lane):
+    """Tasks are sorted by their expected cost."""
+    assert choose_lane(command, mime_type) == lane
+
+
+def test_single_flight():
+    """Identical tasks run once; the result is disposed of when nobody needs it."""
+    flights = SingleFlight()
+    started = []
+    disposed = []
+
+    async def task(value):
+        started.append(value)
+        await asyncio.sleep(0.1)
+        return value
+
+    async def scenario():
+        first = flights.join("a", lambda: task(1), disposed.append)
+        second = flights.join("a", lambda: task(2), disposed.append)
+        other = flights.join("b", lambda: task(3), disposed.append)
+        assert first is second
+        assert first is not other
+        assert await first.wait() == 1
+        assert await second.wait() == 1
+        first.leave()
+        assert disposed == []
+        second.leave()
+        assert disposed == [1]
+        # once done, the task is started again
+        third = flights.join("a", lambda: task(4), disposed.append)
+        assert await third.wait() == 4
+        third.leave()
+        other.leave()
+        await other.wait()
+
+    asyncio.run(scenario())
+    assert started == [1, 3, 4]
+    assert sorted(disposed) == [1, 3, 4]
+
+
+def test_flight_cleanup():
+    """The flight is cleaned up once, when it is over, whatever the outcome."""
+    flights = SingleFlight()
+    cleaned = []
+
+    async def fail():
+        raise ValueError("failed")
+
+    async def scenario():
+        first = flights.join("a", fail, cleanup=lambda: cleaned.append("a"))
+        second = flights.join("a", fail, cleanup=lambda: cleaned.append("other"))
+        with pytest.raises(ValueError):
+            await first.wait()
+        first.leave()
+        assert cleaned == []
+        second.leave()
+        assert cleaned == ["a"]
+
+        cancelled = flights.join(
+            "b", lambda: asyncio.sleep(10), cleanup=lambda: cleaned.append("b")
+        )
+        cancelled.leave()
+        await asyncio.sleep(0.01)
+        assert cleaned == ["a", "b"]
+
+    asyncio.run(scenario())
+
+
+def test_flight_cancelled():
+    """The task is cancelled when nobody waits for it any more."""
+    flights = SingleFlight()
+    release = threading.Event()
+    scheduler = Scheduler(concurrency={"mkpdf": 1})
+    executor = ThreadPoolExecutor(max_workers=2)
+
+    async def scenario():
+        limiter = scheduler.limiter("mkpdf")
+        first = flights.join("a", lambda: limiter.run(executor, release.wait))
+        second = flights.join("a", lambda: limiter.run(executor, release.wait))
+        queued = flights.join("b", lambda: limiter.run(executor, release.wait))
+        await asyncio.sleep(0.1)
+        first.leave()
+        assert not first.future.done()
+        second.leave()
+        queued.leave()
+        await asyncio.sleep(0)
+        assert first.future.cancelled()
+        assert queued.future.cancelled()
+        # the slot is free right away
+        assert scheduler.status()["mkpdf"]["in_flight"] == 0
+        assert scheduler.status()["mkpdf"]["waiting"] == 0
+        assert await limiter.run(executor, sum, [1, 2]) == 3
+
+    asyncio.run(scenario())
+    release.set()
+    executor.shutdown()
@@ -0,0 +1,212 @@
+"""Test where the tasks work (see yakunin.scratch)."""
+
+import collections
+import logging
+import os
+import shutil
+import subprocess
+import tarfile
+import time
+
+import pytest
+
+from yakunin.archive import Archive
+from yakunin.batch import package_batch
+from yakunin.cache import ResultCache
+from yakunin.exceptions import ScratchSpaceExceeded
+from yakunin.jobs import Job
+from yakunin.lib import TASK_LOG, TASK_LOGGER
+from yakunin.packaging import package
+from yakunin.scratch import RAM_THRESHOLD, Scratch, usage
+from yakunin.service_handlers import copy_to_temp
+
+DiskUsage = collections.namedtuple("DiskUsage", "total used free")
+
+
+def small_tar_gz(path, size=100000) -> str:
+    """Write a tiny tar.gz that unpacks to `size` bytes."""
+    tex = path.parent / "main.tex"
+    tex.write_bytes(b"\\documentclass{article}\n" + b"%" * size)
+    with tarfile.open(path, "w:gz") as tar:
+        tar.add(tex, arcname="main.tex")
+    return str(path)
+
+
+def test_from_config(tmp_path):
+    """The scratch dirs are read from the config, with dashes or underscores."""
+    disks = [str(tmp_path / "a"), str(tmp_path / "b")]
+    scratch = Scratch.from_config(
+        {
+            "scratch-dirs": os.pathsep.join(disks),
+            "scratch_ram_dir": str(tmp_path / "ram"),
+            "scratch_ram_threshold": "1024",
+            "max-job-size": 2048,
+        }
+    )
+    assert scratch.base_dirs == disks
+    assert scratch.ram_dir == str(tmp_path / "ram")
+    assert (scratch.ram_threshold, scratch.max_job_size) == (1024, 2048)
+    assert all(os.path.isdir(path) for path in disks + [scratch.ram_dir])
+
+    scratch = Scratch.from_config({"scratch_dirs": disks})
+    assert scratch.base_dirs == disks
+    assert scratch.ram_dir is None
+    assert (scratch.ram_threshold, scratch.max_job_size) == (RAM_THRESHOLD, None)
+
+
+def test_base_dir(tmp_path, monkeypatch):
+    """Small jobs work in RAM, the others on the disk with the most free space."""
+    free = {"a": 10, "b": 30, "c": 20, "ram": 10000}
+    monkeypatch.setattr(
+        shutil,
+        "disk_usage",
+        lambda path: DiskUsage(0, 0, free[os.path.basename(path)]),
+    )
+    disks = [str(tmp_path / name) for name in "abc"]
+    scratch = Scratch(disks, ram_dir=str(tmp_path / "ram"), ram_threshold=1000)
+    assert scratch.base_dir(100) == scratch.ram_dir
+    assert scratch.base_dir(1000) == str(tmp_path / "b")
+    assert scratch.disk_dir() == str(tmp_path / "b")
+
+    # no room left in RAM
+    free["ram"] = 1000
+    assert scratch.base_dir(100) == str(tmp_path / "b")
+
+    path = scratch.mkdtemp(1000)
+    assert os.path.dirname(path) == str(tmp_path / "b")
+    assert not scratch.in_ram(path)
+    assert scratch.in_ram(os.path.join(scratch.ram_dir, "job"))
+
+
+def test_usage(tmp_path):
+    """The bytes of the files are counted, not those of the targets of links."""
+    (tmp_path / "sub").mkdir()
+    (tmp_path / "sub" / "a").write_bytes(b"x" * 100)
+    (tmp_path / "b").write_bytes(b"x" * 20)
+    (tmp_path / "outside").mkdir()
+    (tmp_path / "outside" / "big").write_bytes(b"x" * 10000)
+    (tmp_path / "sub" / "link").symlink_to(tmp_path / "outside")
+    assert usage(str(tmp_path / "sub")) == 100
+    assert usage(str(tmp_path / "missing")) == 0
+
+
+def test_spill(tmp_path, caplog):
+    """Archives that grow too large for RAM are moved to disk."""
+    caplog.set_level(logging.DEBUG, logger="yakunin.task")
+    # (temp dirs are kept when yakunin logs at DEBUG)
+    caplog.set_level(logging.INFO, logger="yakunin")
+    scratch = Scratch(
+        [str(tmp_path / "disk")], ram_dir=str(tmp_path / "ram"), ram_threshold=10000
+    )
+    archive = small_tar_gz(tmp_path / "paper.tar.gz")
+    with Archive(archive=archive, scratch=scratch) as arc:
+        ram_dir = arc.temp_dir
+        assert scratch.in_ram(ram_dir)
+        with arc.task_log.activate():
+            arc._unpack_archive()
+        assert os.path.dirname(arc.temp_dir) == str(tmp_path / "disk")
+        assert os.path.islink(ram_dir)
+        assert arc.work_dir == os.path.join(arc.temp_dir, "work")
+        assert os.path.isfile(os.path.join(arc.work_dir, "main.tex"))
+        assert arc.manifest.packed_size == os.path.getsize(archive)
+        with arc.task_log.activate():
+            TASK_LOGGER.info("Still here")
+        arc.task_log.close()
+        with open(os.path.join(ram_dir, TASK_LOG)) as log:
+            content = log.read()
+        assert "Moved from RAM" in content
+        assert content.index("Moved from RAM") < content.index("Still here")
+    assert not os.path.lexists(ram_dir)
+    assert os.listdir(tmp_path / "disk") == []
+
+
+def test_max_job_size(tmp_path):
+    """Archives that take more than max_job_size bytes are stopped."""
+    scratch = Scratch([str(tmp_path / "disk")], max_job_size=10000)
+    archive = small_tar_gz(tmp_path / "paper.tar.gz")
+    with Archive(archive=archive, scratch=scratch) as arc:
+        with pytest.raises(ScratchSpaceExceeded):
+            arc._unpack_archive()
+        arc.task_log.close()
+        with open(os.path.join(arc.temp_dir, TASK_LOG)) as log:
+            assert "bytes of scratch space (at most 10000)" in log.read()
+
+    with Archive(archive=archive, scratch=Scratch([str(tmp_path / "disk")])) as arc:
+        arc._unpack_archive()
+
+
+def test_max_job_size_while_compiling(tmp_path, caplog):
+    """The TeX compilation is stopped as soon as it takes too many bytes."""
+    caplog.set_level(logging.INFO, logger="yakunin")
+    # (a "TeX engine" that fills the scratch space, then takes its time)
+    engine = tmp_path / "engine.sh"
+    engine.write_text("head -c 1000000 /dev/zero > filler\nsleep 20\n")
+    scratch = Scratch([str(tmp_path / "disk")], max_job_size=500000)
+    archive = small_tar_gz(tmp_path / "paper.tar.gz")
+    with Archive(archive=archive, scratch=scratch) as arc:
+        start = time.monotonic()
+        with pytest.raises(ScratchSpaceExceeded):
+            arc.tex_compile(tex_engine=f"sh {engine}", timeout_compilation=30)
+        assert time.monotonic() - start < 10
+    assert os.listdir(tmp_path / "disk") == []
+
+
+def test_job_cleanup(tmp_path):
+    """The dirs of the tasks moved to disk are removed with their job."""
+    scratch = Scratch(
+        [str(tmp_path / "disk")], ram_dir=str(tmp_path / "ram"), ram_threshold=10000
+    )
+    upload_dir = scratch.mkdtemp()
+    archive = small_tar_gz(tmp_path / "paper.tar.gz")
+    arc = Archive(archive=archive, base_dir=upload_dir, scratch=scratch)
+    arc._unpack_archive()
+    arc.task_log.close()
+    assert os.listdir(tmp_path / "disk") != []
+
+    job = Job("mkpdf", upload_dir)
+    job.cleanup()
+    assert not os.path.exists(upload_dir)
+    assert os.listdir(tmp_path / "disk") == []
+
+
+def test_package_dest_dir(tmp_path):
+    """Packages (and copies of results) are created in the given dir."""
+    (tmp_path / "src").mkdir()
+    (tmp_path / "src" / "main.tex").write_bytes(b"x")
+    result = package(str(tmp_path / "src"), "gztar", dest_dir=str(tmp_path))
+    assert os.path.dirname(result) == str(tmp_path)
+
+    (tmp_path / "dest").mkdir()
+    dest_dir = str(tmp_path / "dest")
+    cache = ResultCache(str(tmp_path / "cache"))
+    cache.put("key", result)
+    copies = [
+        cache.get("key", dest_dir=dest_dir),
+        copy_to_temp(result, dest_dir),
+        package_batch("mkpdf", ["paper.tar.gz"], [result], dest_dir=dest_dir),
+    ]
+    assert [os.path.dirname(copy) for copy in copies] == [dest_dir] * 3
+
+
+def test_libreoffice_profile(tmp_path, monkeypatch):
+    """The profile of LibreOffice is created in the scratch space, and removed."""
+    profiles = []
+    run = subprocess.run
+
+    def fake_run(args, **kwargs):
+        if args[0] != "libreoffice":
+            return run(args, **kwargs)
+        profile = args[1].split("file://", 1)[1]
+        profiles.append(profile)
+        assert os.path.isdir(profile)
+        open(os.path.join(args[-2], "paper.pdf"), "wb").close()
+
+    monkeypatch.setattr(subprocess, "run", fake_run)
+    scratch = Scratch([str(tmp_path / "disk")])
+    with Archive(
+        archive=small_tar_gz(tmp_path / "paper.tar.gz"), scratch=scratch
+    ) as arc:
+        arc._convert_to_pdf_via_libreoffice("paper.odt")
+        assert arc.main_pdf == "paper.pdf"
+    assert os.path.dirname(profiles[0]) == str(tmp_path / "disk")
+    assert not os.path.exists(profiles[0])
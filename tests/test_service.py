@@ -1,17 +1,40 @@
 """Test the service."""
 
 
+import asyncio
 import datetime
+import http.client
+import io
+import json
+import logging
+import multiprocessing
+import os
+import re
+import shutil
+import socket
 import subprocess
+import tarfile
 import threading
+import time
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
 import pytest
 import requests
+import tornado.httpserver
 from conftest import ARCHIVES_DIR
+from tornado.ioloop import IOLoop
+from tornado.testing import bind_unused_port
 
 import yakunin
-from yakunin.service import PORT
+from yakunin.cache import ResultCache
+from yakunin.client import Client, Submission, report
+from yakunin.packaging import write_package
+from yakunin.scratch import Scratch
+from yakunin.service import PORT, make_app, shutdown_app, split_workers
+from yakunin.service_handlers import MAX_BODY_SIZE
+from yakunin.workers import run_task
 
 
 @pytest.fixture(scope="session")
@@ -20,6 +43,14 @@ def yakunin_service():
     thread = threading.Thread(target=yakunin.service.main)
     thread.daemon = True  # This thread dies when the main thread dies
     thread.start()
+    # wait for the service to be listening
+    for _ in range(50):
+        try:
+            requests.get(f"http://localhost:{PORT}/test")
+        except requests.exceptions.ConnectionError:
+            time.sleep(0.1)
+        else:
+            break
     yield
     yakunin.service.stop()
 
@@ -65,3 +96,768 @@ def suffix(day):
         return "rd"
     else:
         return "th"
+
+
+def test_mkpdf_from_pdf(yakunin_service, tmp_path):
+    """Send a pdf and get it back in the result archive."""
+    in_fname = Path(ARCHIVES_DIR) / "14-test.pdf"
+    with open(in_fname, "rb") as in_file:
+        response = requests.post(
+            f"http://localhost:{PORT}/mkpdf",
+            files={"file": in_file},
+        )
+    assert response.status_code == 200
+    out_fname = tmp_path / "x.tar.gz"
+    with open(out_fname, "wb") as fd:
+        fd.write(response.content)
+    with tarfile.open(out_fname) as tar:
+        names = tar.getnames()
+    assert "./14-test.pdf" in names
+    assert "./yakunin-task.log" in names
+
+
+def test_job(yakunin_service, tmp_path):
+    """Submit a job, wait for it and fetch the result."""
+    in_fname = Path(ARCHIVES_DIR) / "14-test.pdf"
+    with open(in_fname, "rb") as in_file:
+        response = requests.post(
+            f"http://localhost:{PORT}/jobs",
+            files={"file": in_file},
+            data={"command": "mkpdf"},
+        )
+    assert response.status_code == 202
+    job_id = response.json()["id"]
+
+    for _ in range(100):
+        status = requests.get(f"http://localhost:{PORT}/jobs/{job_id}").json()
+        if status["state"] in ("done", "failed"):
+            break
+        time.sleep(0.1)
+    assert status["state"] == "done"
+    assert status["stage"] == "submission_archive"
+
+    response = requests.get(f"http://localhost:{PORT}/jobs/{job_id}/result")
+    assert response.status_code == 200
+    out_fname = tmp_path / "x.tar.gz"
+    with open(out_fname, "wb") as fd:
+        fd.write(response.content)
+    with tarfile.open(out_fname) as tar:
+        assert "./14-test.pdf" in tar.getnames()
+
+
+def read_events(response) -> list:
+    """Parse the Server-Sent Events of the response into (id, event, data)."""
+    events = []
+    event = {}
+    for line in response.iter_lines(decode_unicode=True):
+        if not line:
+            events.append((event.get("id"), event.get("event"), event.get("data")))
+            event = {}
+            continue
+        field, _, value = line.partition(": ")
+        event[field] = value
+    return events
+
+
+def test_job_log(yakunin_service):
+    """The task log of a job is streamed until the job is finished."""
+    in_fname = Path(ARCHIVES_DIR) / "14-test.pdf"
+    with open(in_fname, "rb") as in_file:
+        response = requests.post(
+            f"http://localhost:{PORT}/jobs",
+            files={"file": in_file},
+            data={"command": "mkpdf"},
+        )
+    job_id = response.json()["id"]
+
+    url = f"http://localhost:{PORT}/jobs/{job_id}/log"
+    with requests.get(url, stream=True, timeout=60) as response:
+        assert response.status_code == 200
+        assert response.headers["Content-Type"] == "text/event-stream"
+        events = read_events(response)
+
+    kinds = [kind for _, kind, _ in events]
+    assert kinds[0] == "stage"
+    assert kinds[-1] == "end"
+    assert json.loads(events[-1][2])["state"] == "done"
+    lines = [(event_id, data) for event_id, kind, data in events if kind == "log"]
+    assert len(lines) > 1
+
+    # reconnecting clients get only the rest of the log
+    first_id = lines[0][0]
+    with requests.get(
+        url, headers={"Last-Event-ID": first_id}, stream=True, timeout=60
+    ) as response:
+        again = read_events(response)
+    assert [
+        (event_id, data) for event_id, kind, data in again if kind == "log"
+    ] == lines[1:]
+
+    response = requests.get(f"http://localhost:{PORT}/jobs/0123abc/log")
+    assert response.status_code == 404
+
+
+@pytest.fixture
+def stuck_server():
+    """A server that accepts connections but never answers (like a stuck medusa)."""
+    server = socket.create_server(("127.0.0.1", 0))
+    server.settimeout(30)
+    with server:
+        yield server
+
+
+def pitstop_ini(server: socket.socket) -> str:
+    """Ask to validate with the given server (which will keep us waiting)."""
+    host, port = server.getsockname()
+    return f"[wjs]\npitstop_url = http://{host}:{port}/\ntimeout_pitstop = 50\n"
+
+
+def test_cancel_job(yakunin_service, stuck_server):
+    """Cancelled jobs stop their task, even while it waits for medusa."""
+    in_fname = Path(ARCHIVES_DIR) / "14-test.pdf"
+    with open(in_fname, "rb") as in_file:
+        response = requests.post(
+            f"http://localhost:{PORT}/jobs",
+            files={"file": in_file, "ini": ("wjs.ini", pitstop_ini(stuck_server))},
+            data={"command": "pitstop_validate"},
+        )
+    job_id = response.json()["id"]
+    # the worker is waiting for pitstop's answer
+    connection, _ = stuck_server.accept()
+
+    response = requests.delete(f"http://localhost:{PORT}/jobs/{job_id}")
+    assert response.status_code == 200
+    assert response.json()["state"] == "cancelled"
+    # the HTTP call is aborted
+    with connection:
+        connection.settimeout(10)
+        while connection.recv(65536):
+            pass
+
+    status = requests.get(f"http://localhost:{PORT}/jobs/{job_id}").json()
+    assert status["state"] == "cancelled"
+    # finished jobs are forgotten
+    response = requests.delete(f"http://localhost:{PORT}/jobs/{job_id}")
+    assert response.status_code == 204
+    response = requests.get(f"http://localhost:{PORT}/jobs/{job_id}")
+    assert response.status_code == 404
+
+
+def test_cancel_on_disconnect(yakunin_service, stuck_server):
+    """The task of a client that goes away is stopped."""
+    in_fname = Path(ARCHIVES_DIR) / "14-test.pdf"
+    with open(in_fname, "rb") as in_file:
+        request = requests.Request(
+            "POST",
+            f"http://localhost:{PORT}/task/pitstop_validate",
+            files={"file": in_file, "ini": ("wjs.ini", pitstop_ini(stuck_server))},
+        ).prepare()
+    client = http.client.HTTPConnection("localhost", PORT)
+    client.request("POST", request.path_url, body=request.body, headers=request.headers)
+    connection, _ = stuck_server.accept()
+    client.close()
+
+    with connection:
+        connection.settimeout(10)
+        while connection.recv(65536):
+            pass
+
+
+def test_unknown_job(yakunin_service):
+    """Unknown jobs are not found."""
+    response = requests.get(f"http://localhost:{PORT}/jobs/0123abcd")
+    assert response.status_code == 404
+
+
+def test_too_large_upload(yakunin_service):
+    """Uploads larger than the limit are refused before receiving them."""
+    connection = http.client.HTTPConnection("localhost", PORT)
+    connection.putrequest("POST", "/mkpdf")
+    connection.putheader("Content-Type", "multipart/form-data; boundary=xxx")
+    connection.putheader("Content-Length", str(MAX_BODY_SIZE + 1))
+    connection.endheaders()
+    response = connection.getresponse()
+    assert response.status == 413
+    connection.close()
+
+
+def test_write_package(tmp_path):
+    """The tar.gz written on the fly is like the one of shutil.make_archive."""
+    directory = tmp_path / "dir"
+    (directory / "work" / "sub").mkdir(parents=True)
+    (directory / "work" / "sub" / "a.tex").write_text("ciao")
+    (directory / "yakunin-task.log").write_text("INFO ok\n")
+
+    expected = shutil.make_archive(str(tmp_path / "expected"), "gztar", directory)
+    with tarfile.open(expected) as tar:
+        expected_names = sorted(tar.getnames())
+
+    with open(tmp_path / "x.tar.gz", "wb") as out:
+        write_package(directory, out)
+    with tarfile.open(tmp_path / "x.tar.gz") as tar:
+        assert sorted(tar.getnames()) == expected_names
+        assert tar.extractfile("./work/sub/a.tex").read() == b"ciao"
+
+
+def test_generic_task(yakunin_service, tmp_path):
+    """Any task can be requested via /task/NAME."""
+    in_fname = Path(ARCHIVES_DIR) / "30437-Generative_adversarial_networks.zip"
+    with open(in_fname, "rb") as in_file:
+        response = requests.post(
+            f"http://localhost:{PORT}/task/find_master",
+            files={"file": in_file},
+        )
+    assert response.status_code == 200
+    out_fname = tmp_path / "x.tar.gz"
+    with open(out_fname, "wb") as fd:
+        fd.write(response.content)
+    with tarfile.open(out_fname) as tar:
+        log = tar.extractfile("./yakunin-task.log").read().decode()
+    assert "with \\documentclass): main.tex" in log
+
+
+@pytest.mark.parametrize(
+    "url,ini",
+    [
+        ("task/not_a_task", ""),
+        ("task/mkpdf", "[wjs]\ntimeout_compilation = soon\n"),
+    ],
+)
+def test_generic_task_bad_request(yakunin_service, url, ini):
+    """Unknown tasks and invalid options are refused."""
+    in_fname = Path(ARCHIVES_DIR) / "04-test.tar.gz"
+    with open(in_fname, "rb") as in_file:
+        response = requests.post(
+            f"http://localhost:{PORT}/{url}",
+            files={"file": in_file, "ini": ("wjs.ini", ini)},
+        )
+    assert response.status_code == 400
+
+
+def test_bad_multipart_headers(yakunin_service):
+    """Part headers that cannot be decoded are a bad request."""
+    body = (
+        b"--xxx\r\n"
+        b'Content-Disposition: form-data; name="file"; filename="\xe0.tex"\r\n\r\n'
+        b"x\r\n--xxx--\r\n"
+    )
+    response = requests.post(
+        f"http://localhost:{PORT}/task/find_master",
+        data=body,
+        headers={"Content-Type": "multipart/form-data; boundary=xxx"},
+    )
+    assert response.status_code == 400
+
+
+def test_load_report(yakunin_service):
+    """The test page reports the load of the tasks seen so far."""
+    in_fname = Path(ARCHIVES_DIR) / "14-test.pdf"
+    with open(in_fname, "rb") as in_file:
+        requests.post(f"http://localhost:{PORT}/mkpdf", files={"file": in_file})
+    response = requests.get(f"http://localhost:{PORT}/test")
+    # (other tests might be running concurrently)
+    assert re.search(r"^fast: [0-9]+ running", response.text, re.MULTILINE)
+
+
+def test_metrics(yakunin_service):
+    """Requests, tasks and their stages are measured."""
+    in_fname = Path(ARCHIVES_DIR) / "04-test.tar.gz"
+    with open(in_fname, "rb") as in_file:
+        response = requests.post(
+            f"http://localhost:{PORT}/task/find_master",
+            files={"file": in_file},
+        )
+    assert response.status_code == 200
+
+    response = requests.get(f"http://localhost:{PORT}/metrics")
+    assert response.status_code == 200
+    assert response.headers["Content-Type"].startswith("text/plain; version=0.0.4")
+    text = response.text
+    assert re.search(
+        r'^yakunin_http_requests_total{handler="ArchiveTask",method="POST",code="200"} [1-9]',
+        text,
+        re.MULTILINE,
+    )
+    assert re.search(
+        r'^yakunin_tasks_total{task="find_master",outcome="success"} [1-9]',
+        text,
+        re.MULTILINE,
+    )
+    for stage in ("unpack", "find_master", "submission_archive"):
+        assert (
+            f'yakunin_stage_duration_seconds_count{{task="find_master",stage="{stage}"}}'
+            in text
+        )
+
+
+def start_service(**kwargs):
+    """Start an http service (on a random port), with the given options of make_app.
+
+    Yield the base URL of the service.
+    """
+    sock, port = bind_unused_port()
+    started = threading.Event()
+    loops = []
+
+    def run():
+        asyncio.set_event_loop(asyncio.new_event_loop())
+        app = make_app(max_workers=2, **kwargs)
+        server = tornado.httpserver.HTTPServer(app)
+        server.add_sockets([sock])
+        loops.append(IOLoop.current())
+        started.set()
+        try:
+            IOLoop.current().start()
+        finally:
+            shutdown_app(app)
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    started.wait()
+    yield f"http://localhost:{port}"
+    loops[0].add_callback(loops[0].stop)
+    thread.join()
+
+
+@pytest.fixture
+def cached_service(tmp_path):
+    """Start an http service with a result cache (see start_service)."""
+    yield from start_service(cache_dir=str(tmp_path / "cache"))
+
+
+@pytest.fixture
+def unpacking_service():
+    """Start an http service that unpacks the uploads (see start_service)."""
+    yield from start_service(unpack_uploads=True)
+
+
+@pytest.fixture
+def streaming_service():
+    """Start an http service that streams the results (see start_service)."""
+    yield from start_service(stream_results=True)
+
+
+@pytest.fixture
+def local_service():
+    """Start an http service with the default options (see start_service)."""
+    yield from start_service()
+
+
+def test_lane_outside_task_log(local_service, tmp_path, monkeypatch, caplog):
+    """Choosing the lane of a task writes nothing to the configured task log handlers."""
+    caplog.set_level(logging.DEBUG, logger="yakunin")
+    monkeypatch.chdir(tmp_path)
+    # (like the "report" handler of yakunin.json, but only for this process)
+    handler = logging.FileHandler("report.log", delay=True)
+    handler.addFilter(lambda record: record.process == os.getpid())
+    task_logger = logging.getLogger("yakunin.task")
+    task_logger.addHandler(handler)
+    try:
+        with open(Path(ARCHIVES_DIR) / "14-test.pdf", "rb") as in_file:
+            response = requests.post(f"{local_service}/mkpdf", files={"file": in_file})
+    finally:
+        task_logger.removeHandler(handler)
+        handler.close()
+    assert response.status_code == 200
+    assert os.listdir(tmp_path) == []
+
+
+@pytest.mark.parametrize("package_format", ["gztar", "zip"])
+def test_stream_results(streaming_service, tmp_path, package_format):
+    """Streamed results are sent in the requested format, and saved as such."""
+    ini = tmp_path / "wjs.ini"
+    ini.write_text(f"[wjs]\npackage_format = {package_format}\n")
+    submission = Submission(
+        str(Path(ARCHIVES_DIR) / "04-test.tar.gz"), "find_master", str(ini)
+    )
+    with Client(streaming_service, output_dir=str(tmp_path)) as client:
+        client.run([submission])
+    assert submission.status == 200
+    if package_format == "zip":
+        assert submission.result.endswith(".find_master.zip")
+        with zipfile.ZipFile(submission.result) as zip_file:
+            assert "yakunin-task.log" in zip_file.namelist()
+    else:
+        assert submission.result.endswith(".find_master.tar.gz")
+        with tarfile.open(submission.result) as tar:
+            assert "./yakunin-task.log" in tar.getnames()
+
+
+@pytest.mark.parametrize(
+    "name,unpacked",
+    [
+        ("04-test.tar.gz", True),
+        ("05-test.tar.bz2", True),
+        ("30437-Generative_adversarial_networks.zip", False),
+    ],
+)
+def test_unpack_uploads(unpacking_service, setup_config, name, unpacked):
+    """Tar files are unpacked while they are received."""
+    with open(Path(ARCHIVES_DIR) / name, "rb") as in_file:
+        response = requests.post(
+            f"{unpacking_service}/task/find_master", files={"file": in_file}
+        )
+    assert response.status_code == 200
+    with tarfile.open(fileobj=io.BytesIO(response.content)) as tar:
+        log = tar.extractfile("./yakunin-task.log").read().decode()
+        names = tar.getnames()
+    assert ("Archive unpacked while it was received" in log) == unpacked
+    assert any(name.startswith("./work/") for name in names)
+    assert not any(".unpacked-" in name for name in names)
+
+
+def test_split_workers():
+    """The pools of the lanes share the worker processes."""
+    concurrency = {"fast": 8, "compile": 8, "remote": 16}
+    assert split_workers(concurrency, 32) == concurrency
+    assert split_workers(concurrency, 8) == {"fast": 2, "compile": 2, "remote": 4}
+    assert split_workers(concurrency, 2) == {"fast": 1, "compile": 1, "remote": 1}
+
+
+def test_lane_concurrency():
+    """Each lane runs at most as many tasks as the processes of its pool."""
+    app = make_app(max_workers=8, concurrency={"fast": 8, "compile": 8, "remote": 16})
+    try:
+        scheduler = app.settings["scheduler"]
+        for lane, executor in app.settings["executors"].items():
+            assert scheduler.limiter(lane).concurrency == executor._max_workers
+        assert scheduler.limiter("remote").concurrency == 4
+    finally:
+        shutdown_app(app)
+
+
+def test_shutdown_app():
+    """The processes started by an application are stopped with it."""
+    before = set(multiprocessing.active_children())
+    app = make_app(max_workers=2)
+    started = set(multiprocessing.active_children()) - before
+    assert started
+    shutdown_app(app)
+    assert not any(process.is_alive() for process in started)
+
+
+def test_cached_result(cached_service, setup_config):
+    """The same task on the same file is computed once."""
+    in_fname = Path(ARCHIVES_DIR) / "14-test.pdf"
+    contents = []
+    for _ in range(2):
+        with open(in_fname, "rb") as in_file:
+            response = requests.post(
+                f"{cached_service}/task/mkpdf", files={"file": in_file}
+            )
+        assert response.status_code == 200
+        with tarfile.open(fileobj=io.BytesIO(response.content)) as tar:
+            contents.append(tar.extractfile("./14-test.pdf").read())
+    assert contents[0] == contents[1]
+
+    text = requests.get(f"{cached_service}/metrics").text
+    assert 'yakunin_cache_requests_total{task="mkpdf",outcome="hit"} 1\n' in text
+    assert 'yakunin_cache_requests_total{task="mkpdf",outcome="miss"} 1\n' in text
+
+
+@pytest.fixture
+def streaming_cached_service(tmp_path):
+    """Start an http service that streams the results and caches them (see start_service)."""
+    yield from start_service(stream_results=True, cache_dir=str(tmp_path / "cache"))
+
+
+def test_cached_streamed_result(streaming_cached_service, setup_config, tmp_path):
+    """Streamed results are cached while they are sent."""
+    in_fname = Path(ARCHIVES_DIR) / "14-test.pdf"
+    contents = []
+    for _ in range(2):
+        with open(in_fname, "rb") as in_file:
+            response = requests.post(
+                f"{streaming_cached_service}/task/mkpdf", files={"file": in_file}
+            )
+        assert response.status_code == 200
+        with tarfile.open(fileobj=io.BytesIO(response.content)) as tar:
+            contents.append(tar.extractfile("./14-test.pdf").read())
+    assert contents[0] == contents[1]
+    assert len(os.listdir(tmp_path / "cache")) == 1
+
+    text = requests.get(f"{streaming_cached_service}/metrics").text
+    assert 'yakunin_cache_requests_total{task="mkpdf",outcome="hit"} 1\n' in text
+    assert 'yakunin_cache_requests_total{task="mkpdf",outcome="miss"} 1\n' in text
+
+
+@pytest.fixture
+def coalescing_service(tmp_path, caplog):
+    """Start an http service that runs one remote task at a time (see start_service)."""
+    # (temp dirs are kept when yakunin logs at DEBUG)
+    caplog.set_level(logging.INFO, logger="yakunin")
+    yield from start_service(
+        concurrency={"remote": 1},
+        config={"scratch_dirs": str(tmp_path / "scratch")},
+    )
+
+
+def answer_pitstop(server: socket.socket):
+    """Let the (stuck) server answer the next request, with an error."""
+    connection, _ = server.accept()
+    answer_with_error(connection)
+
+
+def answer_with_error(connection: socket.socket):
+    """Answer the request received on the given connection with an error."""
+    with connection:
+        connection.settimeout(10)
+        request = b""
+        while b"\r\n\r\n" not in request:
+            request += connection.recv(65536)
+        head, body = request.split(b"\r\n\r\n", 1)
+        length = int(re.search(rb"Content-Length: (\d+)", head, re.IGNORECASE)[1])
+        while len(body) < length:
+            body += connection.recv(65536)
+        connection.sendall(
+            b"HTTP/1.1 500 Error\r\nContent-Length: 0\r\nConnection: close\r\n\r\n"
+        )
+
+
+def metric(url: str, name: str) -> float:
+    """Return the total of the samples of the given metric of the service."""
+    text = requests.get(f"{url}/metrics").text
+    return sum(
+        float(value) for value in re.findall(rf"^{name}{{.*}} (\S+)$", text, re.M)
+    )
+
+
+def post_pitstop(url: str, server: socket.socket) -> requests.Response:
+    """Ask to validate a PDF with the given server."""
+    with open(Path(ARCHIVES_DIR) / "14-test.pdf", "rb") as in_file:
+        return requests.post(
+            f"{url}/task/pitstop_validate",
+            files={"file": in_file, "ini": ("wjs.ini", pitstop_ini(server))},
+        )
+
+
+def wait_for(condition, timeout=30):
+    """Wait until the condition is true."""
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "Timed out"
+        time.sleep(0.05)
+
+
+def test_identical_requests(coalescing_service, stuck_server):
+    """Identical requests sent together share one task, and its result."""
+    with ThreadPoolExecutor(max_workers=3) as executor:
+        responses = [
+            executor.submit(post_pitstop, coalescing_service, stuck_server)
+            for _ in range(3)
+        ]
+        wait_for(
+            lambda: metric(coalescing_service, "yakunin_coalesced_requests_total") == 2
+        )
+        answer_pitstop(stuck_server)
+        responses = [response.result() for response in responses]
+    assert [response.status_code for response in responses] == [200] * 3
+    assert all(response.content == responses[0].content for response in responses)
+    assert metric(coalescing_service, "yakunin_tasks_total") == 1
+
+
+def test_identical_requests_leader_leaves(coalescing_service, stuck_server, tmp_path):
+    """The requests that share a task get its result, even if the first one goes away."""
+    in_fname = Path(ARCHIVES_DIR) / "14-test.pdf"
+    with socket.create_server(("127.0.0.1", 0)) as busy_server, ThreadPoolExecutor(
+        max_workers=2
+    ) as executor:
+        busy_server.settimeout(30)
+        # keep the remote lane busy, so that the shared task waits its turn
+        busy = executor.submit(post_pitstop, coalescing_service, busy_server)
+        wait_for(lambda: metric(coalescing_service, "yakunin_tasks_in_flight") == 1)
+
+        with open(in_fname, "rb") as in_file:
+            request = requests.Request(
+                "POST",
+                f"{coalescing_service}/task/pitstop_validate",
+                files={"file": in_file, "ini": ("wjs.ini", pitstop_ini(stuck_server))},
+            ).prepare()
+        leader = http.client.HTTPConnection(*request.url.split("/")[2].split(":"))
+        leader.request(
+            "POST", request.path_url, body=request.body, headers=request.headers
+        )
+        follower = executor.submit(post_pitstop, coalescing_service, stuck_server)
+        wait_for(
+            lambda: metric(coalescing_service, "yakunin_coalesced_requests_total") == 1
+        )
+        leader.close()
+        wait_for(
+            lambda: re.search(
+                r'^yakunin_http_requests_total{handler="ArchiveTask".*} 1',
+                requests.get(f"{coalescing_service}/metrics").text,
+                re.M,
+            )
+        )
+
+        answer_pitstop(busy_server)
+        answer_pitstop(stuck_server)
+        assert busy.result().status_code == 200
+        assert follower.result().status_code == 200
+    with tarfile.open(fileobj=io.BytesIO(follower.result().content)) as tar:
+        assert "./work/14-test.pdf" in tar.getnames()
+    # the files of the shared task are removed at last
+    wait_for(lambda: not os.listdir(tmp_path / "scratch"))
+
+
+def submit_pitstop_job(url: str, server: socket.socket) -> str:
+    """Submit a job that validates a PDF with the given server; return its id."""
+    with open(Path(ARCHIVES_DIR) / "14-test.pdf", "rb") as in_file:
+        response = requests.post(
+            f"{url}/jobs",
+            files={"file": in_file, "ini": ("wjs.ini", pitstop_ini(server))},
+            data={"command": "pitstop_validate"},
+        )
+    assert response.status_code == 202
+    return response.json()["id"]
+
+
+def test_shared_job_leader_removed(coalescing_service, stuck_server, tmp_path):
+    """The job that started a shared task can go away while the others still need it."""
+    leader = submit_pitstop_job(coalescing_service, stuck_server)
+    follower = submit_pitstop_job(coalescing_service, stuck_server)
+    assert metric(coalescing_service, "yakunin_coalesced_requests_total") == 1
+    connection, _ = stuck_server.accept()
+
+    response = requests.delete(f"{coalescing_service}/jobs/{leader}")
+    assert response.json()["state"] == "cancelled"
+    response = requests.delete(f"{coalescing_service}/jobs/{leader}")
+    assert response.status_code == 204
+
+    # the shared task goes on in the dir of the removed job, with its stage
+    url = f"{coalescing_service}/jobs/{follower}"
+    assert requests.get(url).json()["stage"] is not None
+    answer_with_error(connection)
+    wait_for(lambda: requests.get(url).json()["state"] in ("done", "failed"))
+    status = requests.get(url).json()
+    assert status["state"] == "done", status["error"]
+    assert requests.get(f"{url}/result").status_code == 200
+
+    assert requests.delete(url).status_code == 204
+    wait_for(lambda: not os.listdir(tmp_path / "scratch"))
+
+
+@pytest.fixture
+def two_jobs_service(tmp_path, caplog):
+    """Start an http service like coalescing_service, that keeps two jobs at most."""
+    # (temp dirs are kept when yakunin logs at DEBUG)
+    caplog.set_level(logging.INFO, logger="yakunin")
+    yield from start_service(
+        concurrency={"remote": 1},
+        config={"scratch_dirs": str(tmp_path / "scratch")},
+        max_jobs=2,
+    )
+
+
+def test_shared_job_leader_evicted(two_jobs_service, stuck_server, tmp_path):
+    """A cancelled job evicted to make room keeps the files of the task it shared."""
+    url = two_jobs_service
+    leader = submit_pitstop_job(url, stuck_server)
+    follower = submit_pitstop_job(url, stuck_server)
+    connection, _ = stuck_server.accept()
+    requests.delete(f"{url}/jobs/{leader}")
+    # no room: the cancelled job is forgotten
+    third = submit_pitstop_job(url, stuck_server)
+    assert requests.get(f"{url}/jobs/{leader}").status_code == 404
+
+    answer_with_error(connection)
+    for job_id in (follower, third):
+        job_url = f"{url}/jobs/{job_id}"
+        wait_for(lambda: requests.get(job_url).json()["state"] in ("done", "failed"))
+        status = requests.get(job_url).json()
+        assert status["state"] == "done", status["error"]
+        requests.delete(job_url)
+    wait_for(lambda: not os.listdir(tmp_path / "scratch"))
+
+
+def test_run_task_packages_once(tmp_path, caplog):
+    """The result of a task is packaged once, and nothing else is left behind."""
+    # (temp dirs are kept when yakunin logs at DEBUG)
+    caplog.set_level(logging.INFO, logger="yakunin")
+    result, timings = run_task(
+        "mkpdf",
+        str(Path(ARCHIVES_DIR) / "14-test.pdf"),
+        {},
+        scratch=Scratch([str(tmp_path)]),
+    )
+    assert [stage for stage, _ in timings].count("submission_archive") == 1
+    assert os.listdir(tmp_path) == [os.path.basename(result)]
+
+
+def test_run_task_cache_key(tmp_path, setup_config, monkeypatch, caplog):
+    """The upload is not hashed again when the key of the result is known."""
+    caplog.set_level(logging.INFO, logger="yakunin")
+
+    def file_digest(path):
+        raise AssertionError(f"{path} hashed again")
+
+    monkeypatch.setattr(yakunin.archive, "file_digest", file_digest)
+    cache = ResultCache(str(tmp_path / "cache"))
+    result, _ = run_task(
+        "mkpdf",
+        str(Path(ARCHIVES_DIR) / "14-test.pdf"),
+        {},
+        cache=cache,
+        cache_key="known",
+        scratch=Scratch([str(tmp_path / "scratch")]),
+    )
+    os.unlink(result)
+    assert os.listdir(cache.directory) == ["known.tar.gz"]
+
+
+def test_batch(yakunin_service, tmp_path):
+    """Many files are processed by one request and their results packaged together."""
+    names = ["04-test.tar.gz", "30437-Generative_adversarial_networks.zip"]
+    files = [("file", (name, open(Path(ARCHIVES_DIR) / name, "rb"))) for name in names]
+    try:
+        response = requests.post(
+            f"http://localhost:{PORT}/batch/find_master", files=files
+        )
+    finally:
+        for _, (_, in_file) in files:
+            in_file.close()
+    assert response.status_code == 200
+    with tarfile.open(fileobj=io.BytesIO(response.content)) as tar:
+        manifest = json.load(tar.extractfile("./manifest.json"))
+        log = tar.extractfile(f"./{names[1]}/yakunin-task.log").read().decode()
+    assert manifest["succeeded"] == 2
+    assert [entry["file"] for entry in manifest["files"]] == names
+    assert "with \\documentclass): main.tex" in log
+
+
+def test_batch_same_names(yakunin_service):
+    """Files with the same name get a result each."""
+    with open(Path(ARCHIVES_DIR) / "04-test.tar.gz", "rb") as in_file:
+        content = in_file.read()
+    files = [("file", ("04-test.tar.gz", content)) for _ in range(2)]
+    response = requests.post(f"http://localhost:{PORT}/batch/find_master", files=files)
+    assert response.status_code == 200
+    with tarfile.open(fileobj=io.BytesIO(response.content)) as tar:
+        manifest = json.load(tar.extractfile("./manifest.json"))
+        names = tar.getnames()
+    assert manifest["succeeded"] == 2
+    assert [entry["result"] for entry in manifest["files"]] == [
+        "./0-04-test.tar.gz",
+        "./1-04-test.tar.gz",
+    ]
+    assert "./1-04-test.tar.gz/yakunin-task.log" in names
+
+
+def test_client(yakunin_service, tmp_path):
+    """The client sends many files at once and saves the results."""
+    submissions = [
+        Submission(str(Path(ARCHIVES_DIR) / "14-test.pdf"), "mkpdf"),
+        Submission(str(Path(ARCHIVES_DIR) / "04-test.tar.gz"), "find_master"),
+        Submission(str(Path(ARCHIVES_DIR) / "04-test.tar.gz"), "not_a_task"),
+    ]
+    with Client(
+        f"http://localhost:{PORT}", concurrency=2, output_dir=str(tmp_path), retries=3
+    ) as client:
+        client.run(submissions)
+    assert [s.status for s in submissions] == [200, 200, 400]
+    with tarfile.open(submissions[0].result) as tar:
+        assert "./14-test.pdf" in tar.getnames()
+    assert submissions[1].result == str(tmp_path / "04-test.tar.gz.find_master.tar.gz")
+    assert submissions[2].result is None
+    assert all(s.latency > 0 for s in submissions)
+    assert "failed: 1" in report(submissions, client.elapsed, 2)
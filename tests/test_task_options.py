@@ -0,0 +1,46 @@
+"Test the validation of the options of the tasks (e.g. received by the service)"
+
+import pytest
+
+from yakunin import TEX_ENGINE_CHOICES, task_options
+from yakunin.exceptions import InvalidTaskOptions
+
+
+def test_conversion_and_defaults():
+    "Options are converted as the command line would do"
+    options = task_options(
+        "topdfa",
+        {
+            "text": "Ciao",
+            "timeout-compilation": "30",
+            "do_pitstop_validation": "yes",
+            "tex_engine": "xelatex",
+            "not-an-option": "whatever",
+        },
+        config={"pitstop_url": "https://example.org/pitstop", "log": "DEBUG"},
+    )
+    assert options["text"] == "Ciao"
+    assert options["timeout_compilation"] == 30.0
+    assert options["do_pitstop_validation"] is True
+    assert options["tex_engine"] == TEX_ENGINE_CHOICES["xelatex"]
+    assert options["pitstop_url"] == "https://example.org/pitstop"
+    # defaults from the parser
+    assert options["x"] == "550"
+    # unknown options are ignored
+    assert "not-an-option" not in options
+    assert "log" not in options
+
+
+@pytest.mark.parametrize(
+    "command,options",
+    [
+        ("not_a_command", {}),
+        ("mkpdf", {"timeout_compilation": "soon"}),
+        ("mkpdf", {"tex_engine": "word"}),
+        ("topdfa", {"do_pitstop_validation": "maybe"}),
+    ],
+)
+def test_invalid_options(command, options):
+    "Unknown commands and invalid values are refused"
+    with pytest.raises(InvalidTaskOptions):
+        task_options(command, options)
@@ -0,0 +1,99 @@
+"""Test the cancellation of the tasks run by the workers."""
+
+import asyncio
+import multiprocessing
+import os
+import subprocess
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import pytest
+
+from yakunin.exceptions import TaskCancelled
+from yakunin.workers import CANCEL_SIGNAL, WorkerTasks
+
+
+def run_commands(pid_file: str) -> str:
+    """Start a command that starts another command, both waiting forever."""
+    subprocess.run(["sh", "-c", f"sleep 60 & echo $! > {pid_file}; wait"])
+    return "finished"
+
+
+def echo(value):
+    """Return the value."""
+    return value
+
+
+def is_running(pid: int) -> bool:
+    """Tell if the process exists (and is not a zombie)."""
+    try:
+        with open(f"/proc/{pid}/stat") as stat:
+            return stat.read().rsplit(")", 1)[1].split()[0] != "Z"
+    except FileNotFoundError:
+        return False
+
+
+@pytest.fixture
+def workers():
+    """Keep track of the tasks in a shared dict."""
+    with multiprocessing.Manager() as manager:
+        yield WorkerTasks(manager.dict())
+
+
+def test_cancel_running_task(workers, tmp_path):
+    """The commands started by a cancelled task are killed and the worker is free."""
+    pid_file = tmp_path / "pid"
+    with ProcessPoolExecutor(max_workers=1, **workers.pool_options()) as pool:
+        task_id, fn = workers.new_task(run_commands)
+        future = pool.submit(fn, str(pid_file))
+        while not pid_file.exists() or not pid_file.read_text().strip():
+            time.sleep(0.05)
+        grandchild = int(pid_file.read_text())
+
+        workers.cancel(task_id)
+        with pytest.raises(TaskCancelled):
+            future.result(timeout=10)
+        for _ in range(100):
+            if not is_running(grandchild):
+                break
+            time.sleep(0.05)
+        assert not is_running(grandchild)
+
+        # the worker runs the next task
+        task_id, fn = workers.new_task(echo)
+        assert pool.submit(fn, "next").result(timeout=10) == "next"
+        assert task_id not in workers.tasks
+
+
+def test_stale_cancellation(workers, tmp_path):
+    """A signal meant for a previous task of the worker does not stop the current one."""
+    pid_file = tmp_path / "pid"
+    with ProcessPoolExecutor(max_workers=1, **workers.pool_options()) as pool:
+        task_id, fn = workers.new_task(run_commands)
+        future = pool.submit(fn, str(pid_file))
+        while not pid_file.exists() or not pid_file.read_text().strip():
+            time.sleep(0.05)
+        grandchild = int(pid_file.read_text())
+
+        # as if the worker moved on just before the signal of an old task
+        os.kill(workers.tasks[task_id], CANCEL_SIGNAL)
+        time.sleep(0.5)
+        assert not future.done()
+        assert is_running(grandchild)
+
+        workers.cancel(task_id)
+        with pytest.raises(TaskCancelled):
+            future.result(timeout=10)
+
+
+def test_cancel_before_start(workers):
+    """Tasks cancelled before they start do not run."""
+
+    async def cancel_and_run():
+        with ProcessPoolExecutor(max_workers=1, **workers.pool_options()) as pool:
+            task_id, fn = workers.new_task(echo)
+            workers.cancel(task_id)
+            with pytest.raises(TaskCancelled):
+                pool.submit(fn, "never").result(timeout=10)
+
+    asyncio.run(cancel_and_run())
@@ -6,10 +6,15 @@ import logging
 import logging.config
 import os
 import sys
+from typing import Any, Dict
 
 from yakunin.archive import Archive
-from yakunin.exceptions import NoTeXMaster, UnknownArchiveFormat
+from yakunin.cache import MAX_CACHE_SIZE, ResultCache
+from yakunin.exceptions import InvalidTaskOptions, NoTeXMaster, UnknownArchiveFormat
+from yakunin.extraction import Limits
 from yakunin.lib import TASK_LOGGER, YAKUNIN_LOGGER, verify_environment
+from yakunin.packaging import DEFAULT_FORMAT, FORMATS
+from yakunin.scratch import Scratch
 
 
 def merge_with_config_file(args):
@@ -67,8 +72,33 @@ def merge_with_config_file(args):
             setattr(args, key, value)
 
 
-def main():
-    """Read config, command line and run requested command."""
+# how boolean options can be given (see also configparser)
+BOOLEAN_STATES = {
+    "1": True,
+    "yes": True,
+    "true": True,
+    "on": True,
+    "0": False,
+    "no": False,
+    "false": False,
+    "off": False,
+}
+
+TEX_ENGINE_CHOICES = {
+    "pdflatex": "latexmk -pv- -pdf",
+    "latex": "latexmk -pv- -dvi -pdfps",  # tex → dvi → pdf
+    "pdftex": "latexmk -pv- -pdf -pdflatex=pdftex",  # TeX, not LaTeX
+    "tex": "latexmk -pv- -dvi -latex=tex",
+    "xelatex": "latexmk -pv- -pdfxe",
+}
+
+
+def make_parser() -> argparse.ArgumentParser:
+    """Build the command-line parser.
+
+    The same parser describes the options accepted by the service (see
+    task_options).
+    """
     # The command-line parser is a bit compicated.
     # compile this tikz code to get a representation:
 
@@ -198,16 +228,9 @@ def main():
         "--tex-master", help="a file with path relative to the extracted archive"
     )
 
-    tex_engine_choices = {
-        "pdflatex": "latexmk -pv- -pdf",
-        "latex": "latexmk -pv- -dvi -pdfps",  # tex → dvi → pdf
-        "pdftex": "latexmk -pv- -pdf -pdflatex=pdftex",  # TeX, not LaTeX
-        "tex": "latexmk -pv- -dvi -latex=tex",
-        "xelatex": "latexmk -pv- -pdfxe",
-    }
     compile_parser_generic.add_argument(
         "--tex_engine",
-        choices=tex_engine_choices.keys(),
+        choices=TEX_ENGINE_CHOICES.keys(),
         default="pdflatex",
         help="tex engine to use (will be made into an option for latexmk)",
     )
@@ -219,12 +242,33 @@ def main():
     )
     compile_parser_generic.add_argument("archive", help="Archive to process.")
 
+    package_parser_generic = argparse.ArgumentParser(add_help=False)
+    package_parser_generic.add_argument(
+        "--package-format",
+        choices=FORMATS,
+        default=DEFAULT_FORMAT,
+        help="how to package the result (defaults to %(default)s)",
+    )
+    package_parser_generic.add_argument(
+        "--package-level",
+        type=int,
+        help="compression level of the result (e.g. 1-9 for gzip)",
+    )
+    package_parser_generic.add_argument(
+        "--package-threads",
+        type=int,
+        default=1,
+        help="how many threads compress the result; 0 means one per core"
+        " (defaults to %(default)s)",
+    )
+
     # TODO: add generic compilation arguments and/or commandline
     commands.add_parser(
         "tex_compile",
         help="Compile a tex source/archive",
         parents=[
             compile_parser_generic,
+            package_parser_generic,
         ],
     )
 
@@ -244,6 +288,7 @@ def main():
         parents=[
             mkpdf_parser_generic,
             compile_parser_generic,
+            package_parser_generic,
         ],
     )
 
@@ -270,6 +315,7 @@ def main():
         parents=[
             mkpdf_parser_generic,
             compile_parser_generic,
+            package_parser_generic,
             watermark_parser_generic,
         ],
     )
@@ -290,6 +336,7 @@ def main():
         parents=[
             mkpdf_parser_generic,
             compile_parser_generic,
+            package_parser_generic,
             watermark_parser_generic,
             validation_parser_generic,
         ],
@@ -301,6 +348,7 @@ def main():
         parents=[
             mkpdf_parser_generic,
             compile_parser_generic,
+            package_parser_generic,
             watermark_parser_generic,
             validation_parser_generic,
         ],
@@ -319,18 +367,107 @@ def main():
         help="also request a pitstop validation before PDF/A transformation",
     )
 
+    commands.add_parser(
+        "find_master",
+        help="Find the TeX master file of an archive",
+        parents=[
+            compile_parser_generic,
+            package_parser_generic,
+        ],
+    )
+
+    commands.add_parser(
+        "tideup_src",
+        help="Fix known problems in the TeX master file of an archive",
+        parents=[
+            compile_parser_generic,
+            package_parser_generic,
+        ],
+    )
+
     parser.add_argument(
         "--verify-env",
         help="Verify environment and exit.",
         action="store_true",
     )
+    return parser
+
+
+def task_options(
+    command: str, options: Dict[str, Any], config: Dict[str, Any] = None
+) -> Dict[str, Any]:
+    """Validate the options of a task against the command-line parser.
+
+    The options are usually strings (e.g. read from a wjs.ini file) and
+    are named after the command-line options (dashes or underscores,
+    without the leading dashes). They are converted as the parser would
+    do. Unknown options are ignored.
+
+    Missing options are taken from `config` (e.g. the GENERAL section of
+    the config file) or from the parser's defaults.
+
+    Return a dictionary suitable as kwargs for the Archive's methods.
+    Raise InvalidTaskOptions if the command is not known or an option
+    is not acceptable.
+    """
+    subparsers = [
+        action
+        for action in make_parser()._actions
+        if isinstance(action, argparse._SubParsersAction)
+    ][0]
+    if command not in subparsers.choices:
+        raise InvalidTaskOptions(f"Unknown command {command}")
+    actions = {
+        action.dest: action
+        for action in subparsers.choices[command]._actions
+        if action.option_strings and action.dest != "help"
+    }
+
+    result = {
+        dest: action.default
+        for dest, action in actions.items()
+        if action.default is not None
+    }
+    for key, value in (config or {}).items():
+        dest = key.replace("-", "_")
+        if dest in actions and value is not None:
+            result[dest] = value
+
+    for key, value in options.items():
+        dest = key.replace("-", "_")
+        action = actions.get(dest)
+        if action is None:
+            YAKUNIN_LOGGER.warning('Ignoring unknown option "%s" for %s', key, command)
+            continue
+        if isinstance(action, argparse._StoreTrueAction):
+            if str(value).lower() not in BOOLEAN_STATES:
+                raise InvalidTaskOptions(f'Option "{key}" should be a boolean')
+            value = BOOLEAN_STATES[str(value).lower()]
+        elif action.type is not None:
+            try:
+                value = action.type(value)
+            except ValueError:
+                raise InvalidTaskOptions(f'Invalid value "{value}" for "{key}"')
+        if action.choices is not None and value not in action.choices:
+            raise InvalidTaskOptions(f'Invalid choice "{value}" for "{key}"')
+        result[dest] = value
+
+    if "tex_engine" in result:
+        result["tex_engine"] = TEX_ENGINE_CHOICES.get(
+            result["tex_engine"], result["tex_engine"]
+        )
+    return result
 
+
+def main():
+    """Read config, command line and run requested command."""
+    parser = make_parser()
     args = parser.parse_args()
     if not args.verify_env and not args.archive:
         parser.error("Either verify the enviroment or provide an archive to process.")
 
     if hasattr(args, "tex_engine") and args.tex_engine is not None:
-        args.tex_engine = tex_engine_choices.get(args.tex_engine)
+        args.tex_engine = TEX_ENGINE_CHOICES.get(args.tex_engine)
 
     merge_with_config_file(args)
 
@@ -348,7 +485,16 @@ def main():
             print(result)
         return
 
-    with Archive(archive=args.archive) as archive:
+    cache = None
+    if getattr(args, "cache_dir", None):
+        cache = ResultCache(args.cache_dir, getattr(args, "cache_size", MAX_CACHE_SIZE))
+
+    with Archive(
+        archive=args.archive,
+        cache=cache,
+        limits=Limits.from_config(vars(args)),
+        scratch=Scratch.from_config(vars(args)),
+    ) as archive, archive.task_log.activate():
         func = getattr(archive, args.command)
         YAKUNIN_LOGGER.debug('Ready to call "%s"', func.__name__)
         result = None
@@ -1,6 +1,7 @@
 "Extract, compile & watermark WJ TeX archives"
 
-import glob
+import contextlib
+import functools
 import inspect
 import io
 import logging
@@ -9,6 +10,7 @@ import re
 import shutil
 import subprocess
 import tempfile
+import time
 import zipfile
 
 import filetype
@@ -16,21 +18,106 @@ import requests
 
 import yakunin.log_reading_lib
 import yakunin.src_tidyup_lib
-from yakunin.exceptions import NoTeXMaster, PDFGenerationFailure, UnknownArchiveFormat
+from yakunin.cache import cache_key, file_digest
+from yakunin.exceptions import (
+    ExtractionLimitExceeded,
+    NoTeXMaster,
+    PDFGenerationFailure,
+    ScratchSpaceExceeded,
+    UnknownArchiveFormat,
+)
+from yakunin.extraction import extract
 from yakunin.lib import (
     TASK_LOG,
     TASK_LOGGER,
     YAKUNIN_LOGGER,
+    FollowedFile,
+    TaskLog,
     aruspica_mime,
     has_documentclass,
+    place_file,
     read_pitstop_report,
 )
+from yakunin.packaging import package, package_options
+from yakunin.scratch import Scratch, usage
+
+
+def logged(method):
+    """Write what the decorated Archive method logs into the Archive's task log."""
+
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self.task_log.activate():
+            return method(self, *args, **kwargs)
+
+    return wrapper
+
+
+def task(method):
+    """Run the decorated Archive method as a task and package its result.
+
+    Tasks call each other (e.g. watermark calls mkpdf): only the
+    outermost call packages the temp dir (see submission_archive) and
+    returns the path of the package; the nested calls just do their
+    work in the temp dir and return None.
+
+    The outermost call also looks for the result in the Archive's cache
+    and stores it there (only if the task log contains no errors).
+    """
+
+    @functools.wraps(method)
+    def wrapper(self, **kwargs):
+        if self._in_task:
+            method(self, **kwargs)
+            return None
+        key = None
+        if self.cache is not None:
+            if self._cache_key is not None:
+                # (given for this task only)
+                key, self._cache_key = self._cache_key, None
+            else:
+                # (the digest of an unpacked archive is known already)
+                if self.manifest is not None:
+                    digest = self.manifest.digest
+                else:
+                    digest = file_digest(self.archive_filename)
+                key = cache_key(
+                    digest, method.__name__, dict(kwargs, tex_master=self.tex_master)
+                )
+            result = self.cache.get(key, dest_dir=self.scratch.disk_dir())
+            if result is not None:
+                YAKUNIN_LOGGER.info(
+                    "Result of %s taken from the cache", method.__name__
+                )
+                return result
+        with self.pipeline():
+            method(self, **kwargs)
+        result = self.submission_archive(**kwargs)
+        if key is not None and self.task_log.errors == 0:
+            self.cache.put(key, result)
+        return result
+
+    return wrapper
+
+
+def stage(name):
+    """Run the decorated Archive method as a stage named `name` (see Archive._stage)."""
+
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            with self.task_log.activate(), self._stage(name):
+                return method(self, *args, **kwargs)
+
+        return wrapper
+
+    return decorator
 
 
 class Archive:
     """The internal representation of a submitted archive.
 
-    An "archive" can be any of zip, tar.gz, xtar (see shutil.unpack_archive)
+    An "archive" can be any of zip, tar.gz, xtar (see yakunin.extraction)
     but also a simple tex file or a pdf file
     (in this last case, some operations will fail).
     """
@@ -50,6 +137,15 @@ class Archive:
 
     def __exit__(self, exc_type, exc_value, traceback):
         """Close the log file when we are finished."""
+        self.cleanup()
+
+    def cleanup(self, keep_temp_dir=False):
+        """Close the log file and remove the temp dir (unless `keep_temp_dir`)."""
+        self.task_log.close()
+        if self._spilled_from is not None and os.path.islink(self._spilled_from):
+            os.unlink(self._spilled_from)
+        if keep_temp_dir:
+            return
         if self.temp_dir and os.path.exists(self.temp_dir):
             if YAKUNIN_LOGGER.getEffectiveLevel() == logging.DEBUG:
                 YAKUNIN_LOGGER.critical("Please remove %s", self.temp_dir)
@@ -60,16 +156,41 @@ class Archive:
         self,
         tex_master=None,
         archive=None,
-        base_dir="/tmp",
+        base_dir=None,
+        progress=None,
+        cache=None,
+        limits=None,
+        extracted=None,
+        scratch=None,
+        cache_key=None,
     ):
-        """Allow for some defaults."""
+        """Allow for some defaults.
+
+        `progress`, when given, is called with the name of each stage
+        of the processing as soon as the stage begins.
+
+        `cache`, when given, is the ResultCache (see yakunin.cache)
+        where the results of the tasks are looked up and stored.
+        `cache_key`, when given, is the key of the result of the first
+        task run (e.g. computed by the service, which has already
+        hashed the archive).
+
+        `limits`, when given, bounds the extraction of the archive (see
+        yakunin.extraction.Limits; by default, the module's defaults).
+
+        `extracted`, when given, is the archive already extracted
+        elsewhere (see yakunin.extraction.Extracted): if it has been
+        extracted in the expected format, it is moved into the work dir
+        instead of being extracted again.
+
+        `scratch` (see yakunin.scratch) tells where the Archive works,
+        unless `base_dir` is given, and how many bytes it can take.
+        """
         assert archive is not None
 
+        # the file is not read until it is unpacked (see _unpack_archive)
         self.archive_filename = archive
         self.archive_name = os.path.split(archive)[-1]
-        # TODO: use only the filename/path, do not open it yet
-        self.archive = io.BytesIO(open(archive, "rb").read())
-        self.archive.seek(0)
 
         self.tex_master = tex_master
         self.main_pdf = None
@@ -77,13 +198,17 @@ class Archive:
         # basename = tex_master sans extension
         self.basename = None
 
-        self.base_dir = base_dir
+        self.scratch = scratch or Scratch()
+        archive_size = os.path.getsize(archive) if os.path.isfile(archive) else 0
+        self.base_dir = base_dir or self.scratch.base_dir(archive_size)
 
         # temp dir
         # ========
         # The folders "submission" and "work", the task log and the
         # main pdf will be created inside this dir
         self.temp_dir = tempfile.mkdtemp(dir=self.base_dir)
+        # where the temp dir was, if it has been moved to disk (see _spill)
+        self._spilled_from = None
 
         # application logger
         # ==================
@@ -93,20 +218,50 @@ class Archive:
         # This logger writes to a "yakunin.log" file in the temp_dir
         # all relevant steps of the required task. The "yakunin.log"
         # is a mean to communicate with the calling wjapp application.
-        # Now I know where temp_dir is, so here I change the logger's
-        # handler filename
-        log_stream = open(os.path.join(self.temp_dir, TASK_LOG), "w")
-        # no handler defined during tests?
-        for handler in TASK_LOGGER.handlers:
-            handler.setStream(log_stream)
-        TASK_LOGGER.debug("Working in %s", self.temp_dir)
+        # Each Archive has its own log file: TASK_LOGGER writes there
+        # while the methods of the Archive run (see @logged and @stage)
+        self.task_log = TaskLog(os.path.join(self.temp_dir, TASK_LOG))
+        with self.task_log.activate():
+            TASK_LOGGER.debug("Working in %s", self.temp_dir)
 
         self.work_dir = None
 
         self.mime_type = None
-        # shutil format for unpack_archive function
+        # format for yakunin.extraction.extract
         self.formato = None
+        # what has been unpacked (see yakunin.extraction.Manifest)
+        self.manifest = None
+
+        # what we are doing right now (see _report_stage)
+        self.stage = None
+        self.progress = progress
+        # how long (in seconds) each stage took (see _stage)
+        self.timings = []
+        self._nested_time = []
+
+        self.cache = cache
+        # the key of the first task, if known (see @task)
+        self._cache_key = cache_key
+        self.limits = limits
+        self.extracted = extracted
+        # True while a task (e.g. mkpdf) is running (see @task)
+        self._in_task = False
+
+    @contextlib.contextmanager
+    def pipeline(self):
+        """Run tasks as steps of a bigger one, without packaging their results.
+
+        E.g. to package the temp dir in a different way (see
+        submission_archive).
+        """
+        in_task = self._in_task
+        self._in_task = True
+        try:
+            yield
+        finally:
+            self._in_task = in_task
 
+    @stage("unpack")
     def _unpack_archive(self):
         """Open the archive.
 
@@ -125,9 +280,8 @@ class Archive:
         submission_dir = os.path.join(self.temp_dir, "submission")
         os.mkdir(submission_dir)
         archive_file = os.path.join(submission_dir, self.archive_name)
-        with open(os.path.join(archive_file), "wb") as received_file:
-            received_file.write(self.archive.read())
-        self.archive.seek(0)
+        # nobody writes into the submission dir: a hard link will do
+        place_file(self.archive_filename, archive_file, link=True)
 
         # work dir
         # ========
@@ -138,14 +292,12 @@ class Archive:
 
         # mime type
         # =========
-        self.mime_type = aruspica_mime(self.archive_filename)
-        # TODO: should be aruspica_mime(self.submission + self.archive_name)
-        # is this too much of an assumption?
+        self.mime_type = aruspica_mime(archive_file)
         assert self.mime_type is not None
         TASK_LOGGER.debug("Archive mime type: %s", self.mime_type)
 
         # now that we have a mimetype, lets find a suitable format for
-        # shutil.unpack_archive
+        # extract
         epatografo = {
             "text/x-tex": "copy",
             "application/pdf": "copy",
@@ -167,9 +319,20 @@ class Archive:
 
         # extract/write files
         # ===================
-        # TODO: switch to patool? https://libraries.io/pypi/patool
         try:
-            shutil.unpack_archive(archive_file, self.work_dir, self.formato)
+            if self.extracted is not None and self.extracted.format == self.formato:
+                TASK_LOGGER.debug("Archive unpacked while it was received")
+                self.manifest = self.extracted.adopt(self.work_dir, archive_file)
+            else:
+                self.manifest = extract(
+                    archive_file, self.work_dir, self.formato, self.limits
+                )
+        except ExtractionLimitExceeded as exception:
+            TASK_LOGGER.error("Cannot unpack %s: %s", self.archive_name, exception)
+            # don't keep what has been extracted so far
+            shutil.rmtree(self.work_dir)
+            os.mkdir(self.work_dir)
+            raise
         except shutil.ReadError as exception:
             YAKUNIN_LOGGER.warning(
                 "Cannot upack %s as %s: %s", archive_file, self.formato, exception
@@ -177,10 +340,14 @@ class Archive:
             raise exception
         else:
             TASK_LOGGER.info("Unpacked %s as %s", archive_file, self.formato)
+            TASK_LOGGER.debug(
+                "Unpacked %s members (%s bytes)",
+                len(self.manifest.members),
+                self.manifest.size,
+            )
 
-        os.chdir(self.work_dir)
-
-    def find_master(self):
+    @stage("find_master")
+    def find_master(self, **kwargs):
         """Navigate the archive and find the tex_master."""
         if not self.work_dir:
             # archive has not yet been unpacked;
@@ -212,10 +379,10 @@ class Archive:
 
         # One file only
         # =============
-        files = glob.glob("**/*", recursive=True)
+        files = self.manifest.files()
         assert files, "No file to work with? Some error during unpack?"
         if len(files) == 1:
-            mime = filetype.guess_mime(files[0])
+            mime = filetype.guess_mime(os.path.join(self.work_dir, files[0]))
             YAKUNIN_LOGGER.debug("Mime of master %s is %s", files[0], mime)
             if mime in Archive.non_tex_known_types:
                 TASK_LOGGER.warning("Mime of master %s is %s. Not TeX!", files[0], mime)
@@ -243,7 +410,7 @@ class Archive:
         # many .tex
         if tex_files:
             # tieni solo quelli che contengono \documentclass
-            tex_files = list(filter(has_documentclass, tex_files))
+            tex_files = [x for x in tex_files if has_documentclass(self._work_path(x))]
             # TODO: what if no tex has \documentclass???
             # se c'è un main.tex usa quello
             if "main.tex" in tex_files:
@@ -262,6 +429,8 @@ class Archive:
         # no .tex
         YAKUNIN_LOGGER.error("WRITE ME!!!")
 
+    @task
+    @logged
     def tex_compile(self, **kwargs):
         """Compile a tex (run tex_engine on the tex_master)."""
         # TODO: read the following:
@@ -282,9 +451,8 @@ class Archive:
         assert tex_engine
 
         # the tex master can be inside a subdir of "work"
-        # we move there and keep only the basename of the tex master
+        # we work there and keep only the basename of the tex master
         self.work_dir = os.path.join(self.work_dir, os.path.dirname(self.tex_master))
-        os.chdir(self.work_dir)
         self.tex_master = os.path.basename(self.tex_master)
 
         self.basename = re.sub(r"\.tex$", "", self.tex_master, flags=re.IGNORECASE)
@@ -292,6 +460,8 @@ class Archive:
         # correct known problems in the tex source
         self.tideup_src()
 
+        self._report_stage("tex_compile")
+
         # build the compilation command
         args = tex_engine.split()
         args.extend(tex_options)
@@ -300,44 +470,49 @@ class Archive:
         TASK_LOGGER.debug(
             "ready to compile %s in %s with command %s",
             self.tex_master,
-            os.getcwd(),
+            self.work_dir,
             " ".join(args),
         )
-        stdout = None
-        try:
-            # NB: do not use "encoding='utf-8'"
+        # all stdout/stderr goes to basename.stdout, which is read
+        # (and problems are logged away) while latexmk writes it
+        stdout_log = os.path.join(self.work_dir, self.basename + ".stdout")
+        deadline = time.monotonic() + timeout
+        with self._stage("latexmk"):
+            # NB: do not decode the output here
             # because pesky files have broken encodings
-            result = subprocess.run(
-                args=args,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.STDOUT,
-                check=True,
-                timeout=timeout,
-            )
-        except subprocess.CalledProcessError as error:
+            with open(stdout_log, "wb") as out:
+                process = subprocess.Popen(
+                    args=args,
+                    cwd=self.work_dir,
+                    stdout=out,
+                    stderr=subprocess.STDOUT,
+                )
+            # (the scratch space taken by the job grows while latexmk runs)
+            check = None
+            if self.scratch.max_job_size is not None:
+                check = self._check_job_size
+            try:
+                with open(stdout_log) as stdout_file:
+                    self._read_stdout(
+                        FollowedFile(stdout_file, process, deadline, check=check)
+                    )
+            finally:
+                if process.poll() is None:
+                    process.kill()
+                    timed_out = True
+                else:
+                    timed_out = False
+                process.wait()
+
+        if timed_out:
+            TASK_LOGGER.error("Compilation timed out after %s seconds", timeout)
+        elif process.returncode != 0:
             # Here I log a warning.
             # Later on, I will examine the situation more accurately
             # an decide whether to eventually log a blockin error
-            TASK_LOGGER.warning(error)
-            # stdout/stderr can be taken from the exception
-            stdout = error.stdout
-        except subprocess.TimeoutExpired as error:
-            TASK_LOGGER.error("Compilation timed out after %s seconds", timeout)
-            stdout = error.stdout
+            TASK_LOGGER.warning(subprocess.CalledProcessError(process.returncode, args))
         else:
             TASK_LOGGER.info("Successfully compiled %s", self.tex_master)
-            stdout = result.stdout
-        finally:
-            # dump all stdout/stderr to basename.stdout
-            if stdout is not None:
-                with open(
-                    os.path.join(self.work_dir, self.basename + ".stdout"), "wb"
-                ) as out:
-                    out.write(stdout)
-
-        # read the logs (latexmk, latex, etc.)
-        # and log away problems as needed
-        self.read_log()
 
         # move the final pdf to the "root" of the temp_dir
         self.main_pdf = self.basename + ".pdf"
@@ -347,8 +522,8 @@ class Archive:
         else:
             TASK_LOGGER.error("No pdf file produced! Compilation fails.")
 
-        return self.submission_archive()
-
+    @task
+    @logged
     def watermark(self, **kwargs):
         """Apply a watermark.
 
@@ -375,6 +550,8 @@ class Archive:
         if not self.main_pdf:
             raise PDFGenerationFailure("Watermarking failed because of missing pdf")
 
+        self._report_stage("watermark")
+
         # parenthesis must be escaped when used in postscript
         text = re.sub(r"([()])", r"\\\1", text)
 
@@ -389,20 +566,22 @@ class Archive:
         # https://stackoverflow.com/a/29647772/1581629
 
         # TODO use try/except
-        result = subprocess.run(
-            args=[
-                "pdfinfo",
-                "-f",
-                "1",
-                "-l",
-                "1000",
-                # '-box',  # \Mediabox & co.
-                pdf_file,
-            ],
-            stdout=subprocess.PIPE,
-            universal_newlines=True,
-            check=True,
-        )
+        with self._stage("pdfinfo"):
+            result = subprocess.run(
+                args=[
+                    "pdfinfo",
+                    "-f",
+                    "1",
+                    "-l",
+                    "1000",
+                    # '-box',  # \Mediabox & co.
+                    pdf_file,
+                ],
+                cwd=self.work_dir,
+                stdout=subprocess.PIPE,
+                universal_newlines=True,
+                check=True,
+            )
         # Example output
         # Page    9 rot:  0
         # Page   10 size: 595.276 x 841.89 pts (A4)
@@ -451,17 +630,17 @@ class Archive:
         # auxiliary files
         # the watermark in a postscript file
         dummy, watermark_ps_name = tempfile.mkstemp(
-            prefix="watermark", suffix=".ps", dir=os.getcwd()
+            prefix="watermark", suffix=".ps", dir=self.work_dir
         )
 
         # the pdf watermark (generated from the ps)
         dummy, watermark_name = tempfile.mkstemp(
-            prefix="watermark", suffix=".pdf", dir=os.getcwd()
+            prefix="watermark", suffix=".pdf", dir=self.work_dir
         )
 
         # the final result (the main pdf watermarked)
         dummy, watermarked_name = tempfile.mkstemp(
-            prefix=self._main_pdf_se(), suffix="-wm.pdf", dir=os.getcwd()
+            prefix=self._main_pdf_se(), suffix="-wm.pdf", dir=self.work_dir
         )
         del dummy  # only to avoid "unused-variable warning"
 
@@ -483,38 +662,42 @@ class Archive:
                 )
 
             # generate the pdf from the ps
-            subprocess.run(
-                args=[
-                    "gs",
-                    "-P-",
-                    "-q",
-                    "-dSAFER",
-                    "-dNOPAUSE",
-                    "-dBATCH",
-                    f"-sOutputFile={watermark_name}",
-                    "-sDEVICE=pdfwrite",
-                    "-sPAPERSIZE=a4",
-                    "-dAutoRotatePages=/None",
-                    "-c",
-                    "<</Orientation 0>> setpagedevice",
-                    "-f",
-                    watermark_ps_name,
-                ],
-                check=True,
-            )
+            with self._stage("gs"):
+                subprocess.run(
+                    args=[
+                        "gs",
+                        "-P-",
+                        "-q",
+                        "-dSAFER",
+                        "-dNOPAUSE",
+                        "-dBATCH",
+                        f"-sOutputFile={watermark_name}",
+                        "-sDEVICE=pdfwrite",
+                        "-sPAPERSIZE=a4",
+                        "-dAutoRotatePages=/None",
+                        "-c",
+                        "<</Orientation 0>> setpagedevice",
+                        "-f",
+                        watermark_ps_name,
+                    ],
+                    cwd=self.work_dir,
+                    check=True,
+                )
 
             # apply the watermark
-            subprocess.run(
-                args=[
-                    "pdftk",
-                    self.main_pdf,
-                    "background",
-                    watermark_name,
-                    "output",
-                    watermarked_name,
-                ],
-                check=True,
-            )
+            with self._stage("pdftk"):
+                subprocess.run(
+                    args=[
+                        "pdftk",
+                        self.main_pdf,
+                        "background",
+                        watermark_name,
+                        "output",
+                        watermarked_name,
+                    ],
+                    cwd=self.work_dir,
+                    check=True,
+                )
 
         else:
             TASK_LOGGER.debug("Rotating watermark for pages %s", pages_to_rotate)
@@ -546,41 +729,46 @@ showpage
                 dst.write(postscript_code)
 
             # generate the pdf from the ps
-            subprocess.run(
-                args=[
-                    "gs",
-                    "-P-",
-                    "-q",
-                    "-dSAFER",
-                    "-dNOPAUSE",
-                    "-dBATCH",
-                    f"-sOutputFile={watermark_name}",
-                    "-sDEVICE=pdfwrite",
-                    "-sPAPERSIZE=a4",
-                    "-dAutoRotatePages=/None",
-                    watermark_ps_name,
-                ],
-                check=True,
-            )
+            with self._stage("gs"):
+                subprocess.run(
+                    args=[
+                        "gs",
+                        "-P-",
+                        "-q",
+                        "-dSAFER",
+                        "-dNOPAUSE",
+                        "-dBATCH",
+                        f"-sOutputFile={watermark_name}",
+                        "-sDEVICE=pdfwrite",
+                        "-sPAPERSIZE=a4",
+                        "-dAutoRotatePages=/None",
+                        watermark_ps_name,
+                    ],
+                    cwd=self.work_dir,
+                    check=True,
+                )
 
             # apply the multibackground
-            subprocess.run(
-                args=[
-                    "pdftk",
-                    self.main_pdf,
-                    "multibackground",
-                    watermark_name,
-                    "output",
-                    watermarked_name,
-                ],
-                check=True,
-            )
+            with self._stage("pdftk"):
+                subprocess.run(
+                    args=[
+                        "pdftk",
+                        self.main_pdf,
+                        "multibackground",
+                        watermark_name,
+                        "output",
+                        watermarked_name,
+                    ],
+                    cwd=self.work_dir,
+                    check=True,
+                )
 
         self.main_pdf = os.path.basename(watermarked_name)
         os.rename(watermarked_name, os.path.join(self.temp_dir, self.main_pdf))
         TASK_LOGGER.debug("Watermark applied.")
-        return self.submission_archive()
 
+    @task
+    @logged
     def pitstop_validate(self, **kwargs):
         "Execute Pitstop fix & validation of the given PDF file."
         YAKUNIN_LOGGER.debug("Pitstop validation requested")
@@ -597,15 +785,17 @@ showpage
                 "Pitstop validation failed because of missing pdf"
             )
 
+        self._report_stage("pitstop_validate")
+
         # let's work in the work dir
         pdf_file = self._move_main_pdf_to_work_dir()
 
         # ensure that the name of the pdf file contains a "." only
         # (for the extension), because the pitstop validation server
         # will split the filename on the first "." and get confused
-        friendly_name = re.sub(r"\.pdf$", "", pdf_file)
+        friendly_name = re.sub(r"\.pdf$", "", os.path.basename(pdf_file))
         friendly_name = friendly_name.replace(".", "_")
-        friendly_name += ".pdf"
+        friendly_name = os.path.join(self.work_dir, friendly_name + ".pdf")
         os.rename(pdf_file, friendly_name)
         pdf_file = friendly_name
 
@@ -615,18 +805,19 @@ showpage
         TASK_LOGGER.debug("PDF ready to be sent to Pitstop validation server %s.", url)
 
         try:
-            response = requests.post(
-                url,
-                files={
-                    "userfile": (
-                        os.path.basename(pdf_file),  # filename
-                        open(pdf_file, "rb"),  # filehandle
-                        "application/pdf",
-                    )  # mime type
-                },
-                headers={"User-Agent": "yakunin"},
-                timeout=timeout,
-            )
+            with self._stage("medusa_pitstop"):
+                response = requests.post(
+                    url,
+                    files={
+                        "userfile": (
+                            os.path.basename(pdf_file),  # filename
+                            open(pdf_file, "rb"),  # filehandle
+                            "application/pdf",
+                        )  # mime type
+                    },
+                    headers={"User-Agent": "yakunin"},
+                    timeout=timeout,
+                )
         except requests.exceptions.Timeout:
             TASK_LOGGER.error("Pitstop validation timed out after %s seconds", timeout)
         else:
@@ -700,8 +891,9 @@ showpage
                         self.main_pdf = pdf_fn
                     else:
                         TASK_LOGGER.error("Missing %s in zip file %s", pdf_fn, zip_file)
-                return self.submission_archive()
 
+    @task
+    @logged
     def topdfa(self, **kwargs):
         "Generate PDF/A-1b via Callas' Pdftoolbox"
         YAKUNIN_LOGGER.debug("PDF/A-1b requested")
@@ -722,6 +914,8 @@ showpage
         if not self.main_pdf:
             raise PDFGenerationFailure("PDF/A-1b failed because of missing pdf")
 
+        self._report_stage("topdfa")
+
         # let's work in the work dir
         pdf_file = self._move_main_pdf_to_work_dir()
 
@@ -733,18 +927,19 @@ showpage
         )
 
         try:
-            response = requests.post(
-                url,
-                files={
-                    "userfile": (
-                        os.path.basename(pdf_file),  # filename
-                        open(pdf_file, "rb"),  # filehandle
-                        "application/pdf",
-                    )  # mime type
-                },
-                headers={"User-Agent": "yakunin"},
-                timeout=timeout,
-            )
+            with self._stage("medusa_pdfa"):
+                response = requests.post(
+                    url,
+                    files={
+                        "userfile": (
+                            os.path.basename(pdf_file),  # filename
+                            open(pdf_file, "rb"),  # filehandle
+                            "application/pdf",
+                        )  # mime type
+                    },
+                    headers={"User-Agent": "yakunin"},
+                    timeout=timeout,
+                )
         except requests.exceptions.Timeout:
             TASK_LOGGER.error(
                 "PDF/A transformation timed out after %s seconds", timeout
@@ -789,8 +984,9 @@ showpage
                     os.rename(pdfa_name, os.path.join(self.temp_dir, self.main_pdf))
 
                     TASK_LOGGER.info("PDF transformed to PDF/A-1b.")
-        return self.submission_archive()
 
+    @task
+    @logged
     def mkpdf(self, **kwargs):
         "Try to generate a pdf from the given archive file"
         YAKUNIN_LOGGER.debug("mkpdf requested")
@@ -798,13 +994,19 @@ showpage
         if not self.work_dir:
             self._unpack_archive()
 
-        files = glob.glob("**/*", recursive=True)
+        self._report_stage("mkpdf")
+        # (as find_master, from the manifest: neither dirs nor hidden files)
+        files = self.manifest.files()
         assert files, "No file to work with? Some error during unpack?"
         if len(files) == 1:
-            mime = aruspica_mime(files[0])
+            mime = aruspica_mime(self._work_path(files[0]))
             if mime == "application/pdf":
-                self.main_pdf = files[0]
-                os.rename(self.main_pdf, os.path.join(self.temp_dir, self.main_pdf))
+                # the file can be inside a subdir of "work"
+                self.main_pdf = os.path.basename(files[0])
+                os.rename(
+                    self._work_path(files[0]),
+                    os.path.join(self.temp_dir, self.main_pdf),
+                )
 
             # ODT or DOCX - transform to pdf via libreoffice
             elif mime in (
@@ -826,7 +1028,7 @@ showpage
                 )
                 timeout = kwargs.get("timeout_mkpdf", 59)
                 self._convert_to_pdf_via_word_on_windows(
-                    files[0], url=url, mime=mime, timeout=timeout
+                    self._work_path(files[0]), url=url, mime=mime, timeout=timeout
                 )
 
         if self.main_pdf is None:
@@ -839,44 +1041,34 @@ showpage
             raise PDFGenerationFailure()
 
         TASK_LOGGER.info("Main pdf is %s", self.main_pdf)
-        return self.submission_archive()
 
-    def submission_archive(self):
+    @stage("submission_archive")
+    def submission_archive(self, **kwargs):
         """Return the processed result.
 
-        Return the path to a tar.gz containing the final pdf, the
-        submission dir, the work dir, and the task log.
+        Return the path to a package (by default a tar.gz) containing
+        the final pdf, the submission dir, the work dir, and the task
+        log. See yakunin.packaging for the options (package_format,
+        package_level and package_threads).
 
         """
         if not self.work_dir:
             self._unpack_archive()
-        filename = tempfile.mkstemp()[1]
-        result = shutil.make_archive(filename, "gztar", self.temp_dir)
-        os.unlink(filename)  # TODO: not thread-safe (?)
-        return result
+        return package(
+            self.temp_dir, dest_dir=self.scratch.disk_dir(), **package_options(kwargs)
+        )
 
-    def read_log(self):
-        """Read the compilation & co. log files and report problems."""
-        # latexmk
-        # =======
-        # TODO: latexmk produces .fls and .fdb_latexmk files
-        # I don't know how to use them...
-        # latexmk_log = os.path.join(  # NOQA E800
-        #     self.work_dir, self.basename+".fls")
-        # if os.path.exists(latexmk_log):
-        #     TASK_LOGGER.debug("%s exists", latexmk_log)  # NOQA E800
-
-        # latex .log
-        # ==========
-        # see stdout
+    def _read_stdout(self, stdout_file):
+        """Report the problems found in the stdout of latexmk (see log_reading_lib).
 
-        # stdout
-        # ======
-        # This is the stdout of the latexmk command, which should
-        # contain also the stdout of the latex command(s)
-        # NB: not sure about the enconding (see
-        # test-files/9578-dg.tar.gz)
+        `stdout_file` can be a FollowedFile, to report the problems
+        while latexmk is running (as tex_compile does: the time spent
+        reading the log is part of the "latexmk" stage).
 
+        This stdout should contain also the stdout of the latex
+        command(s). NB: not sure about the encoding (see
+        test-files/9578-dg.tar.gz)
+        """
         competent_functions = inspect.getmembers(
             yakunin.log_reading_lib,
             lambda x: inspect.isfunction(x) and getattr(x, "exposed", False),
@@ -886,27 +1078,102 @@ showpage
             "found %s error-reading functions", len(competent_functions)
         )
 
-        stdout_log = os.path.join(self.work_dir, self.basename + ".stdout")
-        with open(stdout_log) as stdout_file:
-            TASK_LOGGER.debug("Reading %s", stdout_log)
-
-            # since "next()" disables "tell",
-            # I'm going to iterate over the file lines in this funny faction
-            # https://stackoverflow.com/a/49786016/1581629
-            for line in iter(stdout_file.readline, ""):
-                for func in competent_functions:
-                    if line.find(func.search_string) >= 0:
-                        func(line, stdout_file)
-
-    def tideup_src(self):
+        TASK_LOGGER.debug(
+            "Reading %s", os.path.join(self.work_dir, self.basename + ".stdout")
+        )
+
+        # since "next()" disables "tell",
+        # I'm going to iterate over the file lines in this funny faction
+        # https://stackoverflow.com/a/49786016/1581629
+        for line in iter(stdout_file.readline, ""):
+            for func in competent_functions:
+                if line.find(func.search_string) >= 0:
+                    func(line, stdout_file)
+
+    @stage("tideup_src")
+    def tideup_src(self, **kwargs):
         "Call functions that can fix some known problem in the tex src"
+        if not self.tex_master:
+            self.find_master()
         competent_functions = inspect.getmembers(
             yakunin.src_tidyup_lib, inspect.isfunction
         )
         YAKUNIN_LOGGER.debug("found %s src-tideup functions", len(competent_functions))
         for funcname, func in competent_functions:
             YAKUNIN_LOGGER.debug("calling %s on %s", funcname, self.tex_master)
-            func(self.tex_master)
+            func(self._work_path(self.tex_master))
+
+    def _report_stage(self, stage):
+        """Remember the current stage and tell whoever is interested."""
+        self.stage = stage
+        if self.progress is not None:
+            self.progress(stage)
+
+    @contextlib.contextmanager
+    def _stage(self, name):
+        """Run a stage of the processing and record how long it took.
+
+        The time spent in nested stages (e.g. the unpacking done by
+        find_master) is not counted twice: each entry of self.timings
+        is the time spent in that stage only.
+        """
+        self._report_stage(name)
+        self._nested_time.append(0)
+        start = time.monotonic()
+        try:
+            yield
+            self._check_scratch()
+        finally:
+            elapsed = time.monotonic() - start
+            nested = self._nested_time.pop()
+            self.timings.append((name, elapsed - nested))
+            if self._nested_time:
+                self._nested_time[-1] += elapsed
+
+    def _check_scratch(self):
+        """Stop the task if it takes too many bytes; spill it to disk if too many for RAM."""
+        if not self.scratch.must_measure(self.temp_dir):
+            return
+        size = self._check_job_size()
+        if size > self.scratch.ram_threshold and self.scratch.in_ram(self.temp_dir):
+            self._spill()
+
+    def _check_job_size(self) -> int:
+        """Stop the task if it takes more than max_job_size bytes; return how many it takes."""
+        size = usage(self.temp_dir)
+        max_job_size = self.scratch.max_job_size
+        if max_job_size is not None and size > max_job_size:
+            TASK_LOGGER.error(
+                "The task takes %s bytes of scratch space (at most %s)",
+                size,
+                max_job_size,
+            )
+            raise ScratchSpaceExceeded(f"{size} bytes in {self.temp_dir}")
+        return size
+
+    def _spill(self):
+        """Move the temp dir from RAM to disk.
+
+        A link to the new temp dir takes the place of the old one, for
+        whoever still has its path (e.g. the job following the task log).
+        """
+        ram_dir = self.temp_dir
+        self.temp_dir = tempfile.mkdtemp(dir=self.scratch.disk_dir())
+        for name in os.listdir(ram_dir):
+            shutil.move(os.path.join(ram_dir, name), self.temp_dir)
+        os.rmdir(ram_dir)
+        os.symlink(self.temp_dir, ram_dir)
+        self._spilled_from = ram_dir
+        if self.work_dir is not None:
+            self.work_dir = os.path.join(
+                self.temp_dir, os.path.relpath(self.work_dir, ram_dir)
+            )
+        if self.manifest is not None:
+            self.manifest.source = os.path.join(
+                self.temp_dir, os.path.relpath(self.manifest.source, ram_dir)
+            )
+        self.task_log.reopen(os.path.join(self.temp_dir, TASK_LOG))
+        TASK_LOGGER.debug("Moved from RAM to %s", self.temp_dir)
 
     def _move_main_pdf_to_work_dir(self):
         """Archive the main PDF.
@@ -919,10 +1186,13 @@ showpage
         assert self.main_pdf is not None
         pdf_file = os.path.join(self.work_dir, self.main_pdf)
         os.rename(os.path.join(self.temp_dir, self.main_pdf), pdf_file)
-        os.chdir(self.work_dir)  # ← is this a good idea???
         # TODO: self.main_pdf now is WRONG! should I set it to None?
         return pdf_file
 
+    def _work_path(self, path):
+        """Return the path of a file given relative to the work dir."""
+        return os.path.join(self.work_dir, path)
+
     def _main_pdf_se(self):
         'Return the name of the main pdf file without the ".pdf" extension'
         return re.sub(r"\.pdf$", "", self.main_pdf)
@@ -932,31 +1202,34 @@ showpage
 
         If all goes well, self.main_pdf will be set.
         """
+        # Apparently libreoffice cannot be called concurrently
+        # (see e.g. https://ask.libreoffice.org/t/convert-to-commands-in-parallel-possible/90182)
+        # A workaround, is to set differet UserInstallation folders for each operation,
+        # so we do that (on disk, in the scratch space, as the profile is not small):
+        uniq_profile_dir = tempfile.mkdtemp(
+            prefix="libreoffice-", dir=self.scratch.disk_dir()
+        )
         try:
-            # Apparently libreoffice cannot be called concurrently
-            # (see e.g. https://ask.libreoffice.org/t/convert-to-commands-in-parallel-possible/90182)
-            # A workaround, is to set differet UserInstallation folders for each operation,
-            # so we do that:
-            uniq_profile_dir = tempfile.mkdtemp()
-
             # convert odt to pdf
             # and save the result in root dir (temp_dir)
-            subprocess.run(
-                args=[
-                    "libreoffice",
-                    f"-env:UserInstallation=file://{uniq_profile_dir}",
-                    "--headless",  # already implied by --convert-to
-                    "--convert-to",
-                    "pdf",
-                    "--outdir",
-                    self.temp_dir,
-                    file,
-                ],
-                check=True,
-                timeout=timeout,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.STDOUT,
-            )
+            with self._stage("libreoffice"):
+                subprocess.run(
+                    args=[
+                        "libreoffice",
+                        f"-env:UserInstallation=file://{uniq_profile_dir}",
+                        "--headless",  # already implied by --convert-to
+                        "--convert-to",
+                        "pdf",
+                        "--outdir",
+                        self.temp_dir,
+                        file,
+                    ],
+                    cwd=self.work_dir,
+                    check=True,
+                    timeout=timeout,
+                    stdout=subprocess.PIPE,
+                    stderr=subprocess.STDOUT,
+                )
         except subprocess.CalledProcessError as error:
             TASK_LOGGER.error("PDF generation failed: %s", error)
             TASK_LOGGER.error(f"    error returncode: {error.returncode}")
@@ -968,10 +1241,12 @@ showpage
             TASK_LOGGER.error("PDF generation timed out after %s seconds", timeout)
         else:
             TASK_LOGGER.info("PDF successfully generated.")
-            if file.endswith(".odt"):
-                self.main_pdf = re.sub(r"\.odt$", ".pdf", file)
-            elif file.endswith(".docx"):
-                self.main_pdf = re.sub(r"\.docx$", ".pdf", file)
+            # (libreoffice writes the pdf in the outdir, whatever the subdir of file)
+            name = os.path.basename(file)
+            if name.endswith(".odt"):
+                self.main_pdf = re.sub(r"\.odt$", ".pdf", name)
+            elif name.endswith(".docx"):
+                self.main_pdf = re.sub(r"\.docx$", ".pdf", name)
             else:
                 TASK_LOGGER.error(
                     f"Unknow extension on file {self.main_pdf}. Please check!"
@@ -992,18 +1267,19 @@ showpage
         )
 
         try:
-            response = requests.post(
-                url,
-                files={
-                    "userfile": (
-                        os.path.basename(file),
-                        open(file, "rb"),
-                        mime,
-                    )
-                },
-                headers={"User-Agent": "yakunin"},
-                timeout=timeout,
-            )
+            with self._stage("medusa_doc2pdf"):
+                response = requests.post(
+                    url,
+                    files={
+                        "userfile": (
+                            os.path.basename(file),
+                            open(file, "rb"),
+                            mime,
+                        )
+                    },
+                    headers={"User-Agent": "yakunin"},
+                    timeout=timeout,
+                )
         except requests.exceptions.Timeout:
             TASK_LOGGER.error(
                 "doc-to-pdf conversion timed out after %s seconds", timeout
@@ -1060,7 +1336,7 @@ showpage
         """
         try:
             assert os.path.exists(self.temp_dir)
-            assert os.path.exists(file)
+            assert os.path.exists(self._work_path(file))
             output_file = re.sub(r"(\.odt|\.docx)$", ".pdf", file)
             output_file = os.path.join(self.temp_dir, output_file)
             # convert odt to pdf
@@ -1072,6 +1348,7 @@ showpage
                     f"--output={output_file}",
                     file,
                 ],
+                cwd=self.work_dir,
                 check=True,
                 timeout=timeout,
                 stdout=subprocess.PIPE,
@@ -0,0 +1,152 @@
+"""Run the same task on many files and package the results together.
+
+Each file is processed by its own Archive, in parallel (in a pool of
+processes). The results are collected in a single tar.gz, with one
+directory for each file and a manifest (manifest.json) that tells how
+the processing of each file went, e.g.:
+
+    ./manifest.json
+    ./paper-1.pdf/yakunin-task.log
+    ./paper-1.pdf/paper-1-wm.pdf
+    ...
+"""
+
+import io
+import json
+import os
+import posixpath
+import tarfile
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Dict, List, Union
+
+from yakunin.cache import ResultCache
+from yakunin.extraction import Limits
+from yakunin.scratch import Scratch
+from yakunin.workers import run_task
+
+MANIFEST = "manifest.json"
+
+
+def result_names(filenames: List[str]) -> List[str]:
+    """Name the directory of the result of each file after the file.
+
+    Files with the same name (or named as the manifest) get a prefix
+    with their position in the batch.
+    """
+    names = [os.path.basename(filename) for filename in filenames]
+    return [
+        f"{index}-{name}" if names.count(name) > 1 or name == MANIFEST else name
+        for index, name in enumerate(names)
+    ]
+
+
+def package_batch(
+    command: str,
+    filenames: List[str],
+    outcomes: List[Union[str, BaseException]],
+    dest_dir: str = None,
+) -> str:
+    """Collect the results of a batch into a new tar.gz and return its path.
+
+    `outcomes` tells, for each file, the path of its result (a tar.gz)
+    or the exception raised while processing it. The tar.gz is created
+    in `dest_dir` (by default, the system's temp dir).
+    """
+    manifest = {"command": command, "succeeded": 0, "failed": 0, "files": []}
+    fd, package = tempfile.mkstemp(suffix=".tar.gz", dir=dest_dir)
+    with os.fdopen(fd, "wb") as fileobj:
+        with tarfile.open(fileobj=fileobj, mode="w:gz") as tar:
+            for filename, name, outcome in zip(
+                filenames, result_names(filenames), outcomes
+            ):
+                entry = {"file": os.path.basename(filename)}
+                if isinstance(outcome, BaseException):
+                    manifest["failed"] += 1
+                    entry["outcome"] = type(outcome).__name__
+                    entry["error"] = str(outcome)
+                    entry["result"] = None
+                else:
+                    manifest["succeeded"] += 1
+                    entry["outcome"] = "success"
+                    entry["error"] = None
+                    entry["result"] = f"./{name}"
+                    _add_result(tar, outcome, name)
+                manifest["files"].append(entry)
+
+            content = json.dumps(manifest, indent=2).encode("utf-8")
+            info = tarfile.TarInfo(f"./{MANIFEST}")
+            info.size = len(content)
+            info.mtime = time.time()
+            tar.addfile(info, io.BytesIO(content))
+    return package
+
+
+def _add_result(tar: tarfile.TarFile, result: str, name: str):
+    """Copy the content of the tar.gz `result` into `tar`, under the directory `name`.
+
+    Results packaged otherwise (e.g. zip, see yakunin.packaging) are
+    added as they are.
+    """
+    if not tarfile.is_tarfile(result):
+        tar.add(result, arcname=f"./{name}/{os.path.basename(result)}")
+        return
+    with tarfile.open(result) as src:
+        for member in src:
+            fileobj = src.extractfile(member) if member.isfile() else None
+            member.name = "./" + posixpath.normpath(posixpath.join(name, member.name))
+            if member.islnk():
+                linkname = posixpath.join(name, member.linkname)
+                member.linkname = "./" + posixpath.normpath(linkname)
+            tar.addfile(member, fileobj)
+
+
+def process_batch(
+    command: str,
+    archive_paths: List[str],
+    options: Dict[str, Any],
+    max_workers: int = None,
+    cache: ResultCache = None,
+    limits: Limits = None,
+    scratch: Scratch = None,
+) -> str:
+    """Run the given Archive task on each of the given files, in parallel.
+
+    The files are processed by at most `max_workers` processes (by
+    default, as many as the cores). The failures are reported in the
+    manifest and do not stop the processing of the other files. `cache`,
+    `limits` and `scratch` are given to each Archive.
+
+    Return the path of a tar.gz with all the results (see
+    package_batch), created in the `scratch` space, that the caller
+    should remove.
+    """
+    outcomes = []
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = [
+            executor.submit(
+                run_task,
+                command,
+                path,
+                options,
+                cache=cache,
+                limits=limits,
+                scratch=scratch,
+            )
+            for path in archive_paths
+        ]
+        for future in futures:
+            try:
+                # (without the timings of the stages)
+                outcomes.append(future.result()[0])
+            except Exception as error:
+                outcomes.append(error)
+    try:
+        return package_batch(
+            command, archive_paths, outcomes, dest_dir=(scratch or Scratch()).disk_dir()
+        )
+    finally:
+        for outcome in outcomes:
+            if isinstance(outcome, str):
+                os.unlink(outcome)
@@ -0,0 +1,182 @@
+"""On-disk cache of the results of the tasks.
+
+The results (the packages returned by Archive.submission_archive) are
+stored under a key that depends only on the content of the received
+archive, on the task, on its options and on the version of yakunin.
+When the same work is requested again, the stored result is returned
+without unpacking or compiling anything.
+
+The cache is a plain directory, so it can be shared by several
+processes (e.g. the workers of the service). Entries are evicted, least
+recently used first, when the cache grows beyond its maximum size.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+from importlib import metadata
+from typing import Any, Dict, Optional
+
+from yakunin.lib import YAKUNIN_LOGGER
+from yakunin.packaging import CONTENT_TYPES
+from yakunin.packaging import suffix as package_suffix
+
+# options that do not change the result of a task
+IGNORED_OPTIONS = (
+    "archive",
+    "command",
+    "config_file",
+    "log",
+    "verify_env",
+    # the same files, just compressed differently
+    "package_level",
+    "package_threads",
+)
+
+# default maximum size of the cache (1 GiB)
+MAX_CACHE_SIZE = 1024**3
+
+CHUNK_SIZE = 1024 * 1024
+
+try:
+    VERSION = metadata.version("yakunin")
+except metadata.PackageNotFoundError:  # pragma: no cover
+    VERSION = "unknown"
+
+
+def file_digest(path: str) -> str:
+    """Return the SHA-256 of the content of the given file."""
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as src:
+        for chunk in iter(lambda: src.read(CHUNK_SIZE), b""):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def normalize_options(options: Dict[str, Any]) -> Dict[str, Any]:
+    """Keep the options that matter for the result, with normalized names."""
+    result = {}
+    for key, value in options.items():
+        key = key.replace("-", "_")
+        if key in IGNORED_OPTIONS or value is None:
+            continue
+        result[key] = value
+    return result
+
+
+def cache_key(digest: str, command: str, options: Dict[str, Any]) -> str:
+    """Return the key of the result of `command` on the archive with the given digest."""
+    description = json.dumps(
+        {
+            "archive": digest,
+            "command": command,
+            "options": normalize_options(options),
+            "version": VERSION,
+        },
+        sort_keys=True,
+        default=str,
+    )
+    return hashlib.sha256(description.encode("utf-8")).hexdigest()
+
+
+def task_key(archive_path: str, command: str, options: Dict[str, Any]) -> str:
+    """Return the key of the result of `command` on the given archive."""
+    return cache_key(file_digest(archive_path), command, options)
+
+
+class ResultCache:
+    """Keep at most `max_size` bytes of results in `directory`."""
+
+    def __init__(self, directory: str, max_size: int = MAX_CACHE_SIZE):
+        """Use (and create, if needed) the given directory."""
+        self.directory = directory
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key: str, suffix: str = ".tar.gz") -> str:
+        return os.path.join(self.directory, key + suffix)
+
+    def get(self, key: str, dest_dir: str = None) -> Optional[str]:
+        """Return a copy of the result stored under the given key, if any.
+
+        The copy is created in `dest_dir` (by default, the system's temp
+        dir) and belongs to the caller (who should remove it).
+        """
+        for suffix in CONTENT_TYPES:
+            try:
+                with open(self._path(key, suffix), "rb") as src:
+                    fd, result = tempfile.mkstemp(suffix=suffix, dir=dest_dir)
+                    with os.fdopen(fd, "wb") as dst:
+                        shutil.copyfileobj(src, dst, CHUNK_SIZE)
+                break
+            except FileNotFoundError:
+                continue
+        else:
+            self.misses += 1
+            return None
+        # remember that this entry has been used recently
+        try:
+            os.utime(self._path(key, suffix))
+        except FileNotFoundError:
+            pass
+        self.hits += 1
+        YAKUNIN_LOGGER.debug("Cache hit for %s", key)
+        return result
+
+    def put(self, key: str, result: str):
+        """Store a copy of the given result under the given key."""
+        fd, temp_name = tempfile.mkstemp(dir=self.directory, suffix=".part")
+        try:
+            with os.fdopen(fd, "wb") as dst, open(result, "rb") as src:
+                shutil.copyfileobj(src, dst, CHUNK_SIZE)
+            # readers never see a partial entry
+            os.replace(temp_name, self._path(key, package_suffix(result) or ".tar.gz"))
+        except BaseException:
+            os.unlink(temp_name)
+            raise
+        self.evict()
+
+    def entries(self):
+        """Return (mtime, size, path) of each stored result, oldest first."""
+        result = []
+        for entry in os.scandir(self.directory):
+            if package_suffix(entry.name) is None:
+                continue
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            result.append((stat.st_mtime, stat.st_size, entry.path))
+        return sorted(result)
+
+    def size(self) -> int:
+        """Return the size (in bytes) of the stored results."""
+        return sum(size for _, size, _ in self.entries())
+
+    def evict(self):
+        """Remove the least recently used results until the cache is small enough."""
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if total <= self.max_size:
+                break
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+            YAKUNIN_LOGGER.debug("Evicted %s from the cache", path)
+
+    def stats(self) -> Dict[str, int]:
+        """Report hits, misses and size."""
+        entries = self.entries()
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "entries": len(entries),
+            "size": sum(size for _, size, _ in entries),
+        }
@@ -0,0 +1,434 @@
+"""Client of the service: send many files and measure how it goes.
+
+yakunin-process sends files (or all the files in some directories) to
+the service, a given number at a time, over a pool of keep-alive
+connections. It saves the results and reports throughput and latency
+(p50, p95, p99), so that it can be used both for bulk processing and
+for capacity testing.
+
+The submissions can be recorded (--record) and replayed later
+(--replay). A record is a JSON-lines file with one submission per line,
+e.g.:
+
+    {"file": "paper.pdf", "command": "watermark", "ini": "wjs.ini", "at": 0.52}
+
+where `at` is when the submission was sent (seconds from the start).
+With --keep-pace, the replay sends each submission at the same time.
+"""
+
+import argparse
+import contextlib
+import datetime
+import email.utils
+import json
+import math
+import os
+import tempfile
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from typing import List
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from yakunin.packaging import CONTENT_TYPES, DEFAULT_FORMAT, SUFFIXES, suffix
+
+# see service.PORT
+DEFAULT_URL = "http://localhost:8889"
+
+CHUNK_SIZE = 64 * 1024
+
+# how long to wait before retrying, if the service does not tell (see retry_delay)
+DEFAULT_RETRY_DELAY = 1
+
+
+class Submission:
+    """A file to be processed by the service with the given command."""
+
+    def __init__(self, filename: str, command: str, ini: str = None, at: float = 0):
+        """Describe the submission; the outcome is filled in by Client.submit."""
+        self.filename = filename
+        self.command = command
+        self.ini = ini
+        self.at = at
+        self.status = None
+        self.error = None
+        self.latency = None
+        self.result = None
+
+    def succeeded(self) -> bool:
+        """Tell if the service processed the file."""
+        return self.status == 200
+
+    def as_dict(self) -> dict:
+        """Describe the submission (as recorded, see read_mix)."""
+        return {
+            "file": self.filename,
+            "command": self.command,
+            "ini": self.ini,
+            "at": round(self.at, 3),
+        }
+
+
+def collect_files(paths: List[str]) -> List[str]:
+    """Return the given files and the files in the given directories (recursively)."""
+    result = []
+    for path in paths:
+        if not os.path.isdir(path):
+            result.append(path)
+            continue
+        for dirpath, dirnames, filenames in os.walk(path):
+            dirnames.sort()
+            result.extend(os.path.join(dirpath, name) for name in sorted(filenames))
+    return result
+
+
+def read_mix(path: str) -> List[Submission]:
+    """Read the submissions recorded in the given file (see write_mix)."""
+    submissions = []
+    with open(path) as mix:
+        for line in mix:
+            if not line.strip():
+                continue
+            entry = json.loads(line)
+            submissions.append(
+                Submission(
+                    entry["file"],
+                    entry["command"],
+                    entry.get("ini"),
+                    entry.get("at", 0),
+                )
+            )
+    return submissions
+
+
+def write_mix(path: str, submissions: List[Submission]):
+    """Record the given submissions, in the order they were sent."""
+    with open(path, "w") as mix:
+        for submission in sorted(submissions, key=lambda s: s.at):
+            mix.write(json.dumps(submission.as_dict()) + "\n")
+
+
+def percentile(values: List[float], fraction: float) -> float:
+    """Return the given percentile (e.g. 0.95) of the values (nearest rank)."""
+    if not values:
+        return 0
+    values = sorted(values)
+    rank = min(max(1, math.ceil(fraction * len(values))), len(values))
+    return values[rank - 1]
+
+
+class Client:
+    """Send submissions to the service at `url`, `concurrency` at a time.
+
+    The results are saved in `output_dir` (if given). Refused
+    submissions (503) are sent again, after the delay asked by the
+    service, at most `retries` times.
+    """
+
+    def __init__(
+        self,
+        url: str = DEFAULT_URL,
+        concurrency: int = 1,
+        output_dir: str = None,
+        retries: int = 0,
+        timeout: float = None,
+    ):
+        """Prepare a pool of `concurrency` connections."""
+        self.url = url.rstrip("/")
+        self.concurrency = concurrency
+        self.output_dir = output_dir
+        self.retries = retries
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=concurrency)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.started = None
+        self.elapsed = None
+
+    def close(self):
+        """Close the connections."""
+        self.session.close()
+
+    def __enter__(self):
+        """Use the client as a context manager (closing the connections at the end)."""
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        """Close the connections."""
+        self.close()
+
+    def run(
+        self, submissions: List[Submission], keep_pace: bool = False
+    ) -> List[Submission]:
+        """Send all the submissions and wait for the results.
+
+        If `keep_pace` is True, each submission is sent `at` seconds
+        after the start (or as soon as a connection is free).
+        """
+        names = output_names(submissions)
+        self.started = time.monotonic()
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            futures = []
+            for submission, name in zip(submissions, names):
+                if keep_pace:
+                    delay = self.started + submission.at - time.monotonic()
+                    if delay > 0:
+                        time.sleep(delay)
+                futures.append(executor.submit(self.submit, submission, name))
+            for future in futures:
+                future.result()
+        self.elapsed = time.monotonic() - self.started
+        return submissions
+
+    def submit(self, submission: Submission, name: str = None) -> Submission:
+        """Send the submission and record its outcome.
+
+        The result is saved in `output_dir` as `name` (by default, the
+        name of the file followed by the command).
+        """
+        name = name or f"{os.path.basename(submission.filename)}.{submission.command}"
+        start = time.monotonic()
+        if self.started is not None:
+            submission.at = start - self.started
+        for attempt in range(self.retries + 1):
+            try:
+                response = self._post(submission)
+            except (OSError, requests.RequestException) as error:
+                submission.error = str(error)
+                break
+            with response:
+                submission.status = response.status_code
+                if response.status_code == 503 and attempt < self.retries:
+                    time.sleep(retry_delay(response.headers.get("Retry-After")))
+                    continue
+                if not submission.succeeded():
+                    submission.error = response.reason
+                    break
+                submission.error = None
+                submission.result = self._save(response, name + result_suffix(response))
+                break
+        submission.latency = time.monotonic() - start
+        return submission
+
+    def _post(self, submission: Submission) -> requests.Response:
+        with contextlib.ExitStack() as stack:
+            files = {
+                "file": (
+                    os.path.basename(submission.filename),
+                    stack.enter_context(open(submission.filename, "rb")),
+                )
+            }
+            if submission.ini:
+                files["ini"] = (
+                    os.path.basename(submission.ini),
+                    stack.enter_context(open(submission.ini, "rb")),
+                )
+            return self.session.post(
+                f"{self.url}/task/{submission.command}",
+                files=files,
+                stream=True,
+                timeout=self.timeout,
+            )
+
+    def _save(self, response: requests.Response, name: str) -> str:
+        """Write the body of the response in the output dir (or just read it)."""
+        if self.output_dir is None:
+            for _ in response.iter_content(CHUNK_SIZE):
+                pass
+            return None
+        path = os.path.join(self.output_dir, name)
+        with open(path, "wb") as result:
+            for chunk in response.iter_content(CHUNK_SIZE):
+                result.write(chunk)
+        return path
+
+
+def retry_delay(retry_after: str = None) -> float:
+    """Return how many seconds to wait, according to the given Retry-After header.
+
+    The header is a number of seconds or an HTTP date; if it is missing
+    or invalid, wait DEFAULT_RETRY_DELAY seconds.
+    """
+    if retry_after is None:
+        return DEFAULT_RETRY_DELAY
+    try:
+        delay = float(retry_after)
+    except ValueError:
+        pass
+    else:
+        return max(0.0, delay) if math.isfinite(delay) else DEFAULT_RETRY_DELAY
+    try:
+        date = email.utils.parsedate_to_datetime(retry_after)
+    except (TypeError, ValueError):
+        return DEFAULT_RETRY_DELAY
+    if date.tzinfo is None:
+        # (HTTP dates are in GMT)
+        date = date.replace(tzinfo=datetime.timezone.utc)
+    now = datetime.datetime.now(datetime.timezone.utc)
+    return max(0.0, (date - now).total_seconds())
+
+
+def result_suffix(response: requests.Response) -> str:
+    """Return the suffix of the package sent back (e.g. ".zip").
+
+    The suffix is taken from the name of the attachment or else from its
+    content type.
+    """
+    disposition = response.headers.get("Content-Disposition", "")
+    known = suffix(disposition.rstrip('"'))
+    if known is None:
+        content_type = response.headers.get("Content-Type", "").split(";")[0].strip()
+        types = {value: key for key, value in CONTENT_TYPES.items()}
+        known = types.get(content_type, SUFFIXES[DEFAULT_FORMAT])
+    return known
+
+
+def output_names(submissions: List[Submission]) -> List[str]:
+    """Name the result of each submission after the file and the command.
+
+    Submissions with the same name get a prefix with their position.
+    """
+    names = [
+        f"{os.path.basename(submission.filename)}.{submission.command}"
+        for submission in submissions
+    ]
+    return [
+        f"{index}-{name}" if names.count(name) > 1 else name
+        for index, name in enumerate(names)
+    ]
+
+
+def report(submissions: List[Submission], elapsed: float, concurrency: int) -> str:
+    """Summarize throughput, outcomes and latency of the submissions."""
+    latencies = [s.latency for s in submissions if s.latency is not None]
+    failures = Counter(
+        str(s.status or s.error) for s in submissions if not s.succeeded()
+    )
+    lines = [
+        f"Sent {len(submissions)} requests in {elapsed:.2f}s"
+        f" ({len(submissions) / elapsed if elapsed else 0:.2f} requests/s)"
+        f" with concurrency {concurrency}",
+        f"Succeeded: {len(submissions) - sum(failures.values())},"
+        f" failed: {sum(failures.values())}",
+    ]
+    for failure, count in sorted(failures.items()):
+        lines.append(f"  {failure}: {count}")
+    lines.append(
+        "Latency:"
+        f" p50 {percentile(latencies, 0.50):.3f}s,"
+        f" p95 {percentile(latencies, 0.95):.3f}s,"
+        f" p99 {percentile(latencies, 0.99):.3f}s,"
+        f" max {max(latencies, default=0):.3f}s"
+    )
+    return "\n".join(lines)
+
+
+def make_parser() -> argparse.ArgumentParser:
+    """Build the command-line parser."""
+    parser = argparse.ArgumentParser(
+        "yakunin-process",
+        description="Send files to the yakunin service and report how it goes.",
+    )
+    parser.add_argument(
+        "filenames", nargs="*", help="Files (or directories of files) to send."
+    )
+    parser.add_argument("--ini", help="Optional ini file (the same for all files).")
+    parser.add_argument(
+        "--command",
+        default="watermark",
+        help="Command to apply. Defaults to %(default)s.",
+    )
+    parser.add_argument(
+        "--url",
+        default=DEFAULT_URL,
+        help="Where the service is. Defaults to %(default)s.",
+    )
+    parser.add_argument(
+        "-j",
+        "--concurrency",
+        type=int,
+        default=1,
+        help="How many requests to send at once. Defaults to %(default)s.",
+    )
+    parser.add_argument(
+        "--repeat",
+        type=int,
+        default=1,
+        help="Send everything this many times (e.g. to generate load).",
+    )
+    parser.add_argument(
+        "--retries",
+        type=int,
+        default=0,
+        help="How many times to retry refused (503) requests. Defaults to %(default)s.",
+    )
+    parser.add_argument(
+        "--timeout", type=float, help="How many seconds to wait for each response."
+    )
+    output = parser.add_mutually_exclusive_group()
+    output.add_argument(
+        "--output-dir",
+        help="Where to save the results. Defaults to a new temporary directory.",
+    )
+    output.add_argument(
+        "--discard",
+        action="store_true",
+        help="Do not save the results (e.g. for capacity testing).",
+    )
+    parser.add_argument("--record", help="Record the submissions in this file.")
+    parser.add_argument(
+        "--replay", help="Send the submissions recorded in this file (see --record)."
+    )
+    parser.add_argument(
+        "--keep-pace",
+        action="store_true",
+        help="When replaying, send the submissions with the recorded timing.",
+    )
+    return parser
+
+
+def main() -> int:
+    """Send files to the service.
+
+    Useful as shell entry point.
+    """
+    parser = make_parser()
+    args = parser.parse_args()
+    if args.replay:
+        submissions = read_mix(args.replay)
+    else:
+        submissions = [
+            Submission(filename, args.command, args.ini)
+            for filename in collect_files(args.filenames)
+        ]
+    if not submissions:
+        parser.error("Nothing to send: give some files or a recorded mix.")
+    submissions = [
+        Submission(s.filename, s.command, s.ini, s.at)
+        for _ in range(args.repeat)
+        for s in submissions
+    ]
+
+    output_dir = None
+    if not args.discard:
+        output_dir = args.output_dir or tempfile.mkdtemp(prefix="yakunin-")
+        os.makedirs(output_dir, exist_ok=True)
+
+    with Client(
+        args.url,
+        concurrency=args.concurrency,
+        output_dir=output_dir,
+        retries=args.retries,
+        timeout=args.timeout,
+    ) as client:
+        client.run(submissions, keep_pace=args.keep_pace)
+    if args.record:
+        write_mix(args.record, submissions)
+
+    print(report(submissions, client.elapsed, args.concurrency))
+    if output_dir:
+        print(f"Results in {output_dir}")
+    return 0 if all(s.succeeded() for s in submissions) else 1
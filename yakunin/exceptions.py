@@ -5,9 +5,25 @@ class UnknownArchiveFormat(Exception):
     "x"
 
 
+class ExtractionLimitExceeded(UnknownArchiveFormat):
+    "x"
+
+
 class NoTeXMaster(Exception):
     "x"
 
 
 class PDFGenerationFailure(Exception):
     "x"
+
+
+class InvalidTaskOptions(Exception):
+    "x"
+
+
+class TaskCancelled(Exception):
+    "x"
+
+
+class ScratchSpaceExceeded(Exception):
+    "x"
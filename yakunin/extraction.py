@@ -0,0 +1,553 @@
+"""Extraction of the received archives (see Archive._unpack_archive).
+
+The formats are those of the "formato" of an Archive (see epatografo):
+tar, tar.gz and tar.bz2 files are read, decompressed and extracted in a
+single streaming pass, that also computes the digest of the archive
+(see yakunin.cache); gz and bz2 files are decompressed in the same way.
+zip files need random access (their index is at the end), while rar
+files are left to patool.
+
+What has been extracted is recorded in a Manifest, so that the later
+stages do not need to look for it (e.g. find_master) or to read the
+archive again (e.g. the cache key of a task).
+
+Archives are not trusted: each member is checked against the Limits
+(total size, compression ratio, number of members, depth of the paths)
+before it is written, and members or links that point outside of the
+work dir are refused. The extraction stops at the first violation,
+with ExtractionLimitExceeded. Files decompressed on the fly (gz, bz2)
+are counted while they are written; rar files, extracted by patool,
+can only be checked afterwards.
+
+Tar files can also be extracted while they are still being received
+(see StreamedExtraction): the service does so for its uploads, and
+hands the result (an Extracted) to the Archive of the task.
+"""
+
+import bz2
+import gzip
+import hashlib
+import os
+import re
+import shutil
+import tarfile
+import threading
+import zipfile
+import zlib
+from concurrent.futures import Future
+from typing import Any, Dict, List, Optional
+
+from yakunin.cache import CHUNK_SIZE, file_digest
+from yakunin.exceptions import ExtractionLimitExceeded, TaskCancelled
+from yakunin.lib import YAKUNIN_LOGGER, place_file, use_patool
+from yakunin.mime import TAR_HEADER_SIZE, is_tar_header
+
+# kinds of members
+FILE = "file"
+DIRECTORY = "directory"
+LINK = "link"
+OTHER = "other"
+
+
+def _gunzip(fileobj) -> gzip.GzipFile:
+    # (unlike tarfile's "r|gz", GzipFile reads multi-member files, such as
+    # those of yakunin.packaging)
+    return gzip.GzipFile(fileobj=fileobj, mode="rb")
+
+
+# the formats whose archives are read only once (tar, possibly
+# compressed) and how to decompress them
+STREAMED_TARS = {"tar": None, "gztar": _gunzip, "bztar": bz2.BZ2File}
+# single compressed files, and the suffixes to remove from their names
+COMPRESSED_FILES = {
+    "gz": (_gunzip, re.compile(r"(\.gz)?$", re.IGNORECASE)),
+    "bz": (bz2.BZ2File, re.compile(r"(\.bz2)?$", re.IGNORECASE)),
+}
+
+# how compressed tar files begin (see StreamedExtraction)
+COMPRESSED_TAR_MAGIC = {"gztar": b"\x1f\x8b", "bztar": b"BZh"}
+# how often a GrowingFile looks for new data
+GROWING_FILE_INTERVAL = 0.05
+
+# errors of broken archives (reported as shutil.ReadError, as
+# shutil.unpack_archive does)
+ARCHIVE_ERRORS = (tarfile.TarError, zipfile.BadZipFile, zlib.error, EOFError)
+
+# default limits of an extraction (see Limits)
+MAX_UNPACKED_SIZE = 2 * 1024 * 1024 * 1024
+MAX_COMPRESSION_RATIO = 100
+MAX_MEMBERS = 10000
+MAX_PATH_DEPTH = 32
+# extractions smaller than this are not checked for their compression
+# ratio (a few MB of TeX sources can easily compress 20:1 or more)
+RATIO_GRACE = 64 * 1024 * 1024
+
+# python >= 3.12 warns when tar files are extracted without a filter
+TAR_FILTER = {"filter": "fully_trusted"} if hasattr(tarfile, "data_filter") else {}
+
+
+class Limits:
+    """How far the extraction of an archive can go.
+
+    `max_size` is the total of the bytes extracted, `max_ratio` the
+    largest acceptable ratio between that total and the size of the
+    archive, `max_members` the number of files, directories and links,
+    and `max_depth` the number of components of their paths.
+    """
+
+    # the names of the limits in the configuration (see from_config)
+    CONFIG_KEYS = {
+        "max_unpacked_size": "max_size",
+        "max_compression_ratio": "max_ratio",
+        "max_members": "max_members",
+        "max_path_depth": "max_depth",
+    }
+
+    def __init__(
+        self,
+        max_size: int = MAX_UNPACKED_SIZE,
+        max_ratio: float = MAX_COMPRESSION_RATIO,
+        max_members: int = MAX_MEMBERS,
+        max_depth: int = MAX_PATH_DEPTH,
+    ):
+        """Set the limits (the defaults are the module's constants)."""
+        self.max_size = max_size
+        self.max_ratio = max_ratio
+        self.max_members = max_members
+        self.max_depth = max_depth
+
+    @classmethod
+    def from_config(cls, config: Dict[str, Any]) -> "Limits":
+        """Read the limits from `config` (e.g. the GENERAL section of the config file).
+
+        Missing limits take their default values.
+        """
+        kwargs = {}
+        for key, value in config.items():
+            name = cls.CONFIG_KEYS.get(key.replace("-", "_"))
+            if name is not None and value is not None:
+                kwargs[name] = float(value) if name == "max_ratio" else int(value)
+        return cls(**kwargs)
+
+    def check_path(self, path: str):
+        """Refuse paths (normalized, relative to the work dir) that are out of bounds."""
+        if (
+            os.path.isabs(path)
+            or path == os.pardir
+            or path.startswith(os.pardir + os.sep)
+        ):
+            self.exceeded(f'"{path}" is outside of the work dir')
+        if path.count(os.sep) >= self.max_depth:
+            self.exceeded(f'"{path}" is deeper than {self.max_depth} directories')
+
+    def check_real_path(self, work_dir: str, path: str):
+        """Refuse paths (relative to `work_dir`) that lead outside of it on disk.
+
+        Unlike check_path, this follows the links already extracted
+        (e.g. "b" -> "." and then "b/c" -> "..").
+        """
+        real_work_dir = os.path.realpath(work_dir)
+        real_path = os.path.realpath(os.path.join(work_dir, path))
+        if real_path != real_work_dir and not real_path.startswith(
+            real_work_dir + os.sep
+        ):
+            self.exceeded(f'"{path}" is outside of the work dir')
+
+    def check(self, manifest: "Manifest", pending: int = 0):
+        """Refuse extractions that are too big (counting `pending` bytes still to be recorded)."""
+        if len(manifest.members) > self.max_members:
+            self.exceeded(f"more than {self.max_members} members")
+        size = manifest.size + pending
+        if size > self.max_size:
+            self.exceeded(f"more than {self.max_size} bytes")
+        if size > RATIO_GRACE and size > self.max_ratio * manifest.packed_size:
+            self.exceeded(f"compression ratio above {self.max_ratio:g}")
+
+    @staticmethod
+    def exceeded(reason: str):
+        """Stop the extraction."""
+        raise ExtractionLimitExceeded(f"Extraction stopped: {reason}")
+
+
+class Manifest:
+    """The members extracted from an archive, and the digest of the archive.
+
+    `members` is a list of (path, size, kind) tuples, in the order of
+    the archive, with paths relative to the directory of the
+    extraction. Members are checked against `limits` as they are
+    recorded (see Limits).
+    """
+
+    def __init__(self, source: str, archive_format: str, limits: Limits = None):
+        """Describe the extraction of the file `source`, as `archive_format`."""
+        self.source = source
+        self.format = archive_format
+        self.limits = limits or Limits()
+        self.members = []
+        # (see size)
+        self._size = 0
+        # (see digest)
+        self._digest = None
+
+    def add(self, path: str, size: int = 0, kind: str = FILE, target: str = None):
+        """Record a member (`target` is where a link points, relative to the work dir)."""
+        path = os.path.normpath(path)
+        if path == ".":
+            return
+        self.limits.check_path(path)
+        if target is not None:
+            self.limits.check_path(os.path.normpath(target))
+        self.members.append((path, size, kind))
+        self._size += size
+        self.limits.check(self)
+
+    @property
+    def digest(self) -> str:
+        """The SHA-256 of the archive (computed now, if not during the extraction)."""
+        if self._digest is None:
+            self._digest = file_digest(self.source)
+        return self._digest
+
+    @digest.setter
+    def digest(self, value: str):
+        self._digest = value
+
+    @property
+    def size(self) -> int:
+        """How many bytes have been extracted."""
+        return self._size
+
+    @property
+    def packed_size(self) -> int:
+        """The size of the archive (so far, if it is still being received)."""
+        return os.path.getsize(self.source)
+
+    def files(self) -> List[str]:
+        """Return the paths of the files, but not those of hidden ones (as glob)."""
+        return [
+            path
+            for path, _, kind in self.members
+            if kind in (FILE, LINK)
+            and not any(part.startswith(".") for part in path.split(os.sep))
+        ]
+
+
+class HashingReader:
+    """A file-like object that computes the digest of what is read through it."""
+
+    def __init__(self, fileobj):
+        """Read from `fileobj`."""
+        self.fileobj = fileobj
+        self.sha256 = hashlib.sha256()
+
+    def read(self, size: int = -1) -> bytes:
+        """Read (and hash) at most `size` bytes."""
+        data = self.fileobj.read(size)
+        self.sha256.update(data)
+        return data
+
+    def hexdigest(self) -> str:
+        """Read (and hash) what is left and return the digest of the whole file."""
+        for _ in iter(lambda: self.read(CHUNK_SIZE), b""):
+            pass
+        return self.sha256.hexdigest()
+
+
+class GrowingFile:
+    """A binary file that someone else is still writing (think of "tail -f").
+
+    `read` waits until some data has been written, unless `finished` (a
+    threading.Event) is set: then it behaves as the read of a normal
+    file. Once `aborted` (another Event) is set, `read` raises
+    TaskCancelled.
+    """
+
+    def __init__(
+        self,
+        fileobj,
+        finished: threading.Event,
+        aborted: threading.Event = None,
+        interval=GROWING_FILE_INTERVAL,
+    ):
+        """Follow the given file, until `finished` is set."""
+        self.fileobj = fileobj
+        self.finished = finished
+        self.aborted = aborted
+        self.interval = interval
+
+    def read(self, size: int = -1) -> bytes:
+        """Return at most `size` bytes (waiting for the first one, if needed)."""
+        while True:
+            if self.aborted is not None and self.aborted.is_set():
+                raise TaskCancelled("Stopped reading a growing file")
+            # look before reading: what was written before the end is read
+            finished = self.finished.is_set()
+            data = self.fileobj.read(size)
+            if data or finished:
+                return data
+            self.finished.wait(self.interval)
+
+
+class Extracted:
+    """An archive extracted elsewhere (see StreamedExtraction).
+
+    It can be sent to other processes, where it is adopted by a work
+    dir. If the extraction went beyond its limits, `error` is the
+    ExtractionLimitExceeded that stopped it.
+    """
+
+    def __init__(
+        self,
+        directory: str,
+        archive_format: str,
+        manifest: Manifest = None,
+        error: ExtractionLimitExceeded = None,
+    ):
+        """Describe what has been extracted into `directory`."""
+        self.directory = directory
+        self.format = archive_format
+        self.manifest = manifest
+        self.error = error
+
+    def adopt(self, work_dir: str, source: str) -> Manifest:
+        """Move the extracted files into `work_dir`, as if `source` had been extracted there."""
+        if self.error is not None:
+            raise self.error
+        for name in os.listdir(self.directory):
+            shutil.move(os.path.join(self.directory, name), work_dir)
+        os.rmdir(self.directory)
+        self.manifest.source = source
+        return self.manifest
+
+
+class StreamedExtraction:
+    """Extract a tar file (possibly compressed) while it is being written.
+
+    The file `path` is written by someone else, who calls `finish` when
+    it is complete (or `abort`, to give up). Meanwhile, a thread reads
+    what has been written and extracts it into `directory` (as extract
+    does, with the given limits).
+
+    `future` (a concurrent.futures.Future) ends with an Extracted or
+    with None, if the file is not a tar file or cannot be extracted
+    (and should be extracted again, as usual).
+    """
+
+    def __init__(self, path: str, directory: str, limits: Limits = None):
+        """Start following and extracting the file `path`."""
+        self.path = path
+        self.directory = directory
+        self.limits = limits
+        self.future = Future()
+        self._finished = threading.Event()
+        self._aborted = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def finish(self):
+        """Tell that the whole file has been written."""
+        self._finished.set()
+
+    def abort(self):
+        """Stop the extraction (and wait for it to stop)."""
+        self._aborted.set()
+        self._finished.set()
+        self._thread.join()
+
+    def _run(self):
+        archive_format = None
+        result = None
+        try:
+            archive_format = self._format()
+            if archive_format is not None:
+                manifest = Manifest(self.path, archive_format, self.limits)
+                with open(self.path, "rb") as raw:
+                    _extract_tar_stream(
+                        GrowingFile(raw, self._finished, self._aborted),
+                        self.directory,
+                        manifest,
+                    )
+                result = Extracted(self.directory, archive_format, manifest)
+        except ExtractionLimitExceeded as error:
+            result = Extracted(self.directory, archive_format, error=error)
+        except Exception as error:
+            if not self._aborted.is_set():
+                YAKUNIN_LOGGER.warning(
+                    "Cannot unpack %s while receiving it: %s", self.path, error
+                )
+        finally:
+            if self._aborted.is_set():
+                result = None
+            if result is None or result.error is not None:
+                # don't keep what has been extracted so far
+                shutil.rmtree(self.directory, ignore_errors=True)
+            self.future.set_result(result)
+
+    def _format(self) -> Optional[str]:
+        """Tell (by its first header) if the file is a tar file, and how compressed."""
+        with open(self.path, "rb") as raw:
+            fileobj = GrowingFile(raw, self._finished, self._aborted)
+            head = _read_fully(fileobj, TAR_HEADER_SIZE)
+            for archive_format, magic in COMPRESSED_TAR_MAGIC.items():
+                if head.startswith(magic):
+                    raw.seek(0)
+                    stream = STREAMED_TARS[archive_format](fileobj)
+                    try:
+                        header = _read_fully(stream, TAR_HEADER_SIZE)
+                    except (OSError, EOFError, zlib.error):
+                        return None
+                    return archive_format if is_tar_header(header) else None
+        return "tar" if is_tar_header(head) else None
+
+
+def _read_fully(fileobj, size: int) -> bytes:
+    """Read `size` bytes (or less, at the end of the file)."""
+    data = b""
+    for chunk in iter(lambda: fileobj.read(size - len(data)), b""):
+        data += chunk
+        if len(data) == size:
+            break
+    return data
+
+
+def extract(
+    src: str, work_dir: str, archive_format: str, limits: Limits = None
+) -> Manifest:
+    """Extract the archive `src` (in the given format) into `work_dir`.
+
+    Raise ExtractionLimitExceeded as soon as the archive goes beyond
+    `limits` (by default, those of Limits()).
+    """
+    manifest = Manifest(src, archive_format, limits)
+    try:
+        if archive_format in STREAMED_TARS:
+            _extract_tar(src, work_dir, manifest)
+        elif archive_format in COMPRESSED_FILES:
+            _decompress(src, work_dir, manifest)
+        elif archive_format == "zip":
+            _extract_zip(src, work_dir, manifest)
+        elif archive_format == "copy":
+            name = os.path.basename(src)
+            place_file(src, os.path.join(work_dir, name))
+            manifest.add(name, os.path.getsize(src))
+        elif archive_format == "any":
+            use_patool(src, work_dir)
+            _walk(work_dir, manifest)
+        else:
+            raise shutil.ReadError(f"Unknown archive format {archive_format}")
+    except ARCHIVE_ERRORS as error:
+        raise shutil.ReadError(f"{src} is not a valid {archive_format}: {error}")
+    return manifest
+
+
+def _extract_tar(src: str, work_dir: str, manifest: Manifest):
+    with open(src, "rb") as raw:
+        _extract_tar_stream(raw, work_dir, manifest)
+
+
+def _extract_tar_stream(raw, work_dir: str, manifest: Manifest):
+    """Extract the tar file read from `raw` (in one pass, no seeking)."""
+    reader = HashingReader(raw)
+    decompressor = STREAMED_TARS[manifest.format]
+    stream = reader if decompressor is None else decompressor(reader)
+    with tarfile.open(fileobj=stream, mode="r|") as tar:
+        tar.extractall(
+            work_dir, members=_recorded(tar, manifest, work_dir), **TAR_FILTER
+        )
+    manifest.digest = reader.hexdigest()
+
+
+def _recorded(tar: tarfile.TarFile, manifest: Manifest, work_dir: str):
+    """Yield the members of the (streamed) tar file, recording them.
+
+    Each member is checked against what has been extracted into
+    `work_dir` so far (see Limits.check_real_path) just before it is
+    extracted.
+    """
+    limits = manifest.limits
+    for member in tar:
+        target = None
+        if member.isreg():
+            manifest.add(member.name, member.size)
+        elif member.isdir():
+            manifest.add(member.name, kind=DIRECTORY)
+        elif member.issym():
+            target = os.path.join(os.path.dirname(member.name), member.linkname)
+            manifest.add(member.name, kind=LINK, target=target)
+        elif member.islnk():
+            # (hard links point to a previous member)
+            target = member.linkname
+            manifest.add(member.name, kind=LINK, target=target)
+        else:
+            manifest.add(member.name, kind=OTHER)
+        limits.check_real_path(work_dir, os.path.dirname(member.name))
+        if not member.issym():
+            # (files are written, and dirs changed, through existing links)
+            limits.check_real_path(work_dir, member.name)
+        if target is not None:
+            limits.check_real_path(work_dir, target)
+        yield member
+
+
+def _decompress(src: str, work_dir: str, manifest: Manifest):
+    decompressor, suffix = COMPRESSED_FILES[manifest.format]
+    name = suffix.sub("", os.path.basename(src))
+    written = 0
+    with open(src, "rb") as raw:
+        reader = HashingReader(raw)
+        with decompressor(reader) as stream, open(
+            os.path.join(work_dir, name), "wb"
+        ) as dst:
+            # (the size is not known in advance: count it on the way)
+            for chunk in iter(lambda: stream.read(CHUNK_SIZE), b""):
+                written += len(chunk)
+                manifest.limits.check(manifest, pending=written)
+                dst.write(chunk)
+        manifest.digest = reader.hexdigest()
+    manifest.add(name, written)
+
+
+def _extract_zip(src: str, work_dir: str, manifest: Manifest):
+    # as shutil.unpack_archive does (but absolute paths or paths with ..
+    # in them are refused by the manifest, instead of being skipped)
+    with zipfile.ZipFile(src) as zip_file:
+        for info in zip_file.infolist():
+            name = info.filename
+            if info.is_dir():
+                manifest.add(name, kind=DIRECTORY)
+            else:
+                # (zipfile never reads more than the declared size)
+                manifest.add(name, info.file_size)
+            target = os.path.join(work_dir, *name.split("/"))
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            if info.is_dir():
+                continue
+            with zip_file.open(info) as member, open(target, "wb") as dst:
+                shutil.copyfileobj(member, dst, CHUNK_SIZE)
+
+
+def _walk(work_dir: str, manifest: Manifest):
+    """Record what has been extracted by someone else."""
+    for dirpath, dirnames, filenames in os.walk(work_dir):
+        for name in sorted(dirnames):
+            path = os.path.join(dirpath, name)
+            if os.path.islink(path):
+                _add_link(manifest, path, work_dir)
+            else:
+                manifest.add(os.path.relpath(path, work_dir), kind=DIRECTORY)
+        for name in sorted(filenames):
+            path = os.path.join(dirpath, name)
+            if os.path.islink(path):
+                _add_link(manifest, path, work_dir)
+            else:
+                size = os.path.getsize(path)
+                manifest.add(os.path.relpath(path, work_dir), size)
+
+
+def _add_link(manifest: Manifest, path: str, work_dir: str):
+    target = os.path.join(os.path.dirname(path), os.readlink(path))
+    manifest.add(
+        os.path.relpath(path, work_dir),
+        kind=LINK,
+        target=os.path.relpath(target, work_dir),
+    )
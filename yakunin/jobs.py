@@ -0,0 +1,189 @@
+"""Bookkeeping of the tasks submitted asynchronously to the service."""
+
+import os
+import shutil
+import time
+import uuid
+from typing import Dict, Optional
+
+from yakunin.lib import YAKUNIN_LOGGER
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+CANCELLED = "cancelled"
+
+
+class JobStoreFull(Exception):
+    """There is no room for new jobs (all jobs are still running)."""
+
+
+class Job:
+    """A task submitted to the service.
+
+    The job owns the directory where the received file has been saved
+    and, once done, the resulting archive. Both are removed by `cleanup`,
+    when all their `users` are done with them (see JobStore.release).
+    """
+
+    def __init__(self, command: str, temp_dir: str):
+        """Create a queued job."""
+        self.id = uuid.uuid4().hex
+        self.command = command
+        self.temp_dir = temp_dir
+        self.state = QUEUED
+        self.stage = None
+        # where the workers record the stage (see JobStore): a job that
+        # shares the task of another job follows the stages of that job
+        self.stage_key = self.id
+        # where the Archive of the task works (and writes its task log);
+        # again, the directory of the job that started the task
+        self.work_dir = temp_dir
+        # the job itself and, if its task is shared, the flight of the task
+        self.users = 1
+        self.result = None
+        self.error = None
+        # the future of the task (see service_handlers.Jobs)
+        self.execution = None
+        self.created = time.time()
+        self.finished = None
+
+    def set_stage(self, stage: str):
+        """Record the stage that the worker is running."""
+        self.stage = stage
+        if self.state == QUEUED:
+            self.state = RUNNING
+
+    def done(self, future):
+        """Collect the outcome of the worker (to be used as done-callback)."""
+        self.finished = time.time()
+        if future.cancelled():
+            self.state = CANCELLED
+            return
+        try:
+            self.result = future.result()
+        except Exception as exception:
+            YAKUNIN_LOGGER.error("Job %s failed: %s", self.id, exception)
+            self.state = FAILED
+            self.error = f"{type(exception).__name__}: {exception}"
+        else:
+            self.state = DONE
+
+    def is_finished(self) -> bool:
+        """Tell if the job is done (successfully or not)."""
+        return self.state in (DONE, FAILED, CANCELLED)
+
+    def cancel(self):
+        """Stop waiting for the task (see service_handlers.Jobs).
+
+        The task goes on if other jobs share it: the job is finished, but
+        its files are kept until the task is done (see JobStore.release).
+        """
+        if self.is_finished():
+            return
+        self.state = CANCELLED
+        if self.finished is None:
+            self.finished = time.time()
+        if self.execution is not None:
+            self.execution.cancel()
+
+    def as_dict(self) -> Dict:
+        """Describe the job (e.g. for a json response)."""
+        return {
+            "id": self.id,
+            "command": self.command,
+            "state": self.state,
+            "stage": self.stage,
+            "error": self.error,
+            "created": self.created,
+            "finished": self.finished,
+        }
+
+    def cleanup(self):
+        """Remove the received file and the result."""
+        if self.temp_dir and os.path.exists(self.temp_dir):
+            # the task may have moved its dir to disk, leaving a link
+            # behind (see Archive._spill)
+            for entry in os.scandir(self.temp_dir):
+                if entry.is_symlink() and os.path.isdir(entry.path):
+                    shutil.rmtree(os.path.realpath(entry.path))
+            shutil.rmtree(self.temp_dir)
+        if self.result and os.path.exists(self.result):
+            os.unlink(self.result)
+
+
+class JobStore:
+    """Keep at most `max_jobs` jobs.
+
+    Finished jobs are forgotten (and their files removed) `ttl` seconds
+    after they finish, or earlier if room is needed for new jobs.
+    """
+
+    def __init__(self, max_jobs: int = 100, ttl: float = 3600, stages=None):
+        """Set the limits of the store.
+
+        `stages`, when given, is a dict-like object shared with the
+        worker processes, where they record the stage of each job (by id).
+        """
+        self.max_jobs = max_jobs
+        self.ttl = ttl
+        self.stages = stages
+        self.jobs: Dict[str, Job] = {}
+
+    def add(self, job: Job):
+        """Store a new job, making room if necessary."""
+        self.expire()
+        if len(self.jobs) >= self.max_jobs:
+            # (a cancelled job may only have left a task that other jobs
+            # share: removing it does not free its files, see release)
+            finished = sorted(
+                (j for j in self.jobs.values() if j.is_finished()),
+                key=lambda j: (j.users > 1, j.finished),
+            )
+            if not finished:
+                raise JobStoreFull()
+            self.remove(finished[0].id)
+        self.jobs[job.id] = job
+
+    def get(self, job_id: str) -> Optional[Job]:
+        """Return the job with the given id (or None)."""
+        self.expire()
+        job = self.jobs.get(job_id)
+        if job is not None and self.stages is not None:
+            stage = self.stages.get(job.stage_key)
+            if stage is not None:
+                job.set_stage(stage)
+        return job
+
+    def remove(self, job_id: str):
+        """Forget a job and remove its files (unless its task is still shared)."""
+        job = self.jobs.pop(job_id)
+        YAKUNIN_LOGGER.debug("Removing job %s", job_id)
+        self.release(job)
+
+    def release(self, job: Job):
+        """Tell that one of the users of the files and the stage of the job is done.
+
+        The jobs that share the task of the job follow the task in the
+        dir of the job and under its stage key: these are removed only
+        when nobody uses them any more.
+        """
+        job.users -= 1
+        if job.users > 0:
+            YAKUNIN_LOGGER.debug("Keeping the files of job %s (shared)", job.id)
+            return
+        if self.stages is not None:
+            self.stages.pop(job.id, None)
+        job.cleanup()
+
+    def expire(self):
+        """Forget the jobs that finished more than `ttl` seconds ago."""
+        now = time.time()
+        expired = [
+            job.id
+            for job in self.jobs.values()
+            if job.is_finished() and now - job.finished > self.ttl
+        ]
+        for job_id in expired:
+            self.remove(job_id)
@@ -1,25 +1,214 @@
 "Extract, compile & watermark WJ TeX archives"
 
 import bz2
+import contextlib
+import contextvars
+import fcntl
 import gzip
 import logging
 import os
 import re
 import shutil
 import subprocess
-import tempfile
+import time
 import xml.etree.ElementTree as et  # NOQA N813
 from typing import List
 
 import patoolib
 
 from yakunin.exceptions import UnknownArchiveFormat
+from yakunin.mime import TAR_HEADER_SIZE, is_tar_header, sniff
 
 YAKUNIN_LOGGER = logging.getLogger("yakunin")
 TASK_LOGGER = logging.getLogger("yakunin.task")
 TASK_LOG = "yakunin-task.log"
 PITSTOP_NS = {"tr": "http://www.enfocus.com/PitStop/13/PitStopServerCLI_TaskReport.xsd"}
 
+# ioctl that clones a file on copy-on-write filesystems (btrfs, xfs...);
+# exposed by fcntl only from python 3.12
+FICLONE = getattr(fcntl, "FICLONE", 0x40049409)
+
+# the TaskLog that receives the records of TASK_LOGGER in the current
+# context (thread or asyncio task)
+_active_task_log = contextvars.ContextVar("active_task_log", default=None)
+
+
+class TaskLogRouter(logging.Handler):
+    """Send the records of TASK_LOGGER to the active TaskLog.
+
+    Records emitted when no TaskLog is active go to the handlers that
+    were configured for TASK_LOGGER (e.g. via yakunin.json).
+    """
+
+    def __init__(self, handlers):
+        """Take the place of the given handlers."""
+        super().__init__()
+        self.configured_handlers = handlers
+
+    def emit(self, record):
+        """Pass the record on."""
+        task_log = _active_task_log.get()
+        if task_log is not None:
+            if record.levelno >= task_log.level:
+                task_log.handle(record)
+            return
+        for handler in self.configured_handlers:
+            if record.levelno >= handler.level:
+                handler.handle(record)
+
+
+class TaskLog(logging.FileHandler):
+    """The log of a single task (see TASK_LOG).
+
+    While the TaskLog is active (see `activate`), the records of
+    TASK_LOGGER emitted in the same context are written only to its
+    file, so that concurrent tasks never mix their logs. Level and
+    format are the same as the first handler configured for
+    TASK_LOGGER.
+    """
+
+    def __init__(self, filename):
+        """Open the log file."""
+        super().__init__(filename, mode="w")
+        # how many errors have been logged
+        self.errors = 0
+        router = self._router()
+        if router.configured_handlers:
+            template = router.configured_handlers[0]
+            self.setLevel(template.level)
+            self.setFormatter(template.formatter)
+
+    @staticmethod
+    def _router() -> TaskLogRouter:
+        """Return the router of TASK_LOGGER, installing it if needed.
+
+        The router is installed again when the logging configuration
+        has been reloaded in the meantime.
+        """
+        for handler in TASK_LOGGER.handlers:
+            if isinstance(handler, TaskLogRouter):
+                return handler
+        router = TaskLogRouter(list(TASK_LOGGER.handlers))
+        for handler in router.configured_handlers:
+            TASK_LOGGER.removeHandler(handler)
+        TASK_LOGGER.addHandler(router)
+        return router
+
+    def emit(self, record):
+        """Write the record, counting the errors."""
+        if record.levelno >= logging.ERROR:
+            self.errors += 1
+        super().emit(record)
+
+    def reopen(self, filename):
+        """Go on writing at the end of `filename` (e.g. the same log, moved elsewhere)."""
+        with self.lock:
+            if self.stream is not None:
+                self.stream.close()
+                self.stream = None
+            self.baseFilename = os.path.abspath(filename)
+            self.mode = "a"
+            # (not self._open: self.errors counts the errors here)
+            self.stream = open(self.baseFilename, self.mode, encoding=self.encoding)
+
+    @contextlib.contextmanager
+    def activate(self):
+        """Let TASK_LOGGER write to this log within the context."""
+        token = _active_task_log.set(self)
+        try:
+            yield self
+        finally:
+            _active_task_log.reset(token)
+
+
+class FollowedFile:
+    """A text file that a process is still writing (think of "tail -f").
+
+    `readline` waits until a whole line has been written, unless the
+    process has exited or the deadline (see time.monotonic) has passed:
+    then it behaves as the readline of a normal file. `tell` and `seek`
+    work as usual, so the file can be given to the functions of
+    log_reading_lib.
+
+    If `check` is given, it is called (at most every `check_interval`
+    seconds) while the file is read: it can stop the reading by raising
+    an exception (e.g. when the process takes too much space).
+    """
+
+    def __init__(
+        self,
+        fileobj,
+        process,
+        deadline=None,
+        interval=0.05,
+        check=None,
+        check_interval=1,
+    ):
+        """Follow the given file, written by the given process (a Popen)."""
+        self.fileobj = fileobj
+        self.process = process
+        self.deadline = deadline
+        self.interval = interval
+        self.check = check
+        self.check_interval = check_interval
+        self._last_check = time.monotonic()
+
+    def finished(self) -> bool:
+        """Tell if no more lines should be waited for."""
+        if self.process.poll() is not None:
+            return True
+        return self.deadline is not None and time.monotonic() > self.deadline
+
+    def readline(self) -> str:
+        """Return the next line (waiting for it, if needed)."""
+        while True:
+            if self.check is not None and (
+                time.monotonic() - self._last_check >= self.check_interval
+            ):
+                self.check()
+                self._last_check = time.monotonic()
+            # look before reading: what was written before the end is read
+            finished = self.finished()
+            position = self.fileobj.tell()
+            line = self.fileobj.readline()
+            if line.endswith("\n") or finished:
+                return line
+            self.fileobj.seek(position)
+            time.sleep(self.interval)
+
+    def tell(self):
+        """Return the position in the file."""
+        return self.fileobj.tell()
+
+    def seek(self, position):
+        """Go to the given position in the file."""
+        return self.fileobj.seek(position)
+
+
+def file_mime(filename: str) -> str:
+    """Return the mime type of the given file according to `file`."""
+    result = subprocess.run(
+        args=["file", "-b", "--mime-type", filename],
+        check=True,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        encoding="utf-8",
+    )
+    return result.stdout.strip()
+
+
+def guess_mime(filename: str) -> str:
+    """Return the mime type of the given file, outside of any task.
+
+    The type is the one that aruspica_mime starts from (compressed tar
+    files are just compressed files), and it is logged by YAKUNIN_LOGGER:
+    e.g. the service uses it to choose the lane of a task, where no task
+    log is active.
+    """
+    mime_type = sniff(filename) or file_mime(filename)
+    YAKUNIN_LOGGER.debug('Mime type of "%s" appears to be "%s"', filename, mime_type)
+    return mime_type
+
 
 def aruspica_mime(archive_filename):
     """Epatoscopia del file per determinarne il tipo.
@@ -34,89 +223,86 @@ def aruspica_mime(archive_filename):
     # .docx → zip
     # or do not know tex files (text/x-tex)
 
-    # Using "file"
-    result = subprocess.run(
-        args=["file", "-b", "--mime-type", archive_filename],
-        check=True,
-        stdout=subprocess.PIPE,
-        stderr=subprocess.STDOUT,
-        encoding="utf-8",
-    )
-    mime_type = result.stdout.strip()
+    # Using "file", unless we can tell the type by ourselves (as
+    # file would do, but without forking)
+    mime_type = sniff(archive_filename) or file_mime(archive_filename)
 
     TASK_LOGGER.debug(
         'Mime type of "%s" appears to be "%s"', archive_filename, mime_type
     )
 
-    # for doubtful mime_types, do a "first" extraction
-    # and check what you get
+    # for doubtful mime_types, peek at the beginning of the
+    # decompressed data and check what you get
 
     # Please note that mime type of tar.gz is debated:
     # https://superuser.com/a/960710/203364
     pesky_ones = {
         "application/gzip": {
-            "shutil_format": "gz",
+            "open": gzip.open,
             "possible_mime": "application/x-compressed-tar",
         },
         "application/x-bzip2": {
-            "shutil_format": "bz",
+            "open": bz2.open,
             "possible_mime": "application/x-bzip-compressed-tar",
         },
     }
-    tmpdir = tempfile.mkdtemp()
     if mime_type in pesky_ones:
-        shutil.unpack_archive(
-            archive_filename, tmpdir, pesky_ones[mime_type]["shutil_format"]
-        )
-
-        files = os.listdir(tmpdir)
-        assert len(files) == 1
-
-        result = subprocess.run(
-            args=["file", "-b", "--mime-type", os.path.join(tmpdir, files[0])],
-            check=True,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.STDOUT,
-            encoding="utf-8",
-        )
-        internal_mime_type = result.stdout.strip()
-        if internal_mime_type == "application/x-tar":
+        try:
+            with pesky_ones[mime_type]["open"](archive_filename) as decompressed:
+                header = decompressed.read(TAR_HEADER_SIZE)
+        except (OSError, EOFError) as exception:
+            # broken files are left to the unpacking
+            TASK_LOGGER.debug('Cannot decompress "%s": %s', archive_filename, exception)
+            header = b""
+        if is_tar_header(header):
             mime_type = pesky_ones[mime_type]["possible_mime"]
             TASK_LOGGER.debug(
                 'Mime type of "%s" is actually "%s"', archive_filename, mime_type
             )
-    shutil.rmtree(tmpdir)
 
     # TODO: do the same for zip file that could be odt or docx
     return mime_type
 
 
-def gunzip_something(src, work_dir):
-    """Gunzip the given gzipped file."""
-    src_basename = os.path.split(src)[-1]
-    # remve ".gz" from filename
-    src_basename = re.sub(r"(\.gz)?$", "", src_basename, flags=re.IGNORECASE)
-    with gzip.open(src, "rb") as f_in:
-        with open(os.path.join(work_dir, src_basename), "wb") as f_out:
-            shutil.copyfileobj(f_in, f_out)
-
+def place_file(src, dst, link=False):
+    """Put a copy of the file `src` at `dst`, as cheaply as possible.
 
-def bunzip2_something(src, work_dir):
-    """Bunzip2 the given bzipped file."""
-    src_basename = os.path.split(src)[-1]
-    # remve ".bz2" from filename
-    src_basename = re.sub(r"(\.bz2)?$", "", src_basename, flags=re.IGNORECASE)
-    with bz2.open(src, "rb") as f_in:
-        with open(os.path.join(work_dir, src_basename), "wb") as f_out:
+    If `link` is True, `dst` can be a hard link to `src` (so only for
+    files that nobody modifies). Otherwise `dst` is a clone of `src`
+    (where the filesystem can do copy-on-write), an in-kernel copy
+    (copy_file_range) or, as last resort, a plain copy.
+    """
+    if link:
+        try:
+            os.link(src, dst)
+            return
+        except OSError:
+            # e.g. different filesystems
+            pass
+    with open(src, "rb") as f_in, open(dst, "wb") as f_out:
+        try:
+            fcntl.ioctl(f_out.fileno(), FICLONE, f_in.fileno())
+            return
+        except OSError:
+            pass
+        try:
+            _copy_file_range(f_in, f_out)
+        except OSError:
+            f_in.seek(0)
+            f_out.seek(0)
+            f_out.truncate()
             shutil.copyfileobj(f_in, f_out)
 
 
-def just_copy(src, work_dir):
-    """Just copy src into work_dir."""
-    src_basename = os.path.split(src)[-1]
-    with open(src, "rb") as f_in:
-        with open(os.path.join(work_dir, src_basename), "wb") as f_out:
-            shutil.copyfileobj(f_in, f_out)
+def _copy_file_range(f_in, f_out):
+    if not hasattr(os, "copy_file_range"):
+        raise OSError("copy_file_range not available")
+    remaining = os.fstat(f_in.fileno()).st_size
+    while remaining > 0:
+        copied = os.copy_file_range(f_in.fileno(), f_out.fileno(), remaining)
+        if copied == 0:
+            break
+        remaining -= copied
 
 
 def use_patool(src, work_dir):
@@ -132,39 +318,6 @@ def use_patool(src, work_dir):
         raise UnknownArchiveFormat()
 
 
-shutil.register_unpack_format(
-    "gz",
-    [
-        "gz",
-    ],
-    gunzip_something,
-)
-
-shutil.register_unpack_format(
-    "bz",
-    [
-        "bz2",
-    ],
-    bunzip2_something,
-)
-
-shutil.register_unpack_format(
-    "copy",
-    [
-        "tex",
-    ],
-    just_copy,
-)
-
-shutil.register_unpack_format(
-    "any",
-    [
-        "rar",
-    ],
-    use_patool,
-)
-
-
 DOCUMENTCLASS = re.compile(r"^[^%]*\\documentclass")
 
 
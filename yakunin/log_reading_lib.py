@@ -15,7 +15,7 @@ controlo sequences" are displayed in the log two lines after the error
 message.
 
 Each function in this module will be "called" by
-yakunin.Archive::read_log durin log analysis.
+yakunin.Archive::_read_stdout during log analysis.
 """
 
 import logging
@@ -71,7 +71,7 @@ def report_error_and_line(
 
 
 def expose(search_string=None):
-    "Decorate a function so that it is used by read_log"
+    "Decorate a function so that it is used by Archive._read_stdout"
 
     def wrapper(func):
         func.exposed = True
@@ -0,0 +1,182 @@
+"""A minimal registry of metrics, exposed in Prometheus' text format.
+
+See https://prometheus.io/docs/instrumenting/exposition_formats/
+"""
+
+import math
+from typing import Callable, Dict, Iterable, List, Tuple
+
+# seconds; good both for requests and for the stages of the tasks
+DEFAULT_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", r"\\").replace("\n", r"\n").replace('"', r"\"")
+
+
+def _format_labels(labels: Iterable[Tuple[str, str]]) -> str:
+    labels = list(labels)
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in labels) + "}"
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class Metric:
+    """A family of samples sharing name and labels."""
+
+    kind = None
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str] = ()):
+        """Describe the metric."""
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+
+    def _key(self, labels: Dict[str, str]) -> Tuple[str]:
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def samples(self) -> List[Tuple[str, List[Tuple[str, str]], float]]:
+        """Return (name, labels, value) for every sample."""
+        raise NotImplementedError
+
+    def render(self) -> str:
+        """Return the text representation of the metric."""
+        lines = [
+            f"# HELP {self.name} {_escape(self.documentation)}",
+            f"# TYPE {self.name} {self.kind}",
+        ]
+        for name, labels, value in self.samples():
+            lines.append(f"{name}{_format_labels(labels)} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+
+class Counter(Metric):
+    """A value that can only go up."""
+
+    kind = "counter"
+
+    def __init__(self, *args, **kwargs):
+        """Start from zero."""
+        super().__init__(*args, **kwargs)
+        self.values: Dict[Tuple[str], float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        """Increase the counter with the given labels."""
+        key = self._key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def get(self, **labels) -> float:
+        """Return the current value of the counter with the given labels."""
+        return self.values.get(self._key(labels), 0)
+
+    def samples(self):
+        """Return a sample for each combination of labels."""
+        return [
+            (self.name, list(zip(self.labelnames, key)), value)
+            for key, value in sorted(self.values.items())
+        ]
+
+
+class Gauge(Metric):
+    """A value that is read when the metrics are collected.
+
+    `collect` must return a dictionary {label values (tuple): value}.
+    """
+
+    kind = "gauge"
+
+    def __init__(self, name, documentation, labelnames=(), collect: Callable = None):
+        """Remember how to read the values."""
+        super().__init__(name, documentation, labelnames)
+        self.collect = collect
+
+    def samples(self):
+        """Return the values read right now."""
+        return [
+            (self.name, list(zip(self.labelnames, key)), value)
+            for key, value in sorted(self.collect().items())
+        ]
+
+
+class Histogram(Metric):
+    """Count observations in buckets (cumulative, as Prometheus wants)."""
+
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        """Prepare empty buckets."""
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+        self.counts: Dict[Tuple[str], List[int]] = {}
+        self.sums: Dict[Tuple[str], float] = {}
+
+    def observe(self, value: float, **labels):
+        """Record an observation with the given labels."""
+        key = self._key(labels)
+        counts = self.counts.setdefault(key, [0] * len(self.buckets))
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                counts[index] += 1
+        self.sums[key] = self.sums.get(key, 0) + value
+
+    def get_count(self, **labels) -> int:
+        """Return the number of observations with the given labels."""
+        counts = self.counts.get(self._key(labels))
+        return counts[-1] if counts else 0
+
+    def samples(self):
+        """Return buckets, sum and count for each combination of labels."""
+        result = []
+        for key, counts in sorted(self.counts.items()):
+            labels = list(zip(self.labelnames, key))
+            for bound, count in zip(self.buckets, counts):
+                result.append(
+                    (
+                        f"{self.name}_bucket",
+                        labels + [("le", _format_value(bound))],
+                        count,
+                    )
+                )
+            result.append((f"{self.name}_sum", labels, self.sums[key]))
+            result.append((f"{self.name}_count", labels, counts[-1]))
+        return result
+
+
+class Registry:
+    """Collection of metrics, rendered together."""
+
+    def __init__(self):
+        """Start empty."""
+        self.metrics: Dict[str, Metric] = {}
+
+    def register(self, metric: Metric) -> Metric:
+        """Add a metric (or return the one already registered with that name)."""
+        return self.metrics.setdefault(metric.name, metric)
+
+    def counter(self, name: str, documentation: str, labelnames=()) -> Counter:
+        """Return the counter with the given name, creating it if needed."""
+        return self.register(Counter(name, documentation, labelnames))
+
+    def histogram(self, name: str, documentation: str, labelnames=()) -> Histogram:
+        """Return the histogram with the given name, creating it if needed."""
+        return self.register(Histogram(name, documentation, labelnames))
+
+    def gauge(
+        self, name: str, documentation: str, labelnames=(), collect=None
+    ) -> Gauge:
+        """Return the gauge with the given name, creating it if needed."""
+        return self.register(Gauge(name, documentation, labelnames, collect))
+
+    def render(self) -> str:
+        """Return all metrics in Prometheus' text format."""
+        return "".join(metric.render() for metric in self.metrics.values())
@@ -0,0 +1,176 @@
+"""In-process detection of the mime types that yakunin knows (see aruspica_mime).
+
+`sniff` reads the head of a file and returns the same mime type that
+`file -b --mime-type` would, for the types that Archive can unpack (TeX
+sources, PDFs, zip, tar, gzip, bzip2, rar, odt, docx) and for .doc
+files. For anything else, or when unsure, it returns None and the
+caller should ask `file`.
+
+The rules mimic those of file 5.4x (magic(5)), e.g. a docx is a zip
+whose third member is in "word/", and a TeX source is a text file with
+\\documentclass, \\section etc. in its first 4KB.
+"""
+
+import re
+import struct
+import tarfile
+from typing import Optional
+
+# file tells text from binary files by their first 64KB
+HEAD_SIZE = 64 * 1024
+
+PDF = "application/pdf"
+TEX = "text/x-tex"
+ZIP = "application/zip"
+TAR = "application/x-tar"
+ODT = "application/vnd.oasis.opendocument.text"
+DOCX = "application/vnd.openxmlformats-officedocument.wordprocessingml.document"
+MSWORD = "application/msword"
+
+# magic numbers at offset 0
+MAGIC_NUMBERS = (
+    (b"%PDF-", PDF),
+    (b"\x1f\x8b", "application/gzip"),
+    (b"BZh", "application/x-bzip2"),
+    (b"Rar!\x1a\x07", "application/x-rar"),
+    (b"PK\x05\x06", ZIP),  # (empty zip)
+)
+ZIP_MAGIC = b"PK\x03\x04"
+OLE_MAGIC = b"\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1"
+TAR_MAGIC = b"ustar"
+TAR_MAGIC_OFFSET = 257
+TAR_HEADER_SIZE = 512
+
+# bytes that never appear in text files
+BINARY_BYTES = re.compile(rb"[\x00-\x06\x0e-\x1a\x1c-\x1f\x7f]")
+UTF8_BOM = b"\xef\xbb\xbf"
+# the TeX commands that file looks for, in the first TEX_RANGE bytes
+TEX_COMMANDS = (
+    b"\\input",
+    b"\\begin",
+    b"\\section",
+    b"\\setlength",
+    b"\\documentstyle",
+    b"\\chapter",
+    b"\\documentclass",
+    b"\\relax",
+    b"\\contentsline",
+    b"% -*-latex-*-",
+)
+TEX_RANGE = 4096
+# text files with "%PDF-" this close to the beginning are PDFs for file
+PDF_RANGE = 256
+
+# a zip whose first member matches this is an OOXML document (docx,
+# xlsx...), whose kind is told by a following member
+OOXML_NAMES = re.compile(rb"\[Content_Types\]\.xml|_rels/\.rels|docProps|customXml")
+OOXML_SEARCH_RANGE = 6000
+# the stream that Word documents (among OLE2 files) have
+WORD_DOCUMENT = "WordDocument\0".encode("utf-16-le")
+ODF_MIMETYPE = b"application/vnd.oasis.opendocument.text"
+
+
+def sniff(path: str) -> Optional[str]:
+    """Return the mime type of the given file (or None if in doubt)."""
+    with open(path, "rb") as fileobj:
+        head = fileobj.read(HEAD_SIZE)
+        if not head:
+            return None
+        for magic, mime_type in MAGIC_NUMBERS:
+            if head.startswith(magic):
+                return mime_type
+        if head.startswith(ZIP_MAGIC):
+            return _sniff_zip(fileobj, head)
+        if head.startswith(OLE_MAGIC):
+            return _sniff_ole(fileobj, head)
+    if is_tar_header(head[:TAR_HEADER_SIZE]):
+        return TAR
+    return _sniff_text(head, complete=len(head) < HEAD_SIZE)
+
+
+def is_tar_header(header: bytes) -> bool:
+    """Tell whether the given block is the first header of a tar file."""
+    if header[TAR_MAGIC_OFFSET:].startswith(TAR_MAGIC):
+        return True
+    # the old (v7) headers have no magic, but a checksum
+    try:
+        tarfile.TarInfo.frombuf(header, "utf-8", "surrogateescape")
+    except tarfile.HeaderError:
+        return False
+    return True
+
+
+def _sniff_zip(fileobj, head: bytes) -> Optional[str]:
+    """Tell plain zip files from OpenDocument and OOXML ones."""
+    if head[30:38] == b"mimetype":
+        # OpenDocument: the first member, stored, is the mime type (and
+        # templates, masters etc. have their own)
+        declared = head[38:]
+        if declared.startswith(ODF_MIMETYPE) and not declared.startswith(
+            b"-", len(ODF_MIMETYPE)
+        ):
+            return ODT
+        return None
+    if head[30:].startswith(b"word/"):
+        return DOCX
+    # (file matches the regex up to the first NUL)
+    if OOXML_NAMES.search(head[30:].split(b"\0", 1)[0]):
+        (size,) = struct.unpack_from("<I", head, 18)
+        # file skips to the second local header (assuming that the name of
+        # the first member is 19 bytes long) and looks at the one after it
+        second = _search(fileobj, ZIP_MAGIC, size + 49, OOXML_SEARCH_RANGE)
+        if second is None:
+            return None
+        third = _search(fileobj, ZIP_MAGIC, second + 30, OOXML_SEARCH_RANGE)
+        if third is None:
+            return None
+        fileobj.seek(third + 30)
+        return DOCX if fileobj.read(5) == b"word/" else None
+    name_length, extra_length = struct.unpack_from("<HH", head, 26)
+    if extra_length and head.startswith(b"\xfe\xca", 30 + name_length):
+        # the extra field of Java archives
+        return None
+    return ZIP
+
+
+def _search(fileobj, pattern: bytes, offset: int, search_range: int) -> Optional[int]:
+    """Return where `pattern` starts, if it starts within `search_range` from `offset`."""
+    fileobj.seek(offset)
+    position = fileobj.read(search_range + len(pattern) - 1).find(pattern)
+    return None if position < 0 else offset + position
+
+
+def _sniff_ole(fileobj, head: bytes) -> Optional[str]:
+    """Recognize Word documents among OLE2 compound files."""
+    (sector_shift,) = struct.unpack_from("<H", head, 30)
+    (directory_sector,) = struct.unpack_from("<I", head, 48)
+    if not 7 <= sector_shift <= 16:
+        return None
+    fileobj.seek((directory_sector + 1) << sector_shift)
+    directory = fileobj.read(1 << sector_shift)
+    for start in range(0, len(directory) - 127, 128):
+        (name_length,) = struct.unpack_from("<H", directory, start + 64)
+        name = directory[start:][: min(name_length, 64)]
+        if name == WORD_DOCUMENT:
+            return MSWORD
+    return None
+
+
+def _sniff_text(head: bytes, complete: bool) -> Optional[str]:
+    """Recognize TeX sources (and text files that file takes for PDFs)."""
+    if complete and head.endswith(b"\0"):
+        # file ignores a NUL at the end
+        head = head[:-1]
+    if BINARY_BYTES.search(head):
+        return None
+    if head.find(b"%PDF-", 0, PDF_RANGE + 5) >= 0:
+        return PDF
+    # many kinds of text files (scripts, mails, HTML...) are told by their
+    # first bytes, which are seldom a command or a comment in TeX sources
+    text = head.split(UTF8_BOM, 1)[-1] if head.startswith(UTF8_BOM) else head
+    if not text.lstrip().startswith((b"\\", b"%")) or head.startswith(b"%!"):
+        return None
+    for command in TEX_COMMANDS:
+        if head.find(command, 0, TEX_RANGE + len(command)) >= 0:
+            return TEX
+    return None
@@ -0,0 +1,218 @@
+"""Incremental parser for multipart/form-data request bodies.
+
+The service receives the body of the requests in chunks (see
+tornado.web.stream_request_body). The parser is fed these chunks and
+writes the content of the interesting parts (e.g. the submitted
+archive) directly to disk, so that large uploads are never kept in
+memory.
+"""
+
+import email.message
+import email.utils
+import os
+import tempfile
+from typing import Dict, Iterable, List
+
+# the parts not written to disk (e.g. the wjs.ini file) must be small
+MAX_IN_MEMORY_PART = 1024 * 1024
+
+PREAMBLE = "preamble"
+DELIMITER = "delimiter"
+HEADERS = "headers"
+BODY = "body"
+EPILOGUE = "epilogue"
+
+
+class MultipartError(Exception):
+    """The request body is not a well-formed multipart/form-data."""
+
+
+class MultipartParser:
+    """Parse a multipart/form-data body that is received in chunks.
+
+    The parts whose name is in `disk_fields` and that have a filename
+    are written into `directory` (one file per part, named after the
+    basename of the given filename, in a subdir of `directory` if a
+    previous part has the same name). The path of the saved file is
+    available in `files[name][i]["path"]`.
+
+    The other parts with a filename are kept in memory, similarly to
+    what tornado does: see `files[name][i]["body"]`.
+
+    The parts without a filename (simple form fields) end up in
+    `arguments[name]` (a list of bytes).
+    """
+
+    def __init__(
+        self,
+        boundary: bytes,
+        directory: str,
+        disk_fields: Iterable[str] = ("file",),
+    ):
+        """Prepare to parse a body with the given boundary."""
+        if boundary.startswith(b'"') and boundary.endswith(b'"'):
+            boundary = boundary[1:-1]
+        self.directory = directory
+        self.disk_fields = tuple(disk_fields)
+        self.files: Dict[str, List[Dict]] = {}
+        self.arguments: Dict[str, List[bytes]] = {}
+
+        self._first_delimiter = b"--" + boundary
+        self._delimiter = b"\r\n--" + boundary
+        self._buffer = b""
+        self._state = PREAMBLE
+        # the part we are receiving: its description and where its body goes
+        self._part = None
+        self._sink = None
+        self._size = 0
+
+    def feed(self, chunk: bytes):
+        """Parse a new chunk of the body."""
+        self._buffer += chunk
+        progress = True
+        while progress:
+            if self._state == PREAMBLE:
+                progress = self._parse_preamble()
+            elif self._state == DELIMITER:
+                progress = self._after_delimiter()
+            elif self._state == HEADERS:
+                progress = self._parse_headers()
+            elif self._state == BODY:
+                progress = self._parse_body()
+            else:
+                # ignore anything after the last delimiter
+                self._buffer = b""
+                progress = False
+
+    def finish(self):
+        """Verify that the whole body has been received."""
+        if self._state != EPILOGUE:
+            self._close_part()
+            raise MultipartError("Truncated multipart body")
+
+    def close(self):
+        """Release the file being written (if any), e.g. after an error."""
+        self._close_part()
+
+    def _parse_preamble(self) -> bool:
+        index = self._buffer.find(self._first_delimiter)
+        if index < 0:
+            # keep only what could be the beginning of the delimiter
+            keep = len(self._first_delimiter)
+            self._buffer = self._buffer[-keep:]
+            return False
+        end = index + len(self._first_delimiter)
+        self._buffer = self._buffer[end:]
+        self._state = DELIMITER
+        return True
+
+    def _after_delimiter(self) -> bool:
+        """Decide if another part follows the delimiter we just read."""
+        if len(self._buffer) < 2:
+            return False
+        if self._buffer.startswith(b"--"):
+            self._state = EPILOGUE
+            return True
+        if not self._buffer.startswith(b"\r\n"):
+            raise MultipartError("Malformed delimiter")
+        self._buffer = self._buffer[2:]
+        self._state = HEADERS
+        return True
+
+    def _parse_headers(self) -> bool:
+        index = self._buffer.find(b"\r\n\r\n")
+        if index < 0:
+            if len(self._buffer) > MAX_IN_MEMORY_PART:
+                raise MultipartError("Part headers too long")
+            return False
+        try:
+            lines = self._buffer[:index].decode("utf-8").split("\r\n")
+        except UnicodeDecodeError as error:
+            raise MultipartError(f"Part headers not in UTF-8: {error}")
+        headers = email.message.Message()
+        for line in lines:
+            key, sep, value = line.partition(":")
+            if not sep:
+                raise MultipartError(f"Malformed part header {line}")
+            headers[key.strip()] = value.strip()
+        end = index + 4
+        self._buffer = self._buffer[end:]
+        self._open_part(headers)
+        self._state = BODY
+        return True
+
+    def _parse_body(self) -> bool:
+        index = self._buffer.find(self._delimiter)
+        if index < 0:
+            # everything but what could be the beginning of the
+            # delimiter belongs to the part
+            keep = len(self._delimiter) - 1
+            if len(self._buffer) > keep:
+                self._write(self._buffer[:-keep])
+                self._buffer = self._buffer[-keep:]
+            return False
+        self._write(self._buffer[:index])
+        end = index + len(self._delimiter)
+        self._buffer = self._buffer[end:]
+        self._close_part()
+        self._state = DELIMITER
+        return True
+
+    def _open_part(self, headers: email.message.Message):
+        name = headers.get_param("name", header="content-disposition")
+        filename = headers.get_param("filename", header="content-disposition")
+        if filename is not None:
+            filename = email.utils.collapse_rfc2231_value(filename)
+        if name is None:
+            raise MultipartError("Part without name")
+        self._size = 0
+        if filename is None:
+            self._part = {"name": name}
+            self._sink = []
+            return
+
+        self._part = {
+            "filename": filename,
+            "content_type": headers.get("content-type", "application/octet-stream"),
+        }
+        self.files.setdefault(name, []).append(self._part)
+        if name in self.disk_fields:
+            # never trust the path given by the client
+            basename = os.path.basename(filename.replace("\\", "/")) or name
+            path = os.path.join(self.directory, basename)
+            if os.path.exists(path):
+                # e.g. files with the same name from different dirs
+                directory = tempfile.mkdtemp(prefix=".part-", dir=self.directory)
+                path = os.path.join(directory, basename)
+            self._part["path"] = path
+            self._sink = open(path, "wb")
+        else:
+            self._part["body"] = b""
+            self._sink = []
+
+    def _write(self, data: bytes):
+        if not data:
+            return
+        self._size += len(data)
+        if isinstance(self._sink, list):
+            if self._size > MAX_IN_MEMORY_PART:
+                raise MultipartError("Part too large")
+            self._sink.append(data)
+        else:
+            self._sink.write(data)
+
+    def _close_part(self):
+        if self._sink is None:
+            return
+        if isinstance(self._sink, list):
+            body = b"".join(self._sink)
+            if "name" in self._part:
+                # a simple field
+                self.arguments.setdefault(self._part["name"], []).append(body)
+            else:
+                self._part["body"] = body
+        else:
+            self._sink.close()
+            self._part["size"] = self._size
+        self._sink = None
+        self._part = None
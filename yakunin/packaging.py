@@ -0,0 +1,325 @@
+"""Packaging of the results of the tasks (see Archive.submission_archive).
+
+The result of a task is the whole temp dir of an Archive. It can be
+packaged as:
+- gztar (the default): a tar.gz, as wjapp expects. With more than one
+  thread, the data is compressed in blocks, in parallel, and written as
+  a gzip file with many members (which gunzip, tar and python read
+  without noticing)
+- zstdtar: a tar.zst, compressed by the zstd command
+- zip: a zip file, where the members that are already compressed
+  (PDFs, images, archives...) are stored as they are and only the
+  others (e.g. TeX sources and logs) are deflated
+
+Most of a result (PDFs, figures, the received archive) is already
+compressed, so low compression levels cost much less time and lose
+very little space.
+"""
+
+import collections
+import gzip
+import os
+import stat
+import subprocess
+import tarfile
+import tempfile
+import time
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, Optional
+
+GZTAR = "gztar"
+ZSTDTAR = "zstdtar"
+ZIP = "zip"
+FORMATS = (GZTAR, ZSTDTAR, ZIP)
+DEFAULT_FORMAT = GZTAR
+
+SUFFIXES = {GZTAR: ".tar.gz", ZSTDTAR: ".tar.zst", ZIP: ".zip"}
+CONTENT_TYPES = {
+    ".tar.gz": "application/gzip",
+    ".tar.zst": "application/zstd",
+    ".zip": "application/zip",
+}
+
+# default and acceptable compression levels of each format
+DEFAULT_LEVEL = {GZTAR: 6, ZSTDTAR: 3, ZIP: 6}
+LEVELS = {GZTAR: range(0, 10), ZSTDTAR: range(1, 20), ZIP: range(0, 10)}
+
+# size of the blocks compressed in parallel (see ParallelGzipWriter)
+BLOCK_SIZE = 1024 * 1024
+
+# files that are (usually) already compressed: zip stores them as they are
+COMPRESSED_SUFFIXES = (
+    ".pdf",
+    ".png",
+    ".jpg",
+    ".jpeg",
+    ".gif",
+    ".webp",
+    ".zip",
+    ".gz",
+    ".tgz",
+    ".bz2",
+    ".xz",
+    ".zst",
+    ".7z",
+    ".rar",
+    ".docx",
+    ".odt",
+    ".epub",
+)
+
+
+def package(
+    directory: str,
+    package_format: str = DEFAULT_FORMAT,
+    level: int = None,
+    threads: int = 1,
+    dest_dir: str = None,
+) -> str:
+    """Package the content of the given directory into a new file.
+
+    `level` is the compression level (by default, DEFAULT_LEVEL of the
+    format) and `threads` how many threads can compress at once (0
+    means as many as the cores; only for gztar and zstdtar). The
+    package is created in `dest_dir` (by default, the system's temp
+    dir).
+
+    Return the path of the package (that the caller should remove).
+    """
+    if package_format not in FORMATS:
+        raise ValueError(f"Unknown package format {package_format}")
+
+    # write into the file created by mkstemp, so that the name
+    # stays reserved for us until the caller removes it
+    fd, result = tempfile.mkstemp(suffix=SUFFIXES[package_format], dir=dest_dir)
+    try:
+        with os.fdopen(fd, "wb") as fileobj:
+            write_package(directory, fileobj, package_format, level, threads)
+    except BaseException:
+        os.unlink(result)
+        raise
+    return result
+
+
+def write_package(
+    directory: str,
+    fileobj,
+    package_format: str = DEFAULT_FORMAT,
+    level: int = None,
+    threads: int = 1,
+):
+    """Write the package of the given directory into `fileobj` (see package).
+
+    `fileobj` only needs to be writable: the package can be sent while
+    it is written.
+    """
+    if package_format not in FORMATS:
+        raise ValueError(f"Unknown package format {package_format}")
+    if level is None:
+        level = DEFAULT_LEVEL[package_format]
+    if level not in LEVELS[package_format]:
+        raise ValueError(f"Invalid compression level {level} for {package_format}")
+    threads = threads or os.cpu_count() or 1
+    _WRITERS[package_format](str(directory), fileobj, level, threads)
+    fileobj.flush()
+
+
+def package_options(options: Dict[str, Any]) -> Dict[str, Any]:
+    """Return the arguments of package for the given options of a task."""
+    return {
+        "package_format": options.get("package_format") or DEFAULT_FORMAT,
+        "level": options.get("package_level"),
+        "threads": options.get("package_threads", 1),
+    }
+
+
+def suffix(path: str) -> Optional[str]:
+    """Return the suffix of the given package (e.g. ".tar.gz"), if known."""
+    for known in CONTENT_TYPES:
+        if path.endswith(known):
+            return known
+    return None
+
+
+def content_type(path: str) -> str:
+    """Return the content type of the given package."""
+    return CONTENT_TYPES.get(suffix(path), "application/gzip")
+
+
+def read_member(path: str, name: str) -> Optional[bytes]:
+    """Return the content of the file `name` of the packaged directory (or None).
+
+    `name` is relative to the packaged directory (e.g. "yakunin-task.log").
+    """
+    if suffix(path) == ".zip":
+        with zipfile.ZipFile(path) as archive:
+            try:
+                return archive.read(name)
+            except KeyError:
+                return None
+    if suffix(path) == ".tar.zst":
+        process = subprocess.Popen(["zstd", "-dcq", path], stdout=subprocess.PIPE)
+        try:
+            with tarfile.open(fileobj=process.stdout, mode="r|") as tar:
+                for member in tar:
+                    if member.name == f"./{name}" and member.isfile():
+                        return tar.extractfile(member).read()
+            return None
+        finally:
+            process.stdout.close()
+            process.kill()
+            process.wait()
+    with tarfile.open(path) as tar:
+        try:
+            return tar.extractfile(f"./{name}").read()
+        except KeyError:
+            return None
+
+
+class ParallelGzipWriter:
+    """A file-like object that gzips what is written to it, with many threads.
+
+    The data is cut into blocks that are compressed independently (zlib
+    releases the GIL) and written, in order, as the members of a
+    multi-member gzip file.
+    """
+
+    def __init__(self, fileobj, level: int, threads: int, block_size: int = BLOCK_SIZE):
+        """Write into `fileobj` (which is not closed at the end)."""
+        self.fileobj = fileobj
+        self.level = level
+        self.block_size = block_size
+        self.executor = ThreadPoolExecutor(max_workers=threads)
+        # at most this many blocks are kept in memory
+        self.max_pending = 2 * threads
+        self.pending = collections.deque()
+        self.buffer = bytearray()
+        self.written = False
+
+    def write(self, data: bytes) -> int:
+        """Compress the data (as soon as there is a whole block)."""
+        self.buffer += data
+        while len(self.buffer) >= self.block_size:
+            self._submit(bytes(self.buffer[: self.block_size]))
+            del self.buffer[: self.block_size]
+        return len(data)
+
+    def _submit(self, block: bytes):
+        self.pending.append(
+            self.executor.submit(gzip.compress, block, self.level, mtime=0)
+        )
+        self.written = True
+        while len(self.pending) > self.max_pending:
+            self.fileobj.write(self.pending.popleft().result())
+
+    def close(self):
+        """Compress what is left and write everything."""
+        if self.buffer or not self.written:
+            # (an empty file is still a valid gzip file)
+            self._submit(bytes(self.buffer))
+            self.buffer = bytearray()
+        while self.pending:
+            self.fileobj.write(self.pending.popleft().result())
+        self.executor.shutdown()
+
+    def __enter__(self):
+        """Use the writer as a context manager (closing it at the end)."""
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        """Write everything, unless something went wrong."""
+        if exc_type is None:
+            self.close()
+        else:
+            self.executor.shutdown(cancel_futures=True)
+
+
+def _write_gztar(directory: str, fileobj, level: int, threads: int):
+    if threads == 1:
+        with tarfile.open(fileobj=fileobj, mode="w:gz", compresslevel=level) as tar:
+            tar.add(directory, arcname=".")
+        return
+    with ParallelGzipWriter(fileobj, level, threads) as gzipped:
+        with tarfile.open(fileobj=gzipped, mode="w|") as tar:
+            tar.add(directory, arcname=".")
+
+
+def _write_zstdtar(directory: str, fileobj, level: int, threads: int):
+    args = ["zstd", "-q", "-c", f"-{level}", f"-T{threads}"]
+    try:
+        fileobj.fileno()
+        stdout = fileobj
+    except (AttributeError, OSError):
+        # (no file descriptor: a thread copies the output there)
+        stdout = subprocess.PIPE
+    process = subprocess.Popen(args, stdin=subprocess.PIPE, stdout=stdout)
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        copied = None
+        if stdout is subprocess.PIPE:
+            copied = executor.submit(_copy_output, process, fileobj)
+        try:
+            with tarfile.open(fileobj=process.stdin, mode="w|") as tar:
+                tar.add(directory, arcname=".")
+        except BrokenPipeError:
+            if copied is not None:
+                # (tell why zstd has been stopped)
+                copied.result()
+            raise
+        finally:
+            try:
+                process.stdin.close()
+            except BrokenPipeError:
+                pass
+            process.wait()
+        if copied is not None:
+            copied.result()
+    if process.returncode != 0:
+        raise subprocess.CalledProcessError(process.returncode, args)
+
+
+def _copy_output(process: subprocess.Popen, fileobj):
+    """Copy the output of the process into `fileobj`, stopping the process on errors."""
+    try:
+        for chunk in iter(lambda: process.stdout.read1(BLOCK_SIZE), b""):
+            fileobj.write(chunk)
+    except BaseException:
+        process.kill()
+        raise
+
+
+def _write_zip(directory: str, fileobj, level: int, threads: int):
+    with zipfile.ZipFile(
+        fileobj, "w", zipfile.ZIP_DEFLATED, compresslevel=level
+    ) as zip_file:
+        for dirpath, dirnames, filenames in os.walk(directory):
+            dirnames.sort()
+            for name in list(dirnames):
+                path = os.path.join(dirpath, name)
+                if os.path.islink(path):
+                    # not followed by os.walk
+                    dirnames.remove(name)
+                    _add_symlink(zip_file, path, os.path.relpath(path, directory))
+                else:
+                    zip_file.write(path, os.path.relpath(path, directory))
+            for name in sorted(filenames):
+                path = os.path.join(dirpath, name)
+                arcname = os.path.relpath(path, directory)
+                if os.path.islink(path):
+                    _add_symlink(zip_file, path, arcname)
+                elif name.lower().endswith(COMPRESSED_SUFFIXES):
+                    zip_file.write(path, arcname, compress_type=zipfile.ZIP_STORED)
+                else:
+                    zip_file.write(path, arcname)
+
+
+def _add_symlink(zip_file: zipfile.ZipFile, path: str, arcname: str):
+    """Store a symbolic link as such (as Info-ZIP does), without following it."""
+    mtime = time.localtime(os.lstat(path).st_mtime)
+    info = zipfile.ZipInfo(arcname, mtime[:6])
+    info.create_system = 3  # unix
+    info.external_attr = (stat.S_IFLNK | 0o777) << 16
+    zip_file.writestr(info, os.readlink(path))
+
+
+_WRITERS = {GZTAR: _write_gztar, ZSTDTAR: _write_zstdtar, ZIP: _write_zip}
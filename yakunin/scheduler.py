@@ -0,0 +1,269 @@
+"""Admission control for the tasks run by the service.
+
+Tasks are sorted into lanes by their expected cost (see choose_lane):
+- fast: tasks that do not compile anything (e.g. watermarking a PDF)
+- compile: tasks that run latexmk or libreoffice
+- remote: tasks that wait for medusa's services (pitstop, PDF/A...)
+
+Each lane has its own limit of concurrent executions and a bounded
+queue of tasks waiting for a free slot, so that cheap tasks never wait
+behind long compilations. When the queue is full, new tasks are refused
+instead of being accepted and then timing out.
+
+Identical tasks requested while one of them is running are run only
+once (see SingleFlight).
+"""
+
+import asyncio
+import functools
+import os
+from typing import Callable, Dict, List
+
+from tornado.ioloop import IOLoop
+from tornado.locks import Semaphore
+
+FAST = "fast"
+COMPILE = "compile"
+REMOTE = "remote"
+LANES = (FAST, COMPILE, REMOTE)
+
+# how many tasks can wait in each lane, per slot (see Scheduler); fast
+# tasks take well under a second, so more of them can wait their turn
+QUEUE_FACTOR = {FAST: 10}
+DEFAULT_QUEUE_FACTOR = 2
+
+# tasks that never compile anything
+FAST_COMMANDS = ("find_master", "tideup_src")
+# tasks that call medusa's services
+REMOTE_COMMANDS = ("pitstop_validate", "topdfa")
+
+
+def choose_lane(command: str, mime_type: str) -> str:
+    """Return the lane of the given task on a file of the given type."""
+    if command in FAST_COMMANDS:
+        return FAST
+    # .doc files are converted by medusa
+    if command in REMOTE_COMMANDS or mime_type == "application/msword":
+        return REMOTE
+    if mime_type == "application/pdf":
+        return FAST
+    return COMPILE
+
+
+def possible_lanes(command: str) -> tuple:
+    """Return the lanes where the given task can end up (whatever the file)."""
+    if command in FAST_COMMANDS:
+        return (FAST,)
+    if command in REMOTE_COMMANDS:
+        return (REMOTE,)
+    return LANES
+
+
+class QueueFull(Exception):
+    """No more tasks can be accepted in this lane for now."""
+
+
+class Limiter:
+    """Run at most `concurrency` tasks at once; let at most `max_queue` wait."""
+
+    def __init__(self, name: str, concurrency: int, max_queue: int):
+        """Set the limits."""
+        self.name = name
+        self.concurrency = concurrency
+        self.max_queue = max_queue
+        self.in_flight = 0
+        self.waiting = 0
+        self._semaphore = Semaphore(concurrency)
+
+    def is_full(self) -> bool:
+        """Tell if a new task would be refused."""
+        return self.in_flight >= self.concurrency and self.waiting >= self.max_queue
+
+    def run(self, executor, fn, *args):
+        """Queue `fn(*args)` for execution in the given executor.
+
+        Raise QueueFull immediately if there is no room in the queue,
+        otherwise return an awaitable with the result of `fn`.
+        """
+        if self.is_full():
+            raise QueueFull(self.name)
+        # count the task as waiting right away, so that the limit
+        # holds even before the coroutine starts
+        self.waiting += 1
+        return self._run(executor, fn, *args)
+
+    def run_all(self, executor, calls: List[tuple]) -> list:
+        """Queue many executions at once (e.g. the files of a batch).
+
+        `calls` are tuples `(fn, *args)`. They are refused together
+        (QueueFull) if there is no room in the queue, otherwise they
+        are all queued, even beyond `max_queue`: until they start, new
+        tasks are refused.
+
+        Return a list of awaitables, one for each call.
+        """
+        if self.is_full():
+            raise QueueFull(self.name)
+        self.waiting += len(calls)
+        return [self._run(executor, *call) for call in calls]
+
+    async def _run(self, executor, fn, *args):
+        acquire = self._semaphore.acquire()
+        try:
+            await acquire
+        except asyncio.CancelledError:
+            # cancelled right after getting the slot: give it back
+            if acquire.done() and not acquire.cancelled():
+                self._semaphore.release()
+            raise
+        finally:
+            self.waiting -= 1
+        self.in_flight += 1
+        try:
+            return await IOLoop.current().run_in_executor(executor, fn, *args)
+        finally:
+            self.in_flight -= 1
+            self._semaphore.release()
+
+    def status(self) -> Dict[str, int]:
+        """Report the current load."""
+        return {
+            "in_flight": self.in_flight,
+            "waiting": self.waiting,
+            "concurrency": self.concurrency,
+            "max_queue": self.max_queue,
+        }
+
+
+class Scheduler:
+    """Keep a Limiter for each lane.
+
+    `concurrency` maps lanes to their limit; the lanes not listed there
+    can run `default_concurrency` tasks at once (by default, as many as
+    the cores). Each lane can have `max_queue` waiting tasks (by
+    default, twice its concurrency; ten times for the fast lane).
+
+    Clients whose tasks are refused are asked to come back after
+    `retry_after` seconds.
+    """
+
+    def __init__(
+        self,
+        concurrency: Dict[str, int] = None,
+        default_concurrency: int = None,
+        max_queue: int = None,
+        retry_after: int = 30,
+    ):
+        """Set the limits."""
+        self.concurrency = concurrency or {}
+        self.default_concurrency = default_concurrency or os.cpu_count() or 1
+        self.max_queue = max_queue
+        self.retry_after = retry_after
+        self.limiters: Dict[str, Limiter] = {}
+
+    def limiter(self, name: str) -> Limiter:
+        """Return the limiter for the given lane."""
+        if name not in self.limiters:
+            concurrency = self.concurrency.get(name, self.default_concurrency)
+            max_queue = self.max_queue
+            if max_queue is None:
+                factor = QUEUE_FACTOR.get(name, DEFAULT_QUEUE_FACTOR)
+                max_queue = factor * concurrency
+            self.limiters[name] = Limiter(name, concurrency, max_queue)
+        return self.limiters[name]
+
+    def is_full(self, name: str) -> bool:
+        """Tell if a new task in the given lane would be refused."""
+        return name in self.limiters and self.limiters[name].is_full()
+
+    def status(self) -> Dict[str, Dict[str, int]]:
+        """Report the load of each lane seen so far."""
+        return {name: limiter.status() for name, limiter in self.limiters.items()}
+
+
+class Flight:
+    """A task whose result is shared by several users.
+
+    When the last user has left and the task is done, the result is
+    disposed of with `dispose(result)` (e.g. the result file is removed).
+    If the last user leaves before the task is done, the task is cancelled.
+    Whatever the outcome, `cleanup()` is called then (e.g. the files the
+    task works on are removed).
+
+    `owner` tells who started the task (e.g. the id of a job).
+    """
+
+    def __init__(
+        self, awaitable, dispose: Callable = None, owner=None, cleanup: Callable = None
+    ):
+        """Start waiting for the result of the task."""
+        self.future = asyncio.ensure_future(awaitable)
+        self.dispose = dispose
+        self.owner = owner
+        self.cleanup = cleanup
+        self.users = 0
+        self.future.add_done_callback(lambda _: self._release())
+
+    async def wait(self):
+        """Return the result of the task."""
+        # a user that goes away must not cancel the task of the others
+        return await asyncio.shield(self.future)
+
+    def leave(self):
+        """Tell that the result is not needed by one user any more."""
+        self.users -= 1
+        if self.users == 0 and not self.future.done():
+            # nobody is interested in the result any more
+            self.future.cancel()
+        self._release()
+
+    def _release(self):
+        if self.users > 0 or not self.future.done():
+            return
+        if self.cleanup is not None:
+            cleanup, self.cleanup = self.cleanup, None
+            cleanup()
+        if self.future.cancelled() or self.future.exception() is not None:
+            return
+        if self.dispose is not None:
+            self.dispose(self.future.result())
+
+
+class SingleFlight:
+    """Run identical tasks once, sharing the result among their users.
+
+    Tasks are identified by a key. Users `join` the flight of a task
+    (the first one starts the task) and `leave` it when they do not
+    need the result any more.
+    """
+
+    def __init__(self):
+        """Start with no flight."""
+        self.flights: Dict[str, Flight] = {}
+
+    def join(
+        self,
+        key: str,
+        start: Callable,
+        dispose: Callable = None,
+        owner=None,
+        cleanup: Callable = None,
+    ) -> Flight:
+        """Return the flight of the task with the given key.
+
+        If the task is not running, call `start()` to get an awaitable
+        with its result (exceptions raised by `start` are propagated)
+        and record the given `owner` and `cleanup` in the new Flight.
+        """
+        flight = self.flights.get(key)
+        if flight is None:
+            flight = Flight(start(), dispose, owner, cleanup)
+            self.flights[key] = flight
+            flight.future.add_done_callback(functools.partial(self._landed, key))
+        flight.users += 1
+        return flight
+
+    def _landed(self, key, future):
+        # new requests will start a new task
+        if self.flights.get(key) is not None and self.flights[key].future is future:
+            del self.flights[key]
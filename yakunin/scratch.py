@@ -0,0 +1,109 @@
+"""Scratch space of the tasks (see Archive.temp_dir).
+
+A Scratch knows where the tasks can work:
+- one or more base dirs on disk (e.g. on different disks): each new
+  job goes to the one with the most free space
+- optionally, a RAM-backed dir (e.g. on a tmpfs, such as /dev/shm),
+  for the jobs that are expected to stay small: jobs that grow beyond
+  `ram_threshold` bytes are moved (spilled) to disk
+
+The bytes used by each job are measured at the end of each stage of
+its processing (see Archive._stage), and every second while the TeX
+compilation runs: jobs beyond `max_job_size` bytes are stopped, so
+that one huge submission cannot fill the scratch space of all the
+others.
+"""
+
+import os
+import shutil
+import tempfile
+from typing import Any, Dict, List
+
+# default size above which jobs are moved from RAM to disk
+RAM_THRESHOLD = 64 * 1024 * 1024
+# a job usually needs a few times the size of its archive (the
+# extracted files, what the compilation produces, the result...)
+EXPECTED_GROWTH = 4
+
+
+class Scratch:
+    """Where the tasks work (see the module's docstring)."""
+
+    def __init__(
+        self,
+        base_dirs: List[str] = None,
+        ram_dir: str = None,
+        ram_threshold: int = RAM_THRESHOLD,
+        max_job_size: int = None,
+    ):
+        """Use the given dirs (by default, the system's temp dir), creating them if needed."""
+        self.base_dirs = list(base_dirs or [tempfile.gettempdir()])
+        self.ram_dir = ram_dir
+        self.ram_threshold = ram_threshold
+        self.max_job_size = max_job_size
+        for directory in self.base_dirs + ([ram_dir] if ram_dir else []):
+            os.makedirs(directory, exist_ok=True)
+
+    @classmethod
+    def from_config(cls, config: Dict[str, Any]) -> "Scratch":
+        """Read the scratch dirs from `config` (e.g. the GENERAL section of the config file).
+
+        `scratch_dirs` is a list of dirs (or a string of dirs separated
+        by os.pathsep), `scratch_ram_dir` the RAM-backed dir,
+        `scratch_ram_threshold` and `max_job_size` are in bytes.
+        """
+        config = {key.replace("-", "_"): value for key, value in config.items()}
+        base_dirs = config.get("scratch_dirs")
+        if isinstance(base_dirs, str):
+            base_dirs = [path for path in base_dirs.split(os.pathsep) if path]
+        max_job_size = config.get("max_job_size")
+        return cls(
+            base_dirs=base_dirs,
+            ram_dir=config.get("scratch_ram_dir"),
+            ram_threshold=int(config.get("scratch_ram_threshold") or RAM_THRESHOLD),
+            max_job_size=int(max_job_size) if max_job_size is not None else None,
+        )
+
+    def base_dir(self, file_size: int = 0) -> str:
+        """Return where a new job on a file of `file_size` bytes should work."""
+        if (
+            self.ram_dir
+            and file_size * EXPECTED_GROWTH <= self.ram_threshold
+            # (jobs can grow up to the threshold before they spill: leave
+            # room for another one)
+            and shutil.disk_usage(self.ram_dir).free >= 2 * self.ram_threshold
+        ):
+            return self.ram_dir
+        return self.disk_dir()
+
+    def disk_dir(self) -> str:
+        """Return the base dir on disk with the most free space."""
+        return max(self.base_dirs, key=lambda path: shutil.disk_usage(path).free)
+
+    def mkdtemp(self, file_size: int = 0, **kwargs) -> str:
+        """Create a new dir for a job on a file of `file_size` bytes (see tempfile.mkdtemp)."""
+        return tempfile.mkdtemp(dir=self.base_dir(file_size), **kwargs)
+
+    def in_ram(self, path: str) -> bool:
+        """Tell if the given path is in the RAM-backed dir."""
+        if not self.ram_dir:
+            return False
+        ram_dir = os.path.realpath(self.ram_dir)
+        return os.path.realpath(path).startswith(ram_dir + os.sep)
+
+    def must_measure(self, path: str) -> bool:
+        """Tell if the bytes of the job that works in `path` matter (see usage)."""
+        return self.max_job_size is not None or self.in_ram(path)
+
+
+def usage(path: str) -> int:
+    """Return how many bytes the files in the given dir take (links are not followed)."""
+    total = 0
+    for dirpath, _, filenames in os.walk(path):
+        for name in filenames:
+            try:
+                total += os.lstat(os.path.join(dirpath, name)).st_size
+            except FileNotFoundError:
+                # (removed in the meantime)
+                pass
+    return total
@@ -1,11 +1,12 @@
 """A web application server that exposes yakunin's functionalities as services."""
 
 import argparse
+import multiprocessing
 import os
 import sysconfig
-import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict
 
-import requests
 import tornado.httpserver
 import tornado.ioloop
 import tornado.web
@@ -13,34 +14,197 @@ import tornado.web
 import yakunin
 from yakunin.lib import YAKUNIN_LOGGER as logger  # NOQA N811
 
-from .service_handlers import Mkpdf, TestService, Watermark
+from .cache import MAX_CACHE_SIZE, ResultCache
+from .extraction import Limits
+from .jobs import JobStore
+from .metrics import Registry
+from .scheduler import LANES, Scheduler, SingleFlight
+from .scratch import Scratch
+from .service_handlers import (
+    MAX_BODY_SIZE,
+    ArchiveTask,
+    Batch,
+    JobLog,
+    JobResult,
+    Jobs,
+    JobStatus,
+    Metrics,
+    Mkpdf,
+    TestService,
+    Watermark,
+    log_request,
+    setup_metrics,
+)
+from .workers import WorkerTasks
 
 PORT = 8889
 
 
-def make_app():
+def make_app(
+    max_workers=None,
+    max_jobs=100,
+    job_ttl=3600,
+    max_body_size=None,
+    stream_results=False,
+    unpack_uploads=False,
+    config=None,
+    concurrency=None,
+    default_concurrency=None,
+    max_queue=None,
+    retry_after=30,
+    cache_dir=None,
+    cache_size=None,
+):
+    """Build the application.
+
+    Archive tasks are run in pools of worker processes, so that the
+    IOLoop stays responsive. Tasks are sorted into lanes by their
+    expected cost (see yakunin.scheduler) and each lane has its own
+    pool, as large as the concurrency of the lane. The pools have at
+    most `max_workers` processes in all (by default, the number of
+    cores): if the concurrencies of the lanes add up to more, each
+    pool is shrunk in proportion (but keeps at least one process), and
+    so is the concurrency of its lane.
+
+    At most `max_jobs` asynchronous jobs are remembered; their results
+    are kept for `job_ttl` seconds.
+
+    Uploads larger than `max_body_size` bytes are refused (see
+    service_handlers.MAX_BODY_SIZE for the default).
+
+    If `stream_results` is True, the results are tarred and gzipped
+    while they are sent to the client, instead of being packaged first.
+
+    If `unpack_uploads` is True, received tar files (possibly
+    compressed) are extracted while they arrive, instead of after (see
+    yakunin.extraction.StreamedExtraction).
+
+    `config` (a dict, e.g. the GENERAL section of the config file)
+    provides the default options of the tasks, the limits of the
+    extraction of the received archives (see yakunin.extraction.Limits)
+    and where the tasks work (see yakunin.scratch.Scratch).
+
+    At most `concurrency[LANE]` tasks of the lane LANE (e.g. "compile";
+    default_concurrency for the lanes not listed there, by default the
+    number of cores; at most the processes of its pool) run at the same
+    time, and at most `max_queue` can wait for a free slot (by default
+    twice the concurrency, ten times for the fast lane). Further tasks are refused with a 503 and asked
+    to come back after `retry_after` seconds. Identical requests (same
+    file, task and options) that arrive while the first one is running
+    share its result.
+
+    If `cache_dir` is given, the results are cached there (see
+    yakunin.cache), up to `cache_size` bytes (see cache.MAX_CACHE_SIZE
+    for the default).
+
+    Tasks are cancelled when their clients go away (see yakunin.workers).
+
+    Requests, tasks and the stages of the tasks are measured (see /metrics).
+
+    Call shutdown_app when the application is not needed any more.
+    """
+    # the manager keeps the stages of the jobs and the tasks that the
+    # workers are running, shared with the workers
+    manager = multiprocessing.Manager()
+    workers = WorkerTasks(manager.dict())
+    default_concurrency = default_concurrency or os.cpu_count() or 1
+    pool_sizes = split_workers(
+        {lane: (concurrency or {}).get(lane, default_concurrency) for lane in LANES},
+        max_workers or os.cpu_count() or 1,
+    )
+    # each lane admits only as many tasks as its pool can run: the
+    # others wait in its queue, where they are counted (and limited)
+    scheduler = Scheduler(
+        concurrency=pool_sizes,
+        max_queue=max_queue,
+        retry_after=retry_after,
+    )
+    cache = None
+    if cache_dir:
+        cache = ResultCache(cache_dir, cache_size or MAX_CACHE_SIZE)
+    executors = {
+        lane: ProcessPoolExecutor(max_workers=size, **workers.pool_options())
+        for lane, size in pool_sizes.items()
+    }
+    metrics = Registry()
+    setup_metrics(metrics, scheduler, cache)
     return tornado.web.Application(
         [
             (r"/test.*", TestService),
+            (r"/metrics/?", Metrics),
+            (r"/jobs/?", Jobs),
+            (r"/jobs/([0-9a-f]+)/?", JobStatus),
+            (r"/jobs/([0-9a-f]+)/result/?", JobResult),
+            (r"/jobs/([0-9a-f]+)/log/?", JobLog),
             (r"/mkpdf.*", Mkpdf),
             (r"/watermark.*", Watermark),
-            # other candidates:
-            # - tex_compile
-            # - pitstop_validate
-            # - topdfa
-            # - mkpdf
-            # - find_master
-            # - tideup_src
+            # any other task (e.g. /task/topdfa or /task with a `command` field)
+            (r"/task/(\w+)/?", ArchiveTask),
+            (r"/task/?", ArchiveTask),
+            # the same task on many files (e.g. /batch/watermark)
+            (r"/batch/(\w+)/?", Batch),
+            (r"/batch/?", Batch),
         ],
+        executors=executors,
+        workers=workers,
+        max_body_size=max_body_size or MAX_BODY_SIZE,
+        stream_results=stream_results,
+        unpack_uploads=unpack_uploads,
+        config=config or {},
+        scheduler=scheduler,
+        flights=SingleFlight(),
+        cache=cache,
+        limits=Limits.from_config(config or {}),
+        scratch=Scratch.from_config(config or {}),
+        metrics=metrics,
+        log_function=log_request,
+        manager=manager,
+        jobs=JobStore(max_jobs=max_jobs, ttl=job_ttl, stages=manager.dict()),
     )
 
 
+def split_workers(concurrency: Dict[str, int], max_workers: int) -> Dict[str, int]:
+    """Return how many processes the pool of each lane gets (see make_app)."""
+    total = sum(concurrency.values())
+    if total <= max_workers:
+        return dict(concurrency)
+    return {
+        lane: max(1, lane_concurrency * max_workers // total)
+        for lane, lane_concurrency in concurrency.items()
+    }
+
+
+def shutdown_app(app: tornado.web.Application):
+    """Stop the worker processes and the manager of the application (see make_app)."""
+    for executor in app.settings["executors"].values():
+        executor.shutdown(wait=False)
+    app.settings["manager"].shutdown()
+
+
 def main() -> None:
-    app = make_app()
+    # read the configuration first: worker processes inherit it
+    args = setup_yakunin()
+    app = make_app(
+        max_workers=getattr(args, "max_workers", None),
+        max_jobs=getattr(args, "max_jobs", 100),
+        job_ttl=getattr(args, "job_ttl", 3600),
+        max_body_size=getattr(args, "max_body_size", None),
+        stream_results=getattr(args, "stream_results", False),
+        unpack_uploads=getattr(args, "unpack_uploads", False),
+        config=vars(args),
+        concurrency=getattr(args, "concurrency", None),
+        default_concurrency=getattr(args, "default_concurrency", None),
+        max_queue=getattr(args, "max_queue", None),
+        retry_after=getattr(args, "retry_after", 30),
+        cache_dir=getattr(args, "cache_dir", None),
+        cache_size=getattr(args, "cache_size", None),
+    )
     app.listen(PORT)
-    setup_yakunin()
     logger.info("Started yakunin service")
-    tornado.ioloop.IOLoop.current().start()
+    try:
+        tornado.ioloop.IOLoop.current().start()
+    finally:
+        shutdown_app(app)
 
 
 def stop() -> None:
@@ -48,38 +212,11 @@ def stop() -> None:
     tornado.ioloop.IOLoop.current().stop()
 
 
-def send() -> None:
-    """Send a file to an handler.
+def setup_yakunin() -> argparse.Namespace:
+    """Read and apply yakunin configuration.
 
-    Usefult as shell entry point.
+    Return the configuration (GENERAL section merged with the defaults).
     """
-    parser = argparse.ArgumentParser(
-        "Yakunin service", description="Interact with the service"
-    )
-    parser.add_argument("filename", help="File to send.")
-    parser.add_argument("--ini", help="Optional ini file.")
-    parser.add_argument(
-        "--command",
-        default="watermark",
-        help="Command to apply. Defaults to %(default)s.",
-    )
-    args = parser.parse_args()
-    files_to_post = {"file": open(args.filename, "rb")}
-    if args.ini:
-        files_to_post["ini"] = open(args.ini, "rb")
-    response = requests.post(
-        f"http://localhost:{PORT}/{args.command}",
-        files=files_to_post,
-    )
-    _, fname = tempfile.mkstemp(prefix=f"{args.command}_", suffix=".tar.gz")
-    with open(fname, "wb") as fd:
-        fd.write(response.content)
-    print(f"Result:\n{fname}")
-    # TODO extract tar.gz and display it
-
-
-def setup_yakunin():
-    """Read and apply yakunin configuration."""
     # Get the installation path for data files
     data_path = sysconfig.get_path("data")
 
@@ -102,3 +239,4 @@ def setup_yakunin():
         logger.error("Yakunin configuration not found!")
         args.config_file = "Missing!"
     yakunin.merge_with_config_file(args)
+    return args
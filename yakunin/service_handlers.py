@@ -1,117 +1,992 @@
 """Library of entry points."""
 
+import asyncio
 import configparser
+import email.message
+import functools
+import glob
 import io
+import json
 import logging
 import os
 import shutil
 import tempfile
+import time
 from pathlib import Path
 from typing import Any
 
-from tornado.httpserver import HTTPRequest
-from tornado.web import RequestHandler
+from tornado.ioloop import IOLoop
+from tornado.iostream import StreamClosedError
+from tornado.log import access_log
+from tornado.web import HTTPError, RequestHandler, stream_request_body
 
 import yakunin
+from yakunin.batch import package_batch
+from yakunin.cache import ResultCache, cache_key, task_key
+from yakunin.exceptions import InvalidTaskOptions
+from yakunin.extraction import Extracted, StreamedExtraction
+from yakunin.jobs import DONE, Job, JobStoreFull
+from yakunin.lib import TASK_LOG, guess_mime
+from yakunin.metrics import Registry
+from yakunin.multipart import MultipartError, MultipartParser
+from yakunin.packaging import (
+    DEFAULT_FORMAT,
+    SUFFIXES,
+    content_type,
+    package_options,
+    read_member,
+    write_package,
+)
+from yakunin.scheduler import QueueFull, Scheduler, choose_lane, possible_lanes
+from yakunin.scratch import Scratch
+from yakunin.workers import TaskDirectory, run_task
 
 logger = logging.getLogger(__name__)
 
+# default limit for the size of the requests' body (1 GiB)
+MAX_BODY_SIZE = 1024**3
+
+# results are sent to the clients in chunks of this size
+CHUNK_SIZE = 64 * 1024
+
+# how often (in seconds) the task logs of the jobs are looked at
+LOG_POLL_INTERVAL = 0.25
+
 
 class TestService(RequestHandler):
     """Echo."""
 
     def get(self):
-        """Tell I'm well and who I am."""
+        """Tell I'm well and who I am (and how busy I am)."""
         self.write(f"I'm up and running on {self.request.full_url()}\n")
+        for name, status in self.settings["scheduler"].status().items():
+            self.write(
+                f"{name}: {status['in_flight']} running (max {status['concurrency']}),"
+                f" {status['waiting']} waiting (max {status['max_queue']})\n"
+            )
 
 
-class Mkpdf(RequestHandler):
-    """Generate PDF from any given file.
+class Metrics(RequestHandler):
+    """Expose the metrics of the service (Prometheus' text format)."""
 
-    Honor wjs.ini.
+    def get(self):
+        """Render all metrics."""
+        self.set_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.write(self.settings["metrics"].render())
+
+
+class ServiceBusy(HTTPError):
+    """Too many tasks: the client should retry later."""
+
+    def __init__(self, retry_after: int):
+        """Remember after how many seconds the client should retry."""
+        super().__init__(503, reason="Service busy")
+        self.retry_after = retry_after
+
+
+@stream_request_body
+class Upload(RequestHandler):
+    """Receive files posted as multipart/form-data.
+
+    The body of the request is parsed while it arrives and the `file`
+    part is written directly into a temporary directory (`temp_dir`),
+    which is removed when the request is finished, unless `keep_upload`
+    has been set.
+
+    Bodies larger than the `max_body_size` setting are refused.
+
+    With the `unpack_uploads` setting, the `file` parts that are tar
+    files (possibly compressed) are also extracted while they arrive
+    (see yakunin.extraction.StreamedExtraction and extracted).
     """
 
-    def post(self):
+    def prepare(self):
+        """Verify the size of the body and get ready to receive it."""
+        self.temp_dir = None
+        self.keep_upload = False
+        self.upload = None
+        self.upload_error = None
+        # the extractions of the received files, by path
+        self.extractions = {}
+
+        max_body_size = self.settings.get("max_body_size", MAX_BODY_SIZE)
+        content_length = self.request.headers.get("Content-Length")
+        if content_length is not None and int(content_length) > max_body_size:
+            raise HTTPError(413, reason=f"Body larger than {max_body_size} bytes")
+        self.request.connection.set_max_body_size(max_body_size)
+
+        content_type = email.message.Message()
+        content_type["content-type"] = self.request.headers.get("Content-Type", "")
+        boundary = content_type.get_param("boundary")
+        if content_type.get_content_type() != "multipart/form-data" or not boundary:
+            raise HTTPError(400, reason="Expecting multipart/form-data")
+
+        # (the body's size, if known, tells if the job can work in RAM)
+        expected_size = (
+            int(content_length) if content_length is not None else max_body_size
+        )
+        self.temp_dir = self.scratch().mkdtemp(expected_size)
+        self.upload = MultipartParser(boundary.encode(), self.temp_dir)
+
+    def data_received(self, chunk: bytes):
+        """Feed the received chunk to the parser."""
+        if self.upload_error is not None:
+            return
+        try:
+            self.upload.feed(chunk)
+        except MultipartError as error:
+            # report the error when the whole body has been received
+            self.upload_error = error
+            self.upload.close()
+            return
+        if self.settings.get("unpack_uploads"):
+            self.follow_files()
+
+    def follow_files(self):
+        """Extract the received files while they are written (see StreamedExtraction)."""
+        for file_posted in self.upload.files.get("file", []):
+            path = file_posted.get("path")
+            if path is None:
+                continue
+            extraction = self.extractions.get(path)
+            if extraction is None:
+                extraction = self.extractions[path] = StreamedExtraction(
+                    path,
+                    tempfile.mkdtemp(prefix=".unpacked-", dir=self.temp_dir),
+                    self.settings.get("limits"),
+                )
+            if "size" in file_posted:
+                # the whole file has been received
+                extraction.finish()
+
+    async def extracted(self, path: str) -> Extracted:
+        """Return the received file `path` as extracted while receiving it (or None)."""
+        extraction = self.extractions.get(path)
+        if extraction is None:
+            return None
+        return await asyncio.wrap_future(extraction.future)
+
+    def on_finish(self):
+        """Remove the received files (unless someone else owns them now)."""
+        if self.upload is not None:
+            self.upload.close()
+        for extraction in self.extractions.values():
+            extraction.abort()
+        if self.temp_dir is not None and not self.keep_upload:
+            shutil.rmtree(self.temp_dir, ignore_errors=True)
+
+    def scratch(self) -> Scratch:
+        """Return where the tasks work (see yakunin.scratch)."""
+        return self.settings.get("scratch") or Scratch()
+
+    def scratch_dir(self) -> str:
+        """Return where the results given to this request are copied (e.g. from the cache)."""
+        return self.scratch().disk_dir()
+
+    def main_file(self) -> str:
+        """Return the path of the received `file`."""
+        return self.received_files()[0]["path"]
+
+    def received_files(self) -> list[dict]:
+        """Return the received `file` parts (see MultipartParser.files)."""
+        if self.upload_error is None:
+            try:
+                self.upload.finish()
+            except MultipartError as error:
+                self.upload_error = error
+        if self.upload_error is not None:
+            raise HTTPError(400, reason=f"Bad multipart body: {self.upload_error}")
+        if "file" not in self.upload.files:
+            raise HTTPError(400, reason="Missing file")
+        files_posted = self.upload.files["file"]
+        for file_posted in files_posted:
+            logger.info(
+                f"Received {file_posted['filename']} as per request in {self.temp_dir}"
+            )
+        return files_posted
+
+    def write_error(self, status_code: int, **kwargs):
+        """Tell the client when to retry, if we are too busy."""
+        exception = kwargs.get("exc_info", (None, None, None))[1]
+        if isinstance(exception, ServiceBusy):
+            self.set_header("Retry-After", str(exception.retry_after))
+        super().write_error(status_code, **kwargs)
+
+    async def lane(self, command: str, archive_path: str) -> str:
+        """Return the lane of the given task on the given file (see yakunin.scheduler).
+
+        The type of the file is told as the Archive tells it, when it
+        matters (the compressed tar files do not matter, see
+        lib.guess_mime).
+        """
+        lanes = possible_lanes(command)
+        if len(lanes) == 1:
+            return lanes[0]
+        # (`file` may be called: don't block the IOLoop)
+        mime_type = await IOLoop.current().run_in_executor(
+            None, guess_mime, archive_path
+        )
+        return choose_lane(command, mime_type)
+
+    def schedule(self, command: str, lane: str, fn, *args):
+        """Queue `fn(*args)` for execution in the worker pool of the given lane.
+
+        At most a certain number of tasks of the same lane are run at
+        once and can wait for their turn (see yakunin.scheduler). If
+        there is no room, answer 503.
+
+        `fn` must return the result and the timings of the stages of
+        the task (see run_task), which are recorded in the metrics.
+
+        Return an awaitable with the result of `fn`. Cancelling it
+        cancels the task, even if a worker is already running it (see
+        yakunin.workers).
+        """
+        scheduler = self.settings["scheduler"]
+        workers = self.settings["workers"]
+        task_id, fn = workers.new_task(fn)
+        try:
+            execution = scheduler.limiter(lane).run(
+                self.settings["executors"][lane], fn, *args
+            )
+        except QueueFull:
+            logger.warning(f"Too many tasks in the {lane} lane. Refusing {command}.")
+            raise ServiceBusy(scheduler.retry_after)
+        return observe_task(
+            self.settings["metrics"],
+            command,
+            workers.cancel_on_exit(task_id, execution),
+        )
+
+    def schedule_all(self, command: str, calls: list[tuple]) -> list:
+        """Queue many executions of the same task (`command`) at once.
+
+        `calls` are tuples `(lane, fn, *args)` (see schedule). They are
+        all accepted or all refused with a 503.
+
+        Return a list of awaitables, one for each call.
+        """
+        scheduler = self.settings["scheduler"]
+        workers = self.settings["workers"]
+        lanes = {}
+        for index, (lane, fn, *args) in enumerate(calls):
+            task_id, fn = workers.new_task(fn)
+            lanes.setdefault(lane, []).append((index, task_id, (fn, *args)))
+        if any(scheduler.is_full(lane) for lane in lanes):
+            logger.warning(f"Too many tasks. Refusing a batch of {command}.")
+            raise ServiceBusy(scheduler.retry_after)
+        executions = [None] * len(calls)
+        for lane, indexed_calls in lanes.items():
+            awaitables = scheduler.limiter(lane).run_all(
+                self.settings["executors"][lane],
+                [call for _, _, call in indexed_calls],
+            )
+            for (index, task_id, _), execution in zip(indexed_calls, awaitables):
+                executions[index] = observe_task(
+                    self.settings["metrics"],
+                    command,
+                    workers.cancel_on_exit(task_id, execution),
+                )
+        return executions
+
+    async def task_key(
+        self, command: str, archive_path: str, options: dict[str, Any]
+    ) -> str:
+        """Return the key that identifies the task (see yakunin.cache)."""
+        extracted = await self.extracted(archive_path)
+        if extracted is not None and extracted.manifest is not None:
+            # the file has been hashed while it was extracted
+            return cache_key(extracted.manifest.digest, command, options)
+        # hashing large files must not block the IOLoop
+        return await IOLoop.current().run_in_executor(
+            None, task_key, archive_path, command, options
+        )
+
+    async def cached_result(self, command: str, key: str) -> str:
+        """Look for the result of the task in the cache (if there is one).
+
+        Return the path of a copy of the result (that the caller should
+        remove) or None.
+        """
+        cache = self.settings.get("cache")
+        if cache is None:
+            return None
+        result = await IOLoop.current().run_in_executor(
+            None, cache.get, key, self.scratch_dir()
+        )
+        self.settings["metrics"].metrics["yakunin_cache_requests_total"].inc(
+            task=command, outcome="miss" if result is None else "hit"
+        )
+        return result
+
+    def join_flight(
+        self,
+        command: str,
+        key: str,
+        start,
+        dispose,
+        owner=None,
+        own_upload=False,
+        cleanup=None,
+    ):
+        """Join the running task with the given key, or start it.
+
+        Identical requests that arrive while the task is running share
+        its result (see scheduler.SingleFlight). If `own_upload` is
+        True, a task started here works on the received files, which
+        then belong to the flight: they are removed when nobody needs
+        the task any more, not when this request is finished. Otherwise,
+        `cleanup` (if given) is called then (see scheduler.Flight).
+        """
+        if own_upload:
+            cleanup = functools.partial(
+                shutil.rmtree, self.temp_dir, ignore_errors=True
+            )
+
+            def start_owning():
+                awaitable = start()
+                self.keep_upload = True
+                return awaitable
+
+        flight = self.settings["flights"].join(
+            key, start_owning if own_upload else start, dispose, owner, cleanup
+        )
+        if flight.users > 1:
+            logger.info(f"Joining the running {command} task {key}")
+            self.settings["metrics"].metrics["yakunin_coalesced_requests_total"].inc(
+                task=command
+            )
+        return flight
+
+    def task_options(self, command: str) -> dict[str, Any]:
+        """Read and validate the options for the given task from the `ini` file.
+
+        The options are validated as if they were given on the command
+        line (see yakunin.task_options).
+        """
+        try:
+            return yakunin.task_options(
+                command,
+                ini_to_kwargs(self.upload.files),
+                config=self.settings.get("config"),
+            )
+        except InvalidTaskOptions as error:
+            raise HTTPError(400, reason=str(error))
+
+    def body_argument(self, name: str, default: str = None) -> str:
+        """Return the value of a (simple) form field."""
+        values = self.upload.arguments.get(name)
+        if not values:
+            return default
+        return values[-1].decode("utf-8")
+
+
+class ArchiveTask(Upload):
+    """Run an Archive task in the worker pool and serve back the result.
+
+    The name of the Archive method to call is taken from the URL (see
+    make_app), from the `command` attribute of subclasses or from the
+    `command` form field, in this order.
+    """
+
+    command = None
+
+    def prepare(self):
+        """Refuse the task before receiving the body, if there is no room for it."""
+        self.execution = None
+        # invalid requests are refused (e.g. with 413) even when we are busy
+        super().prepare()
+        command = self.command or (self.path_args[0] if self.path_args else None)
+        scheduler = self.settings["scheduler"]
+        if command is not None and all(
+            scheduler.is_full(lane) for lane in possible_lanes(command)
+        ):
+            raise ServiceBusy(scheduler.retry_after)
+
+    def on_connection_close(self):
+        """Stop waiting for the task, if the client went away.
+
+        The task is cancelled, unless someone else is waiting for it
+        (see scheduler.Flight).
+        """
+        super().on_connection_close()
+        if self.execution is not None and not self.execution.done():
+            logger.info(f"Client went away. Cancelling {self.request.path}.")
+            self.execution.cancel()
+
+    async def wait_for(self, awaitable):
+        """Wait for the task(s), unless the client goes away (see on_connection_close).
+
+        Raise asyncio.CancelledError if the client went away.
+        """
+        self.execution = asyncio.ensure_future(awaitable)
+        return await self.execution
+
+    async def post(self, command=None):
         """Expect a mandatory `file` and an optional `ini`.
 
         `file` can be any file. We'll attempt to transform it into a PDF.
 
         `ini` when given, must be a wjs.ini file.
         """
-        archive_path, temp_dir = get_main_file(self.request)
-        options = ini_to_kwargs(self.request)
+        archive_path = self.main_file()
+        command = command or self.command or self.body_argument("command")
+        options = self.task_options(command)
+        stream_results = self.settings.get("stream_results", False)
 
-        archive = yakunin.Archive(archive=archive_path)
-        archive.mkpdf(**options)
-        output_archive_path = Path(archive.submission_archive())
+        key = await self.task_key(command, archive_path, options)
+        cached = await self.cached_result(command, key)
+        if cached is not None:
+            try:
+                await serve_archive(self, Path(cached))
+            finally:
+                os.unlink(cached)
+            return
 
-        serve_archive(self, output_archive_path)
+        # Only the path of the received file and the options cross the
+        # process boundary: the worker reads the file from disk.
+        flight = self.join_flight(
+            command,
+            f"{key}-{'directory' if stream_results else 'archive'}",
+            functools.partial(
+                self.schedule,
+                command,
+                await self.lane(command, archive_path),
+                functools.partial(
+                    run_task,
+                    package=not stream_results,
+                    cache=self.settings.get("cache"),
+                    cache_key=key,
+                    limits=self.settings.get("limits"),
+                    scratch=self.settings.get("scratch"),
+                    extracted=await self.extracted(archive_path),
+                ),
+                command,
+                archive_path,
+                options,
+            ),
+            dispose=remove_directory if stream_results else os.unlink,
+            # (identical requests use these files, even if this one goes away)
+            own_upload=True,
+        )
+        try:
+            result = await self.wait_for(flight.wait())
+            if stream_results:
+                # result is the temp dir of the Archive
+                await self.stream_result(key, result, options)
+                result = result.path
+            else:
+                await serve_archive(self, Path(result))
+            logger.info(f"Sent back {Path(result).name} as per request.")
+        except asyncio.CancelledError:
+            # nobody to answer to
+            pass
+        finally:
+            flight.leave()
+
+    async def stream_result(
+        self, key: str, result: TaskDirectory, options: dict[str, Any]
+    ):
+        """Send the temp dir of the task, packaged while it is sent (see serve_directory).
 
-        logger.info(
-            f"Sent back {output_archive_path.name} as per request. Cleaning {temp_dir} and {output_archive_path}",
+        The request that started the task also stores the package in
+        the cache (if there is one and the task logged no errors), as
+        the workers do with the results they package.
+        """
+        cache = self.settings.get("cache")
+        package = package_options(options)
+        # (self.keep_upload: this request started the task)
+        if cache is None or not result.cacheable or not self.keep_upload:
+            await serve_directory(self, Path(result.path), **package)
+            return
+        fd, copy = tempfile.mkstemp(
+            suffix=SUFFIXES[package["package_format"]], dir=self.scratch_dir()
         )
-        shutil.rmtree(temp_dir)
-        os.unlink(output_archive_path)
+        try:
+            with os.fdopen(fd, "wb") as copy_file:
+                await serve_directory(
+                    self, Path(result.path), copy=copy_file, **package
+                )
+            await IOLoop.current().run_in_executor(None, cache.put, key, copy)
+        finally:
+            os.unlink(copy)
+
+
+class Mkpdf(ArchiveTask):
+    """Generate PDF from any given file.
+
+    Honor wjs.ini.
+    """
+
+    command = "mkpdf"
 
 
-class Watermark(RequestHandler):
+class Watermark(ArchiveTask):
     """Generate PDF from any given file and watermark it.
 
     Honor wjs.ini.
     """
 
-    def post(self):
-        """Expect a mandatory `file` and an optional `ini`.
+    command = "watermark"
 
-        `file` can be any file. We'll attempt to transform it into a PDF.
 
-        `ini` when given, must be a wjs.ini file.
+class Batch(ArchiveTask):
+    """Run an Archive task on many files and serve back all the results.
+
+    The command is taken from the URL or from the `command` form field.
+    Honor wjs.ini (the same options are used for all the files).
+    """
+
+    async def post(self, command=None):
+        """Expect one or more `file` and an optional `ini`.
+
+        The files are processed in parallel, as independent tasks. The
+        result is a single tar.gz with a directory for each file and a
+        manifest of the outcomes (see yakunin.batch).
         """
-        archive_path, temp_dir = get_main_file(self.request)
-        options = ini_to_kwargs(self.request)
+        files_posted = self.received_files()
+        command = command or self.body_argument("command")
+        options = self.task_options(command)
+        extracted = [
+            await self.extracted(file_posted["path"]) for file_posted in files_posted
+        ]
+        executions = self.schedule_all(
+            command,
+            [
+                (
+                    await self.lane(command, file_posted["path"]),
+                    functools.partial(
+                        run_task,
+                        cache=self.settings.get("cache"),
+                        limits=self.settings.get("limits"),
+                        scratch=self.settings.get("scratch"),
+                        extracted=extracted_file,
+                    ),
+                    command,
+                    file_posted["path"],
+                    options,
+                )
+                for file_posted, extracted_file in zip(files_posted, extracted)
+            ],
+        )
+        executions = [asyncio.ensure_future(execution) for execution in executions]
+        try:
+            outcomes = await self.wait_for(
+                asyncio.gather(*executions, return_exceptions=True)
+            )
+        except asyncio.CancelledError:
+            # the files processed so far will not be sent
+            for execution in executions:
+                if execution.done() and not execution.cancelled():
+                    if execution.exception() is None:
+                        os.unlink(execution.result())
+            return
+        results = [outcome for outcome in outcomes if isinstance(outcome, str)]
+        package = None
+        try:
+            package = await IOLoop.current().run_in_executor(
+                None,
+                package_batch,
+                command,
+                [file_posted["filename"] for file_posted in files_posted],
+                outcomes,
+                self.scratch_dir(),
+            )
+            await serve_archive(self, Path(package))
+            logger.info(f"Sent back the results of {len(outcomes)} files.")
+        finally:
+            for result in results + ([package] if package else []):
+                os.unlink(result)
+
+
+class Jobs(Upload):
+    """Submit a task without waiting for its result.
+
+    Honor wjs.ini.
+    """
+
+    async def post(self):
+        """Expect a mandatory `file` and `command` and an optional `ini`.
+
+        `command` is the name of the task to run (e.g. "topdfa").
+
+        Answer with the id of the job, which can be used to ask for the
+        status of the job (/jobs/ID) and for its result (/jobs/ID/result).
+        """
+        archive_path = self.main_file()
+        command = self.body_argument("command")
+        options = self.task_options(command)
+        key = await self.task_key(command, archive_path, options)
+        cached = await self.cached_result(command, key)
+
+        job = Job(command=command, temp_dir=self.temp_dir)
+        store = self.settings["jobs"]
+        try:
+            store.add(job)
+        except JobStoreFull:
+            logger.warning("Too many jobs. Refusing a new one.")
+            raise ServiceBusy(self.settings["scheduler"].retry_after)
+        if cached is not None:
+            execution = asyncio.get_running_loop().create_future()
+            execution.set_result(cached)
+        else:
+            try:
+                # jobs join only jobs: they follow the stages of the
+                # job that started the task
+                flight = self.join_flight(
+                    command,
+                    f"{key}-job",
+                    functools.partial(
+                        self.schedule,
+                        command,
+                        await self.lane(command, archive_path),
+                        functools.partial(
+                            run_task,
+                            cache=self.settings.get("cache"),
+                            cache_key=key,
+                            limits=self.settings.get("limits"),
+                            scratch=self.settings.get("scratch"),
+                            extracted=await self.extracted(archive_path),
+                            # the task log can be followed (see JobLog)
+                            base_dir=self.temp_dir,
+                        ),
+                        command,
+                        archive_path,
+                        options,
+                        store.stages,
+                        job.id,
+                    ),
+                    dispose=os.unlink,
+                    owner=job.id,
+                    # the task works in the dir of the job, and records
+                    # its stage under the id of the job: these are
+                    # released when the job and the flight are both done
+                    cleanup=functools.partial(store.release, job),
+                )
+            except ServiceBusy:
+                store.remove(job.id)
+                raise
+            if flight.owner == job.id:
+                job.users += 1
+            job.stage_key = flight.owner
+            leader = store.jobs.get(flight.owner)
+            if leader is not None:
+                job.work_dir = leader.work_dir
+            execution = own_copy(flight, self.scratch_dir())
+        # the job will take care of the received files
+        self.keep_upload = True
+        job.execution = asyncio.ensure_future(execution)
+        job.execution.add_done_callback(job.done)
+        logger.info(f"Submitted job {job.id} ({command})")
+
+        self.set_status(202)
+        self.set_header("Location", f"/jobs/{job.id}")
+        self.write(job.as_dict())
+
+
+class JobStatus(RequestHandler):
+    """Report on a submitted job (or get rid of it)."""
 
-        archive = yakunin.Archive(archive=archive_path)
-        archive.watermark(**options)
-        output_archive_path = Path(archive.submission_archive())
+    def get(self, job_id):
+        """Tell the state and the current stage of the job."""
+        job = self.settings["jobs"].get(job_id)
+        if job is None:
+            raise HTTPError(404, f"Unknown job {job_id}")
+        self.write(job.as_dict())
 
-        serve_archive(self, output_archive_path)
+    def delete(self, job_id):
+        """Cancel the job or, if it is finished, forget it.
 
-        logger.info(
-            f"Sent back {output_archive_path.name} as per request. Cleaning {temp_dir} and {output_archive_path}",
+        The task of a cancelled job is stopped, unless other jobs share
+        it. Cancelled jobs are kept (see JobStore), so that their state
+        can be seen; finished jobs are removed with their result.
+        """
+        store = self.settings["jobs"]
+        job = store.get(job_id)
+        if job is None:
+            raise HTTPError(404, f"Unknown job {job_id}")
+        if job.is_finished():
+            store.remove(job_id)
+            logger.info(f"Removed job {job_id}")
+            self.set_status(204)
+            return
+        job.cancel()
+        logger.info(f"Cancelled job {job_id}")
+        self.write(job.as_dict())
+
+
+class JobResult(RequestHandler):
+    """Serve the result of a job."""
+
+    async def get(self, job_id):
+        """Serve the tar.gz produced by the job.
+
+        The result is kept (and can be asked for again) until the job expires.
+        """
+        job = self.settings["jobs"].get(job_id)
+        if job is None:
+            raise HTTPError(404, f"Unknown job {job_id}")
+        if job.state != DONE:
+            raise HTTPError(409, reason=f"Job {job_id} is {job.state}")
+        await serve_archive(self, Path(job.result))
+
+
+class JobLog(RequestHandler):
+    """Stream the task log of a job while the job runs (Server-Sent Events).
+
+    Each line of the log is sent as a `log` event, whose id is the
+    position of the next line in the log: clients that reconnect with
+    a Last-Event-ID header resume from there. Changes of stage are sent
+    as `stage` events. When the job is finished, an `end` event
+    describes the job (as /jobs/ID does) and the stream is closed.
+    """
+
+    def prepare(self):
+        """Notice when the client goes away."""
+        self.gone = False
+
+    def on_connection_close(self):
+        """Stop streaming."""
+        self.gone = True
+
+    async def get(self, job_id):
+        """Send the log as it is written."""
+        store = self.settings["jobs"]
+        job = store.get(job_id)
+        if job is None:
+            raise HTTPError(404, f"Unknown job {job_id}")
+        try:
+            position = int(self.request.headers.get("Last-Event-ID") or 0)
+        except ValueError:
+            raise HTTPError(400, reason="Invalid Last-Event-ID")
+
+        self.set_header("Content-Type", "text/event-stream")
+        self.set_header("Cache-Control", "no-cache")
+        stage = None
+        try:
+            while not self.gone:
+                job = store.get(job_id)
+                if job is None:
+                    # expired in the meantime
+                    break
+                # look before reading: what was logged before the end is sent
+                finished = job.is_finished()
+                if job.stage != stage:
+                    stage = job.stage
+                    self.send_event("stage", stage)
+                position = await self.send_log(job, position, finished)
+                if finished:
+                    self.send_event("end", json.dumps(job.as_dict()))
+                    await self.flush()
+                    break
+                await self.flush()
+                await asyncio.sleep(LOG_POLL_INTERVAL)
+        except StreamClosedError:
+            logger.debug(f"Client stopped following the log of job {job_id}")
+
+    async def send_log(self, job: Job, position: int, finished: bool) -> int:
+        """Send the lines of the log from the given position on.
+
+        The last line is sent only if complete, unless the job is
+        finished. Return the position of the first line not sent.
+        """
+        content = await IOLoop.current().run_in_executor(
+            None, read_task_log, job, position
         )
-        shutil.rmtree(temp_dir)
-        os.unlink(output_archive_path)
+        lines = content.split(b"\n")
+        if not finished:
+            # wait for the rest of the last line
+            lines.pop()
+        for line in lines:
+            position += len(line) + 1
+            if line:
+                self.send_event(
+                    "log", line.decode("utf-8", errors="replace"), event_id=position
+                )
+        return position
+
+    def send_event(self, event: str, data: str, event_id: int = None):
+        """Write (but do not flush) an event."""
+        if event_id is not None:
+            self.write(f"id: {event_id}\n")
+        self.write(f"event: {event}\ndata: {data}\n\n")
 
 
-def get_main_file(request: HTTPRequest) -> [str, str]:
-    """Extract the main file from the request and save it locally.
+def read_task_log(job: Job, position: int) -> bytes:
+    """Return the task log of the job, from the given position on.
 
-    Return the full path of the main file and the containing temporary dir.
-    The caller should clean-up these files.
+    The log is read from the directory where the task runs or, if the
+    task did not run (e.g. the result was in the cache), from the result.
     """
-    file_posted = request.files["file"][0]
-    original_fname: str = file_posted["filename"]
-    temp_dir = tempfile.mkdtemp()
-    logger.info(f"Received {original_fname} as per request. Creating {temp_dir}")
-    archive_path = os.path.join(temp_dir, original_fname)
-    with open(archive_path, "wb") as f:
-        f.write(file_posted["body"])
-    return archive_path, temp_dir
+    paths = glob.glob(os.path.join(glob.escape(job.work_dir), "*", TASK_LOG))
+    if paths:
+        with open(paths[0], "rb") as task_log:
+            task_log.seek(position)
+            return task_log.read()
+    if job.result is not None and os.path.exists(job.result):
+        content = read_member(job.result, TASK_LOG) or b""
+        return content[position:]
+    return b""
+
+
+def remove_directory(directory: TaskDirectory):
+    """Remove the temp dir of a task (see run_task)."""
+    shutil.rmtree(directory.path)
 
 
-def ini_to_kwargs(request: HTTPRequest) -> dict[str:Any]:
-    """Read an ini file from the request.
+async def own_copy(flight, dest_dir: str = None) -> str:
+    """Wait for the result (a file) of the flight and return a copy of it.
+
+    The copy is created in `dest_dir` (see copy_to_temp) and belongs
+    to the caller.
+    """
+    try:
+        result = await flight.wait()
+        return await IOLoop.current().run_in_executor(
+            None, copy_to_temp, result, dest_dir
+        )
+    finally:
+        flight.leave()
+
+
+def copy_to_temp(path: str, dest_dir: str = None) -> str:
+    """Copy the given file into a new temporary file and return its path.
+
+    The copy is created in `dest_dir` (by default, the system's temp dir).
+    """
+    fd, copy = tempfile.mkstemp(suffix="".join(Path(path).suffixes), dir=dest_dir)
+    with os.fdopen(fd, "wb") as dst, open(path, "rb") as src:
+        shutil.copyfileobj(src, dst, CHUNK_SIZE)
+    return copy
+
+
+def setup_metrics(metrics: Registry, scheduler: Scheduler, cache: ResultCache = None):
+    """Declare the metrics of the service."""
+    metrics.counter(
+        "yakunin_http_requests_total",
+        "HTTP requests served.",
+        ("handler", "method", "code"),
+    )
+    metrics.histogram(
+        "yakunin_http_request_duration_seconds",
+        "Time spent serving HTTP requests.",
+        ("handler", "method"),
+    )
+    metrics.counter(
+        "yakunin_tasks_total",
+        "Archive tasks run, by outcome (success or the name of the exception).",
+        ("task", "outcome"),
+    )
+    metrics.histogram(
+        "yakunin_task_duration_seconds",
+        "Time from the submission of an Archive task to its end (queue included).",
+        ("task",),
+    )
+    metrics.histogram(
+        "yakunin_stage_duration_seconds",
+        "Time spent in each stage of the Archive tasks (nested stages excluded).",
+        ("task", "stage"),
+    )
+    metrics.gauge(
+        "yakunin_tasks_in_flight",
+        "Archive tasks running right now, by lane.",
+        ("lane",),
+        lambda: {(name,): s["in_flight"] for name, s in scheduler.status().items()},
+    )
+    metrics.gauge(
+        "yakunin_tasks_waiting",
+        "Archive tasks waiting for a free slot, by lane.",
+        ("lane",),
+        lambda: {(name,): s["waiting"] for name, s in scheduler.status().items()},
+    )
+    metrics.counter(
+        "yakunin_coalesced_requests_total",
+        "Requests that joined an identical task that was already running.",
+        ("task",),
+    )
+    metrics.counter(
+        "yakunin_cache_requests_total",
+        "Lookups in the result cache, by outcome (hit or miss).",
+        ("task", "outcome"),
+    )
+    if cache is not None:
+        metrics.gauge(
+            "yakunin_cache_size_bytes",
+            "Size of the results stored in the cache.",
+            (),
+            lambda: {(): cache.size()},
+        )
+
+
+async def observe_task(metrics: Registry, command: str, execution) -> str:
+    """Await the execution of run_task and record its outcome and timings.
+
+    Return the result of the task (without the timings).
+    """
+    start = time.monotonic()
+    timings = []
+    outcome = "success"
+    try:
+        result, timings = await execution
+        return result
+    except BaseException as error:
+        outcome = type(error).__name__
+        timings = getattr(error, "stage_timings", [])
+        raise
+    finally:
+        metrics.metrics["yakunin_tasks_total"].inc(task=command, outcome=outcome)
+        metrics.metrics["yakunin_task_duration_seconds"].observe(
+            time.monotonic() - start, task=command
+        )
+        for stage, seconds in timings:
+            metrics.metrics["yakunin_stage_duration_seconds"].observe(
+                seconds, task=command, stage=stage
+            )
+
+
+def log_request(handler: RequestHandler):
+    """Log the request (as tornado does by default) and record its metrics.
+
+    To be used as `log_function` setting of the Application.
+    """
+    status = handler.get_status()
+    if status < 400:
+        log_method = access_log.info
+    elif status < 500:
+        log_method = access_log.warning
+    else:
+        log_method = access_log.error
+    request_time = handler.request.request_time()
+    log_method(
+        "%d %s %.2fms", status, handler._request_summary(), 1000.0 * request_time
+    )
+
+    metrics = handler.settings.get("metrics")
+    if metrics is None:
+        return
+    name = type(handler).__name__
+    method = handler.request.method
+    metrics.metrics["yakunin_http_requests_total"].inc(
+        handler=name, method=method, code=status
+    )
+    metrics.metrics["yakunin_http_request_duration_seconds"].observe(
+        request_time, handler=name, method=method
+    )
+
+
+def ini_to_kwargs(files: dict[str, list]) -> dict[str:Any]:
+    """Read an ini file from the files of the request.
 
     Return ini entries in the section [wjs] as a dictionary.
     """
-    if "ini" not in request.files:
+    if "ini" not in files:
         return {}
 
-    posted_ini_file = request.files["ini"][0]
+    posted_ini_file = files["ini"][0]
     config = configparser.ConfigParser()
     config.read_file(io.StringIO(posted_ini_file["body"].decode("utf-8")))
     if "wjs" in config.sections():
-        return config["wjs"]
+        return dict(config["wjs"])
     else:
         logger.warning(
             f'Received ini file {posted_ini_file["filename"]} does not have section "wjs".'
@@ -119,11 +994,85 @@ def ini_to_kwargs(request: HTTPRequest) -> dict[str:Any]:
         return {}
 
 
-def serve_archive(response: RequestHandler, archive: Path):
-    """Serve the given tar.gz archive as an attachment."""
-    response.set_header("Content-Type", "application/gzip")
+async def serve_archive(response: RequestHandler, archive: Path):
+    """Serve the given archive (e.g. a tar.gz, see yakunin.packaging) as an attachment.
+
+    The archive is sent in chunks, waiting for each chunk to be sent
+    before reading the next one.
+    """
+    response.set_header("Content-Type", content_type(str(archive)))
     response.set_header(
         "Content-Disposition", f'attachment; filename="{archive.name}"'
     )  # noqa E702
     with open(archive, "rb") as f:
-        response.write(f.read())
+        for chunk in iter(functools.partial(f.read, CHUNK_SIZE), b""):
+            response.write(chunk)
+            await response.flush()
+
+
+async def serve_directory(
+    response: RequestHandler,
+    directory: Path,
+    package_format: str = DEFAULT_FORMAT,
+    level: int = None,
+    threads: int = 1,
+    copy=None,
+):
+    """Serve the given directory as an attachment (see yakunin.packaging.package).
+
+    The package is generated (in a thread) while it is sent, so it is
+    never written to disk nor kept in memory, unless a `copy` (a file
+    object) is given: then the package is written there too.
+    """
+    name = directory.name + SUFFIXES[package_format]
+    response.set_header("Content-Type", content_type(name))
+    response.set_header(
+        "Content-Disposition", f'attachment; filename="{name}"'
+    )  # noqa E702
+
+    async def send(chunk):
+        response.write(chunk)
+        await response.flush()
+
+    writer = ChunkedWriter(send, asyncio.get_running_loop(), copy=copy)
+    await IOLoop.current().run_in_executor(
+        None, write_package, directory, writer, package_format, level, threads
+    )
+
+
+class ChunkedWriter:
+    """A file-like object that sends what is written to it in chunks.
+
+    `send` is a coroutine function (to be run in `loop`) that receives
+    the chunks. It is meant to be written to from a thread other than
+    the loop's one: `write` blocks until the chunk has been sent.
+    If `copy` (a file object) is given, the data is written there too.
+    """
+
+    def __init__(self, send, loop, chunk_size: int = CHUNK_SIZE, copy=None):
+        """Remember where to send the data."""
+        self.send = send
+        self.loop = loop
+        self.chunk_size = chunk_size
+        self.copy = copy
+        self.buffer = []
+        self.size = 0
+
+    def write(self, data: bytes) -> int:
+        """Buffer the data and send a chunk if the buffer is big enough."""
+        self.buffer.append(bytes(data))
+        self.size += len(data)
+        if self.copy is not None:
+            self.copy.write(data)
+        if self.size >= self.chunk_size:
+            self.flush()
+        return len(data)
+
+    def flush(self):
+        """Send what has been buffered."""
+        if not self.buffer:
+            return
+        chunk = b"".join(self.buffer)
+        self.buffer = []
+        self.size = 0
+        asyncio.run_coroutine_threadsafe(self.send(chunk), self.loop).result()
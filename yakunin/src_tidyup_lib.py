@@ -8,7 +8,7 @@ and the order of call DOES MATTER.
 Functions are ordered by name
 
 Each function in this module will be "called" by
-yakunin.Archive::read_log durin log analysis.
+yakunin.Archive::tideup_src before the compilation.
 """
 
 import logging
@@ -0,0 +1,268 @@
+"""Worker processes of the service: the tasks they run and how to cancel them.
+
+Each worker runs in its own process group, so that all the commands
+started by a task (latexmk and the TeX engines, biber, LibreOffice, gs,
+pdftk...) can be signalled at once. To cancel a running task, the
+service marks it as cancelled in the shared dict of the tasks and sends
+CANCEL_SIGNAL to the worker that runs it. The worker checks that the
+task it is running is the one that was cancelled (it may have moved on
+to another one meanwhile), sends the signal to its process group, so
+that the commands die (the default action of the signal is to
+terminate), and raises TaskCancelled from whatever it was waiting for
+(a command, an HTTP call to medusa...), so that it is free for the
+next task right away.
+"""
+
+import asyncio
+import contextlib
+import functools
+import os
+import signal
+import uuid
+from typing import Any, Callable, NamedTuple, Tuple
+
+from tornado.ioloop import IOLoop
+
+import yakunin
+from yakunin.cache import ResultCache
+from yakunin.exceptions import TaskCancelled
+from yakunin.extraction import Extracted, Limits
+from yakunin.scratch import Scratch
+
+CANCEL_SIGNAL = signal.SIGUSR1
+
+# recorded instead of the pid of the worker for tasks cancelled before
+# they started (see WorkerTasks)
+CANCELLED = 0
+
+# tasks cancelled before they started are forgotten after this many
+# seconds (the task might still be in the queue of the pool meanwhile)
+FORGET_CANCELLED_AFTER = 3600
+
+# in the workers: the tasks shared with the service (see WorkerTasks),
+# the task being run, whether it has been cancelled, whether the worker
+# must not be interrupted right now (see uninterrupted) and whether a
+# signal arrived meanwhile
+_tasks = None
+_current = None
+_cancelled = False
+_shielded = False
+_pending = False
+
+
+def init_worker(tasks):
+    """Prepare a worker process (initializer of the pools, see WorkerTasks)."""
+    global _tasks
+    _tasks = tasks
+    os.setsid()
+    signal.signal(CANCEL_SIGNAL, _on_cancel)
+
+
+def _on_cancel(signum, frame):
+    global _pending
+    if _current is None or _cancelled:
+        return
+    if _shielded:
+        # the manager cannot be asked in the middle of another call
+        _pending = True
+        return
+    _cancel_if_requested()
+    if _cancelled:
+        raise TaskCancelled(f"Task {_current} cancelled")
+
+
+def _cancel_if_requested():
+    """Stop the commands of the running task, if it is the one that was cancelled.
+
+    The signal might be meant for a previous task of the worker.
+    """
+    global _cancelled, _pending
+    _pending = False
+    if _current is None:
+        return
+    with uninterrupted():
+        requested = _tasks.get(_current) == CANCELLED
+    if requested and not _cancelled:
+        _cancelled = True
+        try:
+            # (the worker itself ignores the signal now)
+            os.killpg(os.getpid(), CANCEL_SIGNAL)
+        except ProcessLookupError:
+            pass
+
+
+@contextlib.contextmanager
+def uninterrupted():
+    """Do not raise TaskCancelled in the middle of this block.
+
+    E.g. talking with the manager process must not be interrupted
+    halfway. A cancellation that arrives meanwhile stops the commands
+    at the end of the block, and the task at the next check_cancelled.
+    """
+    global _shielded
+    shielded, _shielded = _shielded, True
+    try:
+        yield
+    finally:
+        _shielded = shielded
+        if _pending and not _shielded:
+            _cancel_if_requested()
+
+
+def check_cancelled():
+    """Raise TaskCancelled if the running task has been cancelled."""
+    if _cancelled:
+        raise TaskCancelled(f"Task {_current} cancelled")
+
+
+def run_cancellable(task_id: str, fn: Callable, *args, **kwargs):
+    """Run `fn(*args, **kwargs)` in a worker, as the task `task_id`."""
+    global _current, _cancelled
+    # (set before registering: a cancellation can arrive right after)
+    _current, _cancelled = task_id, False
+    try:
+        with uninterrupted():
+            registered = _tasks.setdefault(task_id, os.getpid())
+        if registered == CANCELLED:
+            raise TaskCancelled(f"Task {task_id} cancelled")
+        check_cancelled()
+        return fn(*args, **kwargs)
+    finally:
+        with uninterrupted():
+            _tasks.pop(task_id, None)
+        _current = None
+
+
+class TaskDirectory(NamedTuple):
+    """The temp dir of an Archive whose result is not packaged (see run_task)."""
+
+    path: str
+    # the task logged no errors: its result can be cached (see Archive)
+    cacheable: bool
+
+
+def run_task(
+    command: str,
+    archive_path: str,
+    options: dict[str, Any],
+    stages=None,
+    job_id: str = None,
+    package: bool = True,
+    cache: ResultCache = None,
+    base_dir: str = None,
+    limits: Limits = None,
+    extracted: Extracted = None,
+    scratch: Scratch = None,
+    cache_key: str = None,
+) -> tuple[str, list]:
+    """Run the given Archive task on the given file.
+
+    This function is executed by the worker processes of the service.
+    If `stages` is given, record there (with key `job_id`) the stages
+    of the processing as they happen. If `cache` is given, the result
+    is looked up there and stored there (see Archive), with the given
+    `cache_key` if the caller knows it already. If `base_dir` is
+    given, the Archive works in a new directory inside it (that the
+    caller should remove), otherwise in the `scratch` space. `limits`
+    bounds the extraction of the archive and `extracted` is the archive
+    already extracted while it was received (see yakunin.extraction).
+
+    Return the path of the tar.gz containing the results or, if
+    `package` is False, the Archive's temp dir (a TaskDirectory, that
+    the caller should remove), together with the timings of the stages
+    (see Archive.timings). If the task fails, the timings are attached
+    to the exception (`stage_timings`).
+    """
+
+    def progress(stage):
+        if stages is not None:
+            with uninterrupted():
+                stages[job_id] = stage
+        # cancellations that could not interrupt the worker stop it here
+        check_cancelled()
+
+    archive = yakunin.Archive(
+        archive=archive_path,
+        tex_master=options.get("tex_master"),
+        base_dir=base_dir,
+        progress=progress,
+        cache=cache,
+        limits=limits,
+        extracted=extracted,
+        scratch=scratch,
+        cache_key=cache_key,
+    )
+    keep_temp_dir = False
+    try:
+        if not package:
+            with archive.pipeline():
+                getattr(archive, command)(**options)
+            keep_temp_dir = True
+            directory = TaskDirectory(archive.temp_dir, archive.task_log.errors == 0)
+            return directory, archive.timings
+        # some tasks (e.g. find_master) do not package their result
+        result = getattr(archive, command)(**options) or archive.submission_archive(
+            **options
+        )
+        return result, archive.timings
+    except Exception as error:
+        # the attributes of exceptions survive the trip to the main process
+        error.stage_timings = archive.timings
+        raise
+    finally:
+        if base_dir is None:
+            archive.cleanup(keep_temp_dir=keep_temp_dir)
+        else:
+            # (the caller removes base_dir and what the task left there)
+            archive.task_log.close()
+
+
+class WorkerTasks:
+    """Keep track of the tasks run by the workers, so that they can be cancelled.
+
+    `tasks` is a dict-like object shared with the workers (e.g. a
+    Manager dict), where the workers record the tasks they are running
+    (with their pid). The pools of workers must be created with the
+    options given by `pool_options`.
+    """
+
+    def __init__(self, tasks):
+        """Use the given shared dict."""
+        self.tasks = tasks
+
+    def pool_options(self) -> dict:
+        """Return the options of the ProcessPoolExecutors that run the tasks."""
+        return {"initializer": init_worker, "initargs": (self.tasks,)}
+
+    def new_task(self, fn: Callable) -> Tuple[str, Callable]:
+        """Return the id of a new task and the function to run in the pool for it.
+
+        The returned function runs `fn` (with the same arguments).
+        """
+        task_id = uuid.uuid4().hex
+        return task_id, functools.partial(run_cancellable, task_id, fn)
+
+    def cancel(self, task_id: str):
+        """Stop the given task, or prevent it from starting."""
+        pid = self.tasks.setdefault(task_id, CANCELLED)
+        # (the task may also have finished before being marked)
+        IOLoop.current().call_later(
+            FORGET_CANCELLED_AFTER, self.tasks.pop, task_id, None
+        )
+        if pid == CANCELLED:
+            return
+        # the worker may have moved on to another task in the meantime:
+        # it stops only if its task is marked
+        self.tasks[task_id] = CANCELLED
+        try:
+            os.kill(pid, CANCEL_SIGNAL)
+        except ProcessLookupError:
+            pass
+
+    async def cancel_on_exit(self, task_id: str, execution):
+        """Await the execution of the task; cancel the task if the wait is cancelled."""
+        try:
+            return await execution
+        except asyncio.CancelledError:
+            self.cancel(task_id)
+            raise